@@ -0,0 +1,148 @@
+"""
+Streaming analysis of captured network traffic.
+Reads a pcap capture, or the capture inside a zip archive, in constant memory: packets are dissected down to TCP/UDP,
+TCP streams are reassembled, and the connections to the chat server's port are decoded into per-session message
+timelines. Prints per transport protocol and per service port statistics (packets, sizes, inter-arrival times,
+throughput), computed with NumPy, and the same per application protocol and port for a network dataset CSV.
+
+usage: python analyze.py [capture] [--member NAME] [--port 10000] [--timelines] [--top 15] [--csv network_data_file.csv]
+"""
+import argparse
+import os
+import time
+import chat_decode
+import dissect
+import pcap
+import stats
+from streams import Reassembler, CLIENT, SERVER
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DEFAULT_CAPTURE = os.path.join(ROOT, "chat_two_clients_filtered.pcap")
+TRANSPORTS = {dissect.TCP: "tcp", dissect.UDP: "udp"}
+
+class Analysis:
+    """
+    The results of one pass over a capture.
+    """
+    def __init__(self, port: int, on_session=None, keep_sessions: bool = False):
+        self.packets = 0
+        self.bytes = 0
+        self.other = 0
+        # Keyed by the IP protocol number, and by protocol << 16 | service port.
+        self.by_transport = stats.GroupStats()
+        self.by_port = stats.GroupStats()
+        self.chat = chat_decode.ChatDecoder(port, self._session_closed, keep_sessions)
+        self.chat_messages = stats.GroupStats()
+        self.reassembler = Reassembler(self.chat)
+        self.first = None
+        self.last = None
+        self.elapsed = 0.0
+        self.sessions = 0
+        self._on_session = on_session
+
+    def _session_closed(self, session):
+        self.sessions += 1
+        for message in session.messages:
+            self.chat_messages.add(-1 if message.msg_type is None else message.msg_type, message.timestamp, len(message.text.encode("utf-8")))
+        if self._on_session is not None:
+            self._on_session(session)
+
+    def run(self, capture: pcap.Capture):
+        started = time.perf_counter()
+        link_type = capture.link_type
+        for timestamp, length, data in capture.packets():
+            self.packets += 1
+            self.bytes += length
+            if self.first is None:
+                self.first = timestamp
+            self.last = timestamp
+            segment = dissect.dissect(link_type, data)
+            if segment is None:
+                self.other += 1
+                continue
+            self.by_transport.add(segment.protocol, timestamp, length)
+            self.by_port.add(segment.protocol << 16 | stats.service_port(segment.sport, segment.dport), timestamp, length)
+            if segment.protocol == dissect.TCP:
+                self.reassembler.add(timestamp, segment)
+        self.reassembler.close_all()
+        self.elapsed = time.perf_counter() - started
+
+def analyze_capture(path: str, member: str = None, port: int = chat_decode.CHAT_PORT, on_session=None,
+                    keep_sessions: bool = False) -> tuple:
+    """
+    Run the whole analysis over a capture.
+    args:
+        path (str): A pcap file, or a zip archive holding one.
+        member (str): The capture inside the archive.
+        port (int): The chat server's port.
+        on_session (callable): Called with each decoded ChatSession once its connection closes.
+        keep_sessions (bool): Keep the decoded sessions in analysis.chat.sessions, memory then grows with the capture.
+    returns:
+        tuple: (the Analysis, the closed Capture with its name and counters).
+    """
+    analysis = Analysis(port, on_session, keep_sessions)
+    with pcap.open_capture(path, member) as capture:
+        analysis.run(capture)
+    return analysis, capture
+
+def print_table(title: str, summary: dict, label, top: int = None):
+    """
+    Print a GroupStats summary, label turns a group id into its row name.
+    """
+    print(f"\n{title}")
+    print(f"{'':>16} | {'count':>8} | {'bytes':>12} | {'size mean':>9} | {'size std':>8} | {'size max':>8} | "
+          f"{'gap mean ms':>11} | {'gap std ms':>10} | {'gap max s':>9} | {'throughput B/s':>14}")
+    rows = len(summary["group"]) if top is None else min(top, len(summary["group"]))
+    for row in range(rows):
+        print(f"{label(int(summary['group'][row])):>16} | {summary['count'][row]:>8} | {summary['bytes'][row]:>12} | "
+              f"{summary['size_mean'][row]:>9.1f} | {summary['size_std'][row]:>8.1f} | {summary['size_max'][row]:>8.0f} | "
+              f"{summary['gap_mean'][row] * 1000:>11.3f} | {summary['gap_std'][row] * 1000:>10.3f} | "
+              f"{summary['gap_max'][row]:>9.3f} | {summary['throughput'][row]:>14.1f}")
+    if rows < len(summary["group"]):
+        print(f"{'':>16}   ... {len(summary['group']) - rows} more")
+
+def port_label(group: int) -> str:
+    return f"{TRANSPORTS.get(group >> 16, group >> 16)}/{group & 0xFFFF}"
+
+def print_session(session):
+    client = f"{dissect.address(session.client[0])}:{session.client[1]}"
+    room = f"room {session.room_id}" if session.room_id is not None else "no room"
+    print(f"\nSession {session.name or '?'} from {client}, {room}, {session.format or 'no data'} format, "
+          f"{len(session.messages)} messages, {session.bytes[CLIENT]} bytes sent / {session.bytes[SERVER]} received")
+    for direction, error in enumerate(session.errors):
+        if error is not None:
+            print(f"  {'client' if direction == CLIENT else 'server'} stream not decoded past: {error}")
+    for line in session.timeline():
+        print(f"  {line}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", nargs="?", default=DEFAULT_CAPTURE, help="pcap file or zip archive holding one")
+    parser.add_argument("--member", help="capture inside the zip archive, its first .pcap by default")
+    parser.add_argument("--port", type=int, default=chat_decode.CHAT_PORT, help="the chat server's port")
+    parser.add_argument("--timelines", action="store_true", help="print every chat session's messages")
+    parser.add_argument("--top", type=int, default=15, help="service ports to list")
+    parser.add_argument("--csv", help="network dataset CSV to summarise as well")
+    args = parser.parse_args()
+
+    analysis, capture = analyze_capture(args.capture, args.member, args.port, print_session if args.timelines else None)
+    duration = (analysis.last - analysis.first) if analysis.packets else 0.0
+    print(f"{capture.name}: {analysis.packets} packets, {analysis.bytes} bytes over {duration:.3f}s of capture, "
+          f"link type {capture.link_type}, {'memory mapped' if capture.mapped else 'streamed from the archive'}")
+    print(f"analysed in {analysis.elapsed:.3f}s, {capture.bytes_read / max(analysis.elapsed, 1e-9) / 1e6:.1f} MB/s, "
+          f"{analysis.packets / max(analysis.elapsed, 1e-9):.0f} packets/s")
+    print(f"{analysis.other} packets not TCP/UDP over IP, {analysis.reassembler.opened} TCP connections, "
+          f"{analysis.reassembler.gaps} reassembly gaps")
+    print_table("Per transport protocol", analysis.by_transport.summary(), lambda group: TRANSPORTS.get(group, str(group)))
+    print_table("Per service port (the lower port of each conversation)", analysis.by_port.summary(), port_label, args.top)
+    print(f"\nChat sessions on port {args.port}: {analysis.sessions}, {analysis.chat.messages} messages")
+    if analysis.chat.messages:
+        print_table("Chat messages per type (text format sessions as 'text')", analysis.chat_messages.summary(),
+                    lambda group: "text" if group < 0 else chat_decode.TYPE_NAMES.get(group, str(group)))
+    if args.csv:
+        dataset = stats.DatasetStats()
+        dataset.read(args.csv)
+        names = dataset.protocol_names()
+        print(f"\n{args.csv}: {dataset.rows} rows")
+        print_table("Per application protocol", dataset.by_protocol.summary(), lambda group: names[group])
+        print_table("Per service port", dataset.by_port.summary(), str, args.top)
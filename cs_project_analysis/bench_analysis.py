@@ -0,0 +1,105 @@
+"""
+Benchmark of the capture analysis.
+Analyses the same capture three ways, each in a process of its own for its peak memory:
+  in-memory  the notebook way: the whole capture read into memory and every packet parsed into a list of dicts first
+  zip        the streaming analysis reading straight from the zip archive
+  mmap       the streaming analysis over the capture extracted to a file, memory mapped
+and reports the time each took and its peak resident memory. The in-memory run only dissects the packets, it does not
+reassemble or decode anything, so it is a lower bound of the work the notebook does.
+
+usage: python bench_analysis.py [archive] [--member NAME] [--repeat 3]
+"""
+import argparse
+import os
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+import numpy as np
+import analyze
+import dissect
+import pcap
+
+ARCHIVE = os.path.join(analyze.ROOT, "jupyter_cs_project_packets.zip")
+VARIANTS = ("in-memory", "zip", "mmap")
+
+def load_all(path: str, member: str = None) -> list:
+    """The notebook's approach: read everything, then build one dict per packet."""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            data = archive.read(member or archive.namelist()[0])
+    else:
+        with open(path, "rb") as capture_file:
+            data = capture_file.read()
+    link_type = struct.unpack_from("<I", data, 20)[0]
+    packets = []
+    offset = pcap.GLOBAL_HEADER_SIZE
+    while offset + pcap.RECORD_SIZE <= len(data):
+        seconds, fraction, captured, length = struct.unpack_from("<IIII", data, offset)
+        frame = data[offset + pcap.RECORD_SIZE:offset + pcap.RECORD_SIZE + captured]
+        offset += pcap.RECORD_SIZE + captured
+        segment = dissect.dissect(link_type, memoryview(frame))
+        packet = {"time": seconds + fraction / 1e6, "length": length, "frame": frame}
+        if segment is not None:
+            packet.update(sport=segment.sport, dport=segment.dport, flags=segment.flags, payload=bytes(segment.payload))
+        packets.append(packet)
+    return packets
+
+def run_variant(variant: str, path: str, member: str) -> float:
+    started = time.perf_counter()
+    if variant == "in-memory":
+        packets = load_all(path, member)
+        times = np.array([packet["time"] for packet in packets])
+        sizes = np.array([packet["length"] for packet in packets])
+        # The notebook's statistics over the loaded packets.
+        np.diff(times).mean()
+        sizes.mean()
+    else:
+        analyze.analyze_capture(path, member)
+    return time.perf_counter() - started
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("archive", nargs="?", default=ARCHIVE, help="zip archive holding the capture")
+    parser.add_argument("--member", help="capture inside the archive, its first .pcap by default")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each variant, the best one is reported")
+    parser.add_argument("--variant", choices=VARIANTS, help=argparse.SUPPRESS)
+    parser.add_argument("--path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        # Child process: run once, report the time and the peak resident memory.
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        seconds = run_variant(args.variant, args.path, args.member)
+        print(seconds, baseline, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        sys.exit(0)
+
+    with pcap.open_capture(args.archive, args.member) as capture:
+        member = capture.member
+    directory = tempfile.mkdtemp(prefix="chat-analysis-")
+    try:
+        with zipfile.ZipFile(args.archive) as archive, open(os.path.join(directory, "capture.pcap"), "wb") as extracted:
+            with archive.open(member) as source:
+                shutil.copyfileobj(source, extracted, pcap.READ_SIZE)
+        extracted_path = os.path.join(directory, "capture.pcap")
+        size = os.path.getsize(extracted_path)
+        print(f"{args.archive}:{member}, {size / 1e6:.1f} MB, best of {args.repeat}")
+        print(f"{'variant':>10} | {'seconds':>8} | {'MB/s':>7} | {'peak RSS MB':>11} | {'over imports MB':>15}")
+        for variant in VARIANTS:
+            path = extracted_path if variant == "mmap" else args.archive
+            runs = []
+            for _ in range(args.repeat):
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), "--variant", variant, "--path", path]
+                                        + (["--member", member] if variant != "mmap" else []),
+                                        capture_output=True, text=True, check=True).stdout.split()
+                runs.append(tuple(float(value) for value in output))
+            seconds = min(run[0] for run in runs)
+            baseline, peak = max(run[1] for run in runs), max(run[2] for run in runs)
+            # ru_maxrss is in KiB on Linux.
+            print(f"{variant:>10} | {seconds:>8.3f} | {size / seconds / 1e6:>7.1f} | {peak / 1024:>11.1f} | {(peak - baseline) / 1024:>15.1f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,135 @@
+import collections
+import os
+import re
+import zlib
+import protocol
+from streams import Handler, CLIENT, SERVER
+
+# Decodes the chat server's traffic out of reassembled TCP streams into one timeline per session.
+# Two wire formats are recognised by the first bytes of a session: the framed protocol (protocol.py), and the plain
+# text one it replaced, where every send() was a message of its own, taken here as one message per segment.
+
+CHAT_PORT = int(os.getenv("SERVER_PORT", 10000))
+FRAMED = "framed"
+TEXT = "text"
+
+ROOM_ID = re.compile(r"(?:Joined chat room|New chat room) (\d+)")
+TYPE_NAMES = {protocol.CHAT: "chat", protocol.JOIN: "join", protocol.LIST_ROOMS: "list_rooms", protocol.SYSTEM: "system",
+              protocol.BROADCAST: "broadcast", protocol.BUSY: "busy", protocol.PING: "ping", protocol.PONG: "pong",
+              protocol.OPTIONS: "options", protocol.RESUME: "resume", protocol.ROOM_UPDATE: "room_update"}
+
+# direction is streams.CLIENT or streams.SERVER, the sender; msg_type is None in the text format.
+Message = collections.namedtuple("Message", ["timestamp", "direction", "msg_type", "text"])
+
+class ChatSession:
+    """
+    The decoded messages of one connection to the chat server.
+    """
+    def __init__(self, connection):
+        self.client = connection.client
+        self.server = connection.server
+        self.started_at = connection.started_at
+        self.format = None
+        self.name = None
+        self.room_id = None
+        self.messages = []
+        self.bytes = [0, 0]
+        self.gaps = 0
+        # Why a direction could not be decoded past some point, None while it decodes.
+        self.errors = [None, None]
+        self._parsers = (protocol.FrameParser(), protocol.FrameParser())
+        self._inflaters = (protocol.Inflater(), protocol.Inflater())
+
+    @property
+    def ended_at(self) -> float:
+        return self.messages[-1].timestamp if self.messages else self.started_at
+
+    def feed(self, direction: int, timestamp: float, data: memoryview):
+        self.bytes[direction] += len(data)
+        if self.errors[direction] is not None:
+            return
+        if self.format is None:
+            self.format = FRAMED if len(data) >= 2 and data[0] == protocol.PROTOCOL_VERSION and data[1] in protocol.MESSAGE_TYPES else TEXT
+        if self.format == TEXT:
+            self._add(timestamp, direction, None, protocol.decode_text(data))
+            return
+        parser = self._parsers[direction]
+        parser.append(data)
+        try:
+            for msg_type, flags, payload in parser.frames():
+                try:
+                    payload = self._inflaters[direction].decompress(payload, flags)
+                except zlib.error as e:
+                    raise protocol.ProtocolError(f"Bad compressed payload: {e}") from None
+                self._add(timestamp, direction, msg_type, protocol.decode_text(payload))
+        except protocol.ProtocolError as e:
+            self.errors[direction] = str(e)
+
+    def lost(self, direction: int, missing: int):
+        """
+        Bytes of a direction were not captured: frames cannot be found again after that, text messages can.
+        """
+        self.gaps += 1
+        if self.format == FRAMED and self.errors[direction] is None:
+            self.errors[direction] = f"{missing} bytes missing from the capture"
+
+    def _add(self, timestamp: float, direction: int, msg_type: int, text: str):
+        if direction == CLIENT and self.name is None and msg_type in (None, protocol.CHAT):
+            self.name = text.strip()
+        elif direction == SERVER and self.room_id is None:
+            match = ROOM_ID.search(text)
+            if match:
+                self.room_id = int(match.group(1))
+        self.messages.append(Message(timestamp, direction, msg_type, text))
+
+    def timeline(self) -> list:
+        """
+        returns:
+            list: One printable line per message in time order, with its time relative to the start of the session.
+        """
+        lines = []
+        # The directions are decoded apart, and a segment that waited for a hole that was never filled keeps its own time.
+        for message in sorted(self.messages, key=lambda message: message.timestamp):
+            sender = (self.name or "client") if message.direction == CLIENT else "server"
+            kind = "" if message.msg_type is None else f" {TYPE_NAMES.get(message.msg_type, message.msg_type)}"
+            text = message.text.replace("\n", " | ").rstrip(" |")
+            lines.append(f"{message.timestamp - self.started_at:>10.3f}s {sender}{kind}: {text}")
+        return lines
+
+class ChatDecoder(Handler):
+    """
+    Reassembler handler that decodes the connections to the chat port. Each session is handed to on_session once its
+    connection closes, and forgotten unless keep is set.
+    """
+    def __init__(self, port: int = CHAT_PORT, on_session=None, keep: bool = True):
+        self.port = port
+        self.on_session = on_session
+        self.keep = keep
+        self.sessions = []
+        self.messages = 0
+
+    def opened(self, connection):
+        if connection.server[1] == self.port:
+            connection.state = ChatSession(connection)
+
+    def data(self, connection, direction: int, timestamp: float, data: memoryview):
+        if connection.state is not None:
+            before = len(connection.state.messages)
+            connection.state.feed(direction, timestamp, data)
+            self.messages += len(connection.state.messages) - before
+
+    def gap(self, connection, direction: int, missing: int):
+        if connection.state is not None:
+            connection.state.lost(direction, missing)
+
+    def closed(self, connection):
+        session = connection.state
+        if session is None:
+            return
+        if self.on_session is not None:
+            self.on_session(session)
+        if self.keep:
+            self.sessions.append(session)
+
+if __name__ == "__main__":
+    pass
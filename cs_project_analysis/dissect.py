@@ -0,0 +1,105 @@
+import collections
+import socket
+import struct
+
+# Link layer -> IP -> TCP/UDP decoding of captured packets, over memoryviews without copying the payloads.
+# Only the first fragment of a fragmented IPv4 datagram is decoded, and IPv6 extension headers are not walked.
+
+# Link types, see https://www.tcpdump.org/linktypes.html
+LINKTYPE_NULL = 0          # BSD loopback, a 4 byte address family in host byte order
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101         # a bare IP packet
+LINKTYPE_LOOP = 108        # OpenBSD loopback, the address family in network byte order
+LINKTYPE_LINUX_SLL = 113   # Linux "any" device, cooked header v1
+LINKTYPE_LINUX_SLL2 = 276  # cooked header v2
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = (0x8100, 0x88A8)
+
+TCP = 6
+UDP = 17
+
+# TCP flags
+FIN = 0x01
+SYN = 0x02
+RST = 0x04
+PSH = 0x08
+ACK = 0x10
+
+IPV4 = struct.Struct("!BBHHHBBH4s4s")
+IPV6 = struct.Struct("!IHBB16s16s")
+TCP_HEADER = struct.Struct("!HHIIBB")
+UDP_HEADER = struct.Struct("!HHH")
+
+# src and dst are packed addresses, see address(); payload is a memoryview of the packet.
+Segment = collections.namedtuple("Segment", ["protocol", "src", "sport", "dst", "dport", "seq", "flags", "payload"])
+
+def network_layer(link_type: int, data: memoryview):
+    """
+    returns:
+        memoryview: The IP packet carried by the frame, None if it is not an IP packet.
+    """
+    if link_type in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        packet = data[4:]
+    elif link_type == LINKTYPE_ETHERNET:
+        offset = 12
+        ethertype = struct.unpack_from("!H", data, offset)[0] if len(data) >= 14 else 0
+        while ethertype in ETHERTYPE_VLAN and len(data) >= offset + 8:
+            offset += 4
+            ethertype = struct.unpack_from("!H", data, offset)[0]
+        if ethertype not in (ETHERTYPE_IPV4, ETHERTYPE_IPV6):
+            return None
+        packet = data[offset + 2:]
+    elif link_type == LINKTYPE_RAW:
+        packet = data
+    elif link_type == LINKTYPE_LINUX_SLL:
+        packet = data[16:]
+    elif link_type == LINKTYPE_LINUX_SLL2:
+        packet = data[20:]
+    else:
+        return None
+    # The family / protocol fields of the loopback and cooked headers differ between systems, the IP version does not.
+    return packet if len(packet) >= 20 and packet[0] >> 4 in (4, 6) else None
+
+def dissect(link_type: int, data: memoryview):
+    """
+    Decode a captured frame down to its transport layer.
+    args:
+        link_type (int): The capture's link type.
+        data (memoryview): The captured bytes.
+    returns:
+        Segment: The TCP or UDP segment, seq and flags are 0 for UDP. None for anything else, or a truncated packet.
+    """
+    packet = network_layer(link_type, data)
+    if packet is None:
+        return None
+    if packet[0] >> 4 == 4:
+        version_ihl, _, total_length, _, fragment, _, protocol, _, src, dst = IPV4.unpack_from(packet)
+        if fragment & 0x1FFF:
+            return None  # not the first fragment, no transport header
+        header_length = (version_ihl & 0x0F) * 4
+        # Ethernet pads short frames, the IP length says where the packet ends.
+        transport = packet[header_length:total_length] if total_length else packet[header_length:]
+    else:
+        if len(packet) < IPV6.size:
+            return None
+        _, payload_length, protocol, _, src, dst = IPV6.unpack_from(packet)
+        transport = packet[IPV6.size:IPV6.size + payload_length] if payload_length else packet[IPV6.size:]
+    if protocol == TCP and len(transport) >= 20:
+        sport, dport, seq, _, data_offset, flags = TCP_HEADER.unpack_from(transport)
+        return Segment(TCP, src, sport, dst, dport, seq, flags, transport[(data_offset >> 4) * 4:])
+    if protocol == UDP and len(transport) >= 8:
+        sport, dport, length = UDP_HEADER.unpack_from(transport)
+        return Segment(UDP, src, sport, dst, dport, 0, 0, transport[8:length] if length >= 8 else transport[8:])
+    return None
+
+def address(packed: bytes) -> str:
+    """
+    returns:
+        str: The printable form of a packed IPv4 or IPv6 address.
+    """
+    return socket.inet_ntop(socket.AF_INET if len(packed) == 4 else socket.AF_INET6, packed)
+
+if __name__ == "__main__":
+    pass
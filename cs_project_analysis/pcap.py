@@ -0,0 +1,208 @@
+import mmap
+import os
+import struct
+import zipfile
+
+# Reader of classic pcap captures, from a file or from a member of a zip archive, in constant memory.
+# A file, and a zip member stored without compression, are memory mapped: records are parsed in place and the pages
+# behind the cursor are dropped as it moves on. A compressed member is inflated in READ_SIZE chunks into a small
+# sliding buffer. Either way a packet's data is a memoryview that is only valid until the next packet is requested.
+
+GLOBAL_HEADER_SIZE = 24
+RECORD_SIZE = 16
+# Magic number -> seconds per timestamp fraction unit, as read in either byte order.
+MAGICS = {0xa1b2c3d4: 1e-6, 0xa1b23c4d: 1e-9}
+READ_SIZE = int(os.getenv("PCAP_READ_SIZE", 1024 * 1024))
+# Mapped pages already parsed are given back every WINDOW_SIZE bytes, so the resident size of a mapping stays bounded.
+WINDOW_SIZE = int(os.getenv("PCAP_WINDOW_SIZE", 16 * 1024 * 1024))
+
+class CaptureError(Exception):
+    pass
+
+class Capture:
+    """
+    An open capture. Use it as a context manager, and iterate packets() once.
+    """
+    def __init__(self, path: str, member: str = None):
+        """
+        args:
+            path (str): A pcap file, or a zip archive holding one.
+            member (str): The capture inside the archive, by default its first .pcap member.
+        raises:
+            CaptureError: If the file is not a pcap capture, or the archive holds none.
+        """
+        self.path = path
+        self.member = None
+        self._file = None
+        self._map = None
+        self._stream = None
+        # Byte range of the capture inside the mapping.
+        self._start = 0
+        self._end = 0
+        if zipfile.is_zipfile(path):
+            self._open_member(member)
+        else:
+            self._file = open(path, "rb")
+            self._map_range(0, os.fstat(self._file.fileno()).st_size)
+        self.mapped = self._map is not None
+        header = self._read_header()
+        if len(header) < GLOBAL_HEADER_SIZE:
+            self.close()
+            raise CaptureError(f"{self.name} is too short for a pcap capture")
+        for order in "<>":
+            magic, major, minor, _, _, snaplen, link_type = struct.unpack(f"{order}IHHiIII", header)
+            if magic in MAGICS:
+                break
+        else:
+            self.close()
+            raise CaptureError(f"{self.name} is not a pcap capture (pcapng is not supported)")
+        self.record = struct.Struct(f"{order}IIII")
+        self.resolution = MAGICS[magic]
+        self.version = (major, minor)
+        self.snaplen = snaplen
+        self.link_type = link_type
+        self.packets_read = 0
+        self.bytes_read = GLOBAL_HEADER_SIZE
+
+    @property
+    def name(self) -> str:
+        return f"{self.path}:{self.member}" if self.member else self.path
+
+    def _open_member(self, member: str):
+        archive = zipfile.ZipFile(self.path)
+        try:
+            names = [info.filename for info in archive.infolist() if not info.is_dir()]
+            if member is None:
+                member = next((name for name in names if name.lower().endswith((".pcap", ".cap"))), None)
+                if member is None:
+                    raise CaptureError(f"{self.path} holds no .pcap capture: {', '.join(names)}")
+            try:
+                info = archive.getinfo(member)
+            except KeyError:
+                raise CaptureError(f"{self.path} has no member {member}") from None
+            self.member = member
+            if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+                # Stored as is: map the archive and read the member's bytes in place.
+                self._file = open(self.path, "rb")
+                self._file.seek(info.header_offset)
+                local_header = self._file.read(30)
+                name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+                start = info.header_offset + 30 + name_length + extra_length
+                archive.close()
+                self._map_range(start, start + info.file_size)
+            else:
+                self._stream = archive.open(info)
+                self._archive = archive
+        except BaseException:
+            archive.close()
+            raise
+
+    def _map_range(self, start: int, end: int):
+        if end <= start:
+            raise CaptureError(f"{self.name} is empty")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(self._map, "madvise"):
+            self._map.madvise(mmap.MADV_SEQUENTIAL)
+        self._start, self._end = start, end
+
+    def _read_header(self) -> bytes:
+        if self._map is not None:
+            header = self._map[self._start:self._start + GLOBAL_HEADER_SIZE]
+            self._start += len(header)
+            return header
+        return self._stream.read(GLOBAL_HEADER_SIZE)
+
+    def packets(self):
+        """
+        yields:
+            tuple: (timestamp, original length, data) of each packet. data is a memoryview of the captured bytes,
+            only valid until the next packet is requested: copy what has to be kept.
+        raises:
+            CaptureError: If a record is truncated or larger than the capture's snapshot length allows.
+        """
+        if self._map is not None:
+            yield from self._mapped_packets()
+        else:
+            yield from self._streamed_packets()
+
+    def _mapped_packets(self):
+        view = memoryview(self._map)
+        try:
+            offset = yield from self._parse(view, self._start, self._end)
+        finally:
+            view.release()
+        if offset != self._end:
+            raise CaptureError(f"{self.name} ends inside a record, {self._end - offset} bytes left")
+
+    def _parse(self, view: memoryview, offset: int, end: int):
+        """
+        Parse the complete records of view[offset:end].
+        returns:
+            int: The offset of the first incomplete record.
+        """
+        unpack = self.record.unpack_from
+        resolution = self.resolution
+        limit = max(self.snaplen, 65535) + RECORD_SIZE
+        released = offset - offset % mmap.PAGESIZE
+        mapped = self._map is not None and hasattr(self._map, "madvise")
+        while end - offset >= RECORD_SIZE:
+            seconds, fraction, captured, length = unpack(view, offset)
+            if captured > limit:
+                raise CaptureError(f"{self.name}: record of {captured} bytes at offset {offset}, the capture is corrupt")
+            data_end = offset + RECORD_SIZE + captured
+            if data_end > end:
+                break
+            data = view[offset + RECORD_SIZE:data_end]
+            offset = data_end
+            self.packets_read += 1
+            self.bytes_read += RECORD_SIZE + captured
+            yield seconds + fraction * resolution, length, data
+            data.release()
+            if mapped and offset - released >= WINDOW_SIZE:
+                done = offset - offset % mmap.PAGESIZE
+                self._map.madvise(mmap.MADV_DONTNEED, released, done - released)
+                released = done
+        return offset
+
+    def _streamed_packets(self):
+        pending = b""
+        while True:
+            chunk = self._stream.read(READ_SIZE)
+            if not chunk:
+                break
+            # A new buffer for every chunk, the caller may still hold a view of the last packet of the previous one.
+            pending += chunk
+            view = memoryview(pending)
+            try:
+                offset = yield from self._parse(view, 0, len(pending))
+            finally:
+                view.release()
+            pending = pending[offset:]
+        if pending:
+            raise CaptureError(f"{self.name} ends inside a record, {len(pending)} bytes left")
+
+    def close(self):
+        for resource in (self._stream, getattr(self, "_archive", None), self._map, self._file):
+            if resource is not None:
+                resource.close()
+        self._stream = self._map = self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def open_capture(path: str, member: str = None) -> Capture:
+    """
+    Open a pcap capture, see Capture.
+    args:
+        path (str): A pcap file, or a zip archive holding one.
+        member (str): The capture inside the archive, by default its first .pcap member.
+    returns:
+        Capture: The open capture.
+    """
+    return Capture(path, member)
+
+if __name__ == "__main__":
+    pass
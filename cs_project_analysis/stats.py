@@ -0,0 +1,180 @@
+import csv
+import os
+import numpy as np
+
+# Grouped statistics of event streams (packets, chat messages, dataset rows) computed with NumPy in constant memory:
+# the events are gathered CHUNK_SIZE at a time, and each chunk is sorted by group and reduced in a few vectorized passes
+# into running totals per group. The totals are sums, so the means and deviations are exact, not sampled.
+
+CHUNK_SIZE = int(os.getenv("STATS_CHUNK_SIZE", 65536))
+
+# Columns of the running totals of a group.
+COUNT, BYTES, FIRST, LAST, SIZE_MIN, SIZE_MAX, SIZE_SQUARES, GAPS, GAP_SUM, GAP_SQUARES, GAP_MAX = range(11)
+COLUMNS = 11
+
+class GroupStats:
+    """
+    Per group counts, sizes, inter-arrival times and throughput of (group, timestamp, size) events.
+    The events of a group must come in time order across chunks, within a chunk any order will do.
+    """
+    def __init__(self, chunk_size: int = CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._groups = []
+        self._times = []
+        self._sizes = []
+        # group -> numpy row of the columns above.
+        self.totals = {}
+
+    def add(self, group: int, timestamp: float, size: int):
+        self._groups.append(group)
+        self._times.append(timestamp)
+        self._sizes.append(size)
+        if len(self._groups) >= self.chunk_size:
+            self.flush()
+
+    def add_many(self, groups, times, sizes):
+        """
+        Add a batch of events given as arrays.
+        """
+        self.flush()
+        self._reduce(np.asarray(groups, dtype=np.int64), np.asarray(times, dtype=np.float64), np.asarray(sizes, dtype=np.int64))
+
+    def flush(self):
+        """
+        Reduce the gathered events into the totals.
+        """
+        if self._groups:
+            groups = np.fromiter(self._groups, dtype=np.int64, count=len(self._groups))
+            times = np.fromiter(self._times, dtype=np.float64, count=len(self._times))
+            sizes = np.fromiter(self._sizes, dtype=np.int64, count=len(self._sizes))
+            self._groups, self._times, self._sizes = [], [], []
+            self._reduce(groups, times, sizes)
+
+    def _reduce(self, groups: np.ndarray, times: np.ndarray, sizes: np.ndarray):
+        if not len(groups):
+            return
+        order = np.lexsort((times, groups))
+        groups, times, sizes = groups[order], times[order], sizes[order].astype(np.float64)
+        keys, starts, counts = np.unique(groups, return_index=True, return_counts=True)
+        # The gap after each event to the next one of its group, 0 after the last one of a group.
+        gaps = np.zeros(len(times))
+        gaps[:-1] = np.where(groups[1:] == groups[:-1], np.diff(times), 0.0)
+        rows = np.empty((len(keys), COLUMNS))
+        rows[:, COUNT] = counts
+        rows[:, BYTES] = np.add.reduceat(sizes, starts)
+        rows[:, FIRST] = times[starts]
+        rows[:, LAST] = times[starts + counts - 1]
+        rows[:, SIZE_MIN] = np.minimum.reduceat(sizes, starts)
+        rows[:, SIZE_MAX] = np.maximum.reduceat(sizes, starts)
+        rows[:, SIZE_SQUARES] = np.add.reduceat(sizes * sizes, starts)
+        rows[:, GAPS] = counts - 1
+        rows[:, GAP_SUM] = np.add.reduceat(gaps, starts)
+        rows[:, GAP_SQUARES] = np.add.reduceat(gaps * gaps, starts)
+        rows[:, GAP_MAX] = np.maximum.reduceat(gaps, starts)
+        for key, row in zip(keys.tolist(), rows):
+            total = self.totals.get(key)
+            if total is None:
+                self.totals[key] = row
+                continue
+            # The gap from the group's last event in the earlier chunks to its first one here.
+            gap = max(0.0, row[FIRST] - total[LAST])
+            total[[COUNT, BYTES, SIZE_SQUARES, GAPS, GAP_SUM, GAP_SQUARES]] += row[[COUNT, BYTES, SIZE_SQUARES, GAPS, GAP_SUM, GAP_SQUARES]]
+            total[GAPS] += 1
+            total[GAP_SUM] += gap
+            total[GAP_SQUARES] += gap * gap
+            total[GAP_MAX] = max(total[GAP_MAX], row[GAP_MAX], gap)
+            total[SIZE_MIN] = min(total[SIZE_MIN], row[SIZE_MIN])
+            total[SIZE_MAX] = max(total[SIZE_MAX], row[SIZE_MAX])
+            total[FIRST] = min(total[FIRST], row[FIRST])
+            total[LAST] = max(total[LAST], row[LAST])
+
+    def summary(self) -> dict:
+        """
+        returns:
+            dict: Column name -> numpy array with one value per group, the groups in the "group" column, by descending bytes.
+        """
+        self.flush()
+        if not self.totals:
+            return {"group": np.empty(0, dtype=np.int64)}
+        keys = np.fromiter(self.totals, dtype=np.int64, count=len(self.totals))
+        totals = np.vstack(list(self.totals.values()))
+        order = np.argsort(-totals[:, BYTES], kind="stable")
+        keys, totals = keys[order], totals[order]
+        count, size = totals[:, COUNT], totals[:, BYTES]
+        duration = totals[:, LAST] - totals[:, FIRST]
+        gaps = np.maximum(totals[:, GAPS], 1)
+        mean_size = size / count
+        mean_gap = totals[:, GAP_SUM] / gaps
+        with np.errstate(divide="ignore", invalid="ignore"):
+            throughput = np.where(duration > 0, size / duration, 0.0)
+        return {
+            "group": keys,
+            "count": count.astype(np.int64),
+            "bytes": size.astype(np.int64),
+            "duration": duration,
+            "throughput": throughput,
+            "size_mean": mean_size,
+            "size_std": np.sqrt(np.maximum(totals[:, SIZE_SQUARES] / count - mean_size ** 2, 0.0)),
+            "size_min": totals[:, SIZE_MIN],
+            "size_max": totals[:, SIZE_MAX],
+            "gap_mean": mean_gap,
+            "gap_std": np.sqrt(np.maximum(totals[:, GAP_SQUARES] / gaps - mean_gap ** 2, 0.0)),
+            "gap_max": totals[:, GAP_MAX],
+        }
+
+def service_port(src_port, dst_port):
+    """
+    The port that names a conversation's service: the lower of the two, servers listen on the low ports.
+    Works on numbers and on numpy arrays.
+    """
+    return np.minimum(src_port, dst_port)
+
+class DatasetStats:
+    """
+    Statistics of a network dataset CSV with app_protocol, src_port, dst_port, message and timestamp columns:
+    per application protocol and per service port. Message sizes are their UTF-8 byte lengths.
+    """
+    def __init__(self, chunk_size: int = CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.by_protocol = GroupStats(chunk_size)
+        self.by_port = GroupStats(chunk_size)
+        # Protocol name -> group id, in order of appearance.
+        self.protocols = {}
+        self.rows = 0
+
+    def read(self, path: str):
+        """
+        Read the CSV in chunks of rows.
+        raises:
+            ValueError: If a column is missing or a value does not parse.
+        """
+        with open(path, newline="", encoding="utf-8") as csv_file:
+            reader = csv.DictReader(csv_file)
+            missing = {"app_protocol", "src_port", "dst_port", "message", "timestamp"} - set(reader.fieldnames or ())
+            if missing:
+                raise ValueError(f"{path} has no {', '.join(sorted(missing))} column")
+            rows = []
+            for row in reader:
+                rows.append(row)
+                if len(rows) >= self.chunk_size:
+                    self._add(rows)
+                    rows = []
+            self._add(rows)
+
+    def _add(self, rows: list):
+        if not rows:
+            return
+        protocols = [self.protocols.setdefault(row["app_protocol"], len(self.protocols)) for row in rows]
+        src = np.array([int(row["src_port"]) for row in rows])
+        dst = np.array([int(row["dst_port"]) for row in rows])
+        times = np.array([float(row["timestamp"]) for row in rows])
+        sizes = np.array([len(row["message"].encode("utf-8")) for row in rows])
+        self.by_protocol.add_many(protocols, times, sizes)
+        self.by_port.add_many(service_port(src, dst), times, sizes)
+        self.rows += len(rows)
+
+    def protocol_names(self) -> dict:
+        return {group: name for name, group in self.protocols.items()}
+
+if __name__ == "__main__":
+    pass
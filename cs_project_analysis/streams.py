@@ -0,0 +1,225 @@
+import os
+from dissect import FIN, SYN, RST, ACK
+
+# TCP stream reassembly. Each connection is two streams, one per direction, handed to a handler in sequence order
+# as the segments arrive. Retransmitted bytes are dropped, and segments that arrive early wait until the hole before
+# them is filled, up to MAX_BUFFERED bytes per stream; past that the hole is reported as a gap and skipped.
+# Connections are forgotten once closed by FIN or RST, or after IDLE_TIMEOUT seconds of capture time without a segment,
+# so the memory used depends on the connections open at once, not on the length of the capture.
+
+MAX_BUFFERED = int(os.getenv("REASSEMBLY_MAX_BUFFERED", 1024 * 1024))
+IDLE_TIMEOUT = float(os.getenv("REASSEMBLY_IDLE_TIMEOUT", 600))
+SEQ_MASK = 0xFFFFFFFF
+HALF_SEQ = 0x80000000
+# Capture seconds between sweeps for idle connections.
+SWEEP_INTERVAL = 10.0
+
+CLIENT = 0  # the direction from the client to the server
+SERVER = 1  # the direction from the server to the client
+
+class Handler:
+    """
+    What the reassembler reports. Subclass it and override what is needed.
+    """
+    def opened(self, connection):
+        """A connection was seen for the first time."""
+
+    def data(self, connection, direction: int, timestamp: float, data: memoryview):
+        """
+        In order bytes of one direction, one segment's worth. data is only valid during the call.
+        """
+
+    def gap(self, connection, direction: int, missing: int):
+        """
+        missing bytes of one direction were never captured, the data that follows comes after them.
+        """
+
+    def closed(self, connection):
+        """The connection closed or went idle, nothing more is reported for it."""
+
+class Stream:
+    """
+    One direction of a connection.
+    """
+    def __init__(self):
+        # The sequence number of the next byte to deliver, None until the first SYN or data segment.
+        self.next_seq = None
+        # Sequence number -> (timestamp, bytes) of the segments that arrived ahead of next_seq.
+        self.early = {}
+        self.buffered = 0
+        self.bytes = 0
+        self.segments = 0
+        self.retransmitted = 0
+        self.missing = 0
+        self.fin = False
+
+class Connection:
+    """
+    A TCP connection, client and server are told apart by who sent the SYN, by the lower port without one.
+    """
+    def __init__(self, key: tuple, client: tuple, server: tuple, timestamp: float):
+        self.key = key
+        self.client = client
+        self.server = server
+        self.started_at = timestamp
+        self.last_seen = timestamp
+        self.streams = (Stream(), Stream())
+        self.reset = False
+        # For the handler's own state.
+        self.state = None
+
+    def direction(self, src: tuple) -> int:
+        return CLIENT if src == self.client else SERVER
+
+    @property
+    def done(self) -> bool:
+        return self.reset or (self.streams[CLIENT].fin and self.streams[SERVER].fin)
+
+class Reassembler:
+    def __init__(self, handler: Handler, max_buffered: int = MAX_BUFFERED, idle_timeout: float = IDLE_TIMEOUT):
+        self.handler = handler
+        self.max_buffered = max_buffered
+        self.idle_timeout = idle_timeout
+        self.connections = {}
+        self.next_sweep = None
+        self.opened = 0
+        self.gaps = 0
+
+    def add(self, timestamp: float, segment):
+        """
+        Take a TCP segment.
+        args:
+            timestamp (float): The capture time of its packet.
+            segment (Segment): The segment, see dissect.dissect().
+        """
+        src = (segment.src, segment.sport)
+        dst = (segment.dst, segment.dport)
+        key = (src, dst) if src < dst else (dst, src)
+        connection = self.connections.get(key)
+        flags = segment.flags
+        syn = flags & SYN and not flags & ACK
+        if connection is not None and syn:
+            next_seq = connection.streams[connection.direction(src)].next_seq
+            if next_seq is not None and next_seq != (segment.seq + 1) & SEQ_MASK:
+                self._close(connection)  # the ports were reused by a new connection
+                connection = None
+        if connection is None:
+            if flags & RST:
+                return
+            if syn:
+                client, server = src, dst
+            else:
+                client, server = (src, dst) if segment.sport > segment.dport else (dst, src)
+            connection = self.connections[key] = Connection(key, client, server, timestamp)
+            self.opened += 1
+            self.handler.opened(connection)
+        connection.last_seen = timestamp
+        direction = connection.direction(src)
+        stream = connection.streams[direction]
+        stream.segments += 1
+        seq = segment.seq
+        if flags & SYN:
+            seq = (seq + 1) & SEQ_MASK
+            if stream.next_seq is None:
+                stream.next_seq = seq
+        payload = segment.payload
+        if payload:
+            if stream.next_seq is None:
+                stream.next_seq = seq  # joined after the handshake
+            self._receive(connection, direction, stream, timestamp, seq, payload)
+        if flags & FIN:
+            stream.fin = True
+        if flags & RST:
+            connection.reset = True
+        if connection.done:
+            self._close(connection)
+        if self.next_sweep is None:
+            self.next_sweep = timestamp + SWEEP_INTERVAL
+        elif timestamp >= self.next_sweep:
+            self.next_sweep = timestamp + SWEEP_INTERVAL
+            self.sweep(timestamp)
+
+    def _receive(self, connection: Connection, direction: int, stream: Stream, timestamp: float, seq: int, payload):
+        ahead = (seq - stream.next_seq) & SEQ_MASK
+        if ahead >= HALF_SEQ:
+            # Starts before next_seq: a retransmission, maybe carrying some new bytes at its end.
+            overlap = (stream.next_seq - seq) & SEQ_MASK
+            if overlap >= len(payload):
+                stream.retransmitted += 1
+                return
+            payload = payload[overlap:]
+            ahead = 0
+        if ahead:
+            previous = stream.early.get(seq)
+            if previous is None or len(previous[1]) < len(payload):
+                stream.buffered += len(payload) - (len(previous[1]) if previous else 0)
+                stream.early[seq] = (timestamp, bytes(payload))
+            if stream.buffered > self.max_buffered:
+                self._skip_hole(connection, direction, stream)
+            return
+        self._deliver(connection, direction, stream, timestamp, payload)
+        self._drain(connection, direction, stream, timestamp)
+
+    def _deliver(self, connection: Connection, direction: int, stream: Stream, timestamp: float, payload):
+        stream.next_seq = (stream.next_seq + len(payload)) & SEQ_MASK
+        stream.bytes += len(payload)
+        self.handler.data(connection, direction, timestamp, payload)
+
+    def _drain(self, connection: Connection, direction: int, stream: Stream, filled_at: float = None):
+        """
+        Deliver the early segments that the last delivery made contiguous.
+        args:
+            filled_at (float): When the hole before them was filled, the time they became readable. None when the hole
+                was skipped, they are delivered with their own times then.
+        """
+        while stream.early:
+            # A segment starting at next_seq, or before it if it overlaps what was delivered.
+            seq = next((seq for seq in stream.early if (stream.next_seq - seq) & SEQ_MASK < HALF_SEQ), None)
+            if seq is None:
+                return
+            timestamp, payload = stream.early.pop(seq)
+            stream.buffered -= len(payload)
+            overlap = (stream.next_seq - seq) & SEQ_MASK
+            if overlap < len(payload):
+                if filled_at is not None:
+                    timestamp = max(timestamp, filled_at)
+                self._deliver(connection, direction, stream, timestamp, memoryview(payload)[overlap:])
+            else:
+                stream.retransmitted += 1
+
+    def _skip_hole(self, connection: Connection, direction: int, stream: Stream):
+        """
+        Give up on the bytes missing before the earliest buffered segment.
+        """
+        first = min(stream.early, key=lambda seq: (seq - stream.next_seq) & SEQ_MASK)
+        missing = (first - stream.next_seq) & SEQ_MASK
+        stream.missing += missing
+        stream.next_seq = first
+        self.gaps += 1
+        self.handler.gap(connection, direction, missing)
+        self._drain(connection, direction, stream)
+
+    def sweep(self, now: float):
+        """
+        Close the connections without a segment for idle_timeout seconds of capture time.
+        """
+        for connection in [connection for connection in self.connections.values() if now - connection.last_seen >= self.idle_timeout]:
+            self._close(connection)
+
+    def _close(self, connection: Connection):
+        # Whatever still waits behind a hole will not be completed any more.
+        for direction, stream in enumerate(connection.streams):
+            while stream.early:
+                self._skip_hole(connection, direction, stream)
+        del self.connections[connection.key]
+        self.handler.closed(connection)
+
+    def close_all(self):
+        """
+        End of the capture: close every connection still open.
+        """
+        for connection in list(self.connections.values()):
+            self._close(connection)
+
+if __name__ == "__main__":
+    pass
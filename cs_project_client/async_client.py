@@ -0,0 +1,465 @@
+"""
+Headless asyncio client for the chat server, usable without the Tk ClientGUI.
+
+    client = ChatClient("alice", room="new")
+    client.on("message", lambda message: print(message.text))
+    await client.connect()
+    await client.send("hello")
+    message = await client.receive()
+    await client.close()
+
+The client answers the server's pings and notices a dead connection on its own. When a connection drops it reconnects
+with exponential backoff and jitter. With a resumable session the server puts the client back in its room, and each
+side sends again what the other missed. If the session expired, the client goes through the handshake again and rejoins
+its room, asking for the history since its last message.
+"""
+import asyncio
+import collections
+import inspect
+import os
+import random
+import re
+import time
+import dotenv
+import protocol
+from utils import logger
+dotenv.load_dotenv()
+# Ask the server for deflate compression; messages under COMPRESSION_MIN_SIZE bytes are sent as they are.
+COMPRESSION = os.getenv("COMPRESSION", "none").lower() == "deflate"
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", 6))
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 256))
+# Reconnect delays grow exponentially from RECONNECT_MIN_DELAY up to RECONNECT_MAX_DELAY seconds. Each delay is drawn
+# at random below that bound, so clients dropped together do not all come back at once.
+RECONNECT_MIN_DELAY = float(os.getenv("RECONNECT_MIN_DELAY", 0.5))
+RECONNECT_MAX_DELAY = float(os.getenv("RECONNECT_MAX_DELAY", 30))
+# A connection silent for PING_INTERVAL seconds is pinged, and given up as dead if it stays silent for another interval.
+PING_INTERVAL = float(os.getenv("PING_INTERVAL", 15))
+# Bytes written to the server kept to be sent again after a resume, and received messages kept for receive().
+RESUME_BUFFER_BYTES = int(os.getenv("RESUME_BUFFER_BYTES", 256 * 1024))
+INBOX_SIZE = int(os.getenv("INBOX_SIZE", 10000))
+READ_SIZE = 64 * 1024
+
+ROOM_ID = re.compile(r"chat room (\d+)")
+RETRY_AFTER = re.compile(r"retry after (\d+) seconds")
+
+Message = collections.namedtuple("Message", ["msg_type", "text"])
+
+class ServerBusy(ConnectionError):
+    """
+    The server's admission control refused the connection.
+    """
+    def __init__(self, text: str):
+        super().__init__(text)
+        match = RETRY_AFTER.search(text)
+        self.retry_after = float(match.group(1)) if match else 0.0
+
+class ConnectionClosed(Exception):
+    """
+    The client was closed, or gave up reconnecting.
+    """
+
+class ChatClient:
+    """
+    One chat user. Frames are read by a background task that hands the messages to the "message" callbacks and to receive().
+    Events, with the arguments their callbacks get: "message" (Message), "connected" (whether the session was resumed),
+    "disconnected" (the reason) and "closed" (none). Callbacks can be plain functions or coroutine functions.
+    """
+    def __init__(self, name: str, room="new", host: str = None, port: int = None, compression: bool = COMPRESSION,
+                 resume: bool = True, max_attempts: int = None):
+        """
+        args:
+            name (str): The user name.
+            room (str | int): "new" to create a room, a room id to join, None to stay in the lobby.
+            host (str): The server host, defaults to the SERVER_HOST env parameter.
+            port (int): The server port, defaults to the SERVER_PORT env parameter.
+            compression (bool): Ask the server for deflate compression.
+            resume (bool): Ask the server for a resumable session.
+            max_attempts (int): Reconnect attempts after a drop before giving up, None for no limit.
+        """
+        self.host = host or os.getenv("SERVER_HOST", "127.0.0.1")
+        self.port = port or int(os.getenv("SERVER_PORT", 10000))
+        self.name = name
+        self.room = room
+        self.compression = compression
+        self.resume = resume
+        self.max_attempts = max_attempts
+        self.room_id = None
+        self.connected = False
+        self.closed = False
+        # Unix time of the last chat message received, the history replay after an expired session starts there.
+        self.last_message_at = None
+        self._reader = None
+        self._writer = None
+        self._parser = protocol.FrameParser()
+        # Frames read from the connection but not handled yet, and whether the connection was pinged for being silent.
+        self._frames = collections.deque()
+        self._pinged = False
+        self._inflater = protocol.Inflater()
+        self._compressing = False
+        # Session: its token and the bytes of the frames handled since the token frame, counted once the token came.
+        self.token = None
+        self.received = 0
+        self._counting = False
+        # The bytes written since the OPTIONS offer, while the session may need them again: the last frames and their total.
+        self._recording = False
+        self._sent = collections.deque()
+        self._sent_size = 0
+        self.sent = 0
+        # Frames sent while disconnected, written once connected again.
+        self._outbox = []
+        self._inbox = asyncio.Queue(INBOX_SIZE)
+        self._handlers = collections.defaultdict(list)
+        self._task = None
+
+    def on(self, event: str, callback):
+        """
+        Call callback on event, see the class docstring for the events.
+        """
+        self._handlers[event].append(callback)
+
+    async def _emit(self, event: str, *args):
+        for callback in self._handlers[event]:
+            try:
+                result = callback(*args)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                logger.error(f"The {event} callback {callback} failed: {e}")
+
+    async def connect(self):
+        """
+        Connect, go through the handshake and start reading in the background.
+        raises:
+            ServerBusy: If the server refused the connection, the exception says when to retry.
+            ConnectionError: If the server could not be reached or the room could not be joined.
+        """
+        await self._open(reconnect=False)
+        self._task = asyncio.create_task(self._run())
+
+    async def send(self, text: str):
+        """
+        Send a chat message, or a lobby input before joining a room. While reconnecting, the message waits in an outbox.
+        """
+        payload = text.encode("utf-8")
+        if self._compressing and len(payload) >= COMPRESSION_MIN_SIZE:
+            frame = protocol.encode_frame(protocol.CHAT, protocol.deflate(payload, COMPRESSION_LEVEL), protocol.FLAG_DEFLATE)
+        else:
+            frame = protocol.encode_frame(protocol.CHAT, payload)
+        if not self.connected or self._writer.is_closing():
+            self._outbox.append(frame)
+            return
+        self._write(frame)
+        try:
+            await self._writer.drain()
+        except ConnectionError:
+            pass  # the reader notices the drop, a resumed session sends the frame again
+
+    async def receive(self) -> Message:
+        """
+        returns:
+            Message: The next message from the server.
+        raises:
+            ConnectionClosed: Once the client is closed or gave up reconnecting.
+        """
+        message = await self._inbox.get()
+        if message is None:
+            self._inbox.put_nowait(None)  # for the next caller
+            raise ConnectionClosed()
+        return message
+
+    def __aiter__(self):
+        return self._messages()
+
+    async def _messages(self):
+        try:
+            while True:
+                yield await self.receive()
+        except ConnectionClosed:
+            return
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """
+        Leave for good: the server forgets the session instead of keeping it for a reconnect.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._writer is not None:
+            try:
+                if self.connected and self.token is not None:
+                    self._write(protocol.encode_frame(protocol.RESUME, "end"))
+                self._writer.close()
+                await self._writer.wait_closed()
+            except (OSError, ConnectionError):
+                pass
+        self.connected = False
+        self._finish()
+        await self._emit("closed")
+
+    def _finish(self):
+        if self._inbox.full():
+            self._inbox.get_nowait()
+        self._inbox.put_nowait(None)
+
+    def _write(self, frame: bytes):
+        self._writer.write(frame)
+        if self._recording:
+            self._sent.append(frame)
+            self._sent_size += len(frame)
+            self.sent += len(frame)
+            while self._sent and self._sent_size - len(self._sent[0]) >= RESUME_BUFFER_BYTES:
+                self._sent_size -= len(self._sent.popleft())
+
+    def _sent_since(self, offset: int):
+        """
+        returns:
+            list: The bytes written from offset on, None if they are no longer kept.
+        """
+        start = self.sent - self._sent_size
+        if not start <= offset <= self.sent:
+            return None
+        chunks = []
+        for frame in self._sent:
+            if offset < start + len(frame):
+                chunks.append(frame[offset - start:] if offset > start else frame)
+                offset = start + len(frame)
+            start += len(frame)
+        return chunks
+
+    async def _next_frame(self) -> tuple:
+        """
+        Read the next frame that is not connection housekeeping: pings are answered, and the OPTIONS answer and the
+        session token are taken in here.
+        returns:
+            tuple: (msg_type, text).
+        raises:
+            ConnectionError: If the connection closed or stopped answering.
+        """
+        while True:
+            while not self._frames:
+                try:
+                    data = await asyncio.wait_for(self._reader.read(READ_SIZE), PING_INTERVAL)
+                except asyncio.TimeoutError:
+                    if self._pinged:
+                        raise ConnectionError("The server stopped answering")
+                    self._pinged = True
+                    self._write(protocol.encode_frame(protocol.PING, b""))
+                    continue
+                if not data:
+                    raise ConnectionError("The server closed the connection")
+                self._pinged = False
+                self._frames.extend(self._parser.feed(data))
+            msg_type, flags, payload = self._frames.popleft()
+            # Counted once handled: the frames still queued when a connection drops are sent again after a resume.
+            if self._counting:
+                self.received += protocol.HEADER_SIZE + len(payload)
+            payload = self._inflater.decompress(payload, flags)
+            if msg_type == protocol.PING:
+                self._write(protocol.encode_frame(protocol.PONG, payload))
+            elif msg_type == protocol.OPTIONS:
+                accepted = payload.decode("utf-8").split()
+                self._compressing = "deflate" in accepted
+                if "resume" not in accepted:
+                    self._stop_recording()
+            elif msg_type == protocol.RESUME and payload.startswith(b"token "):
+                self.token = payload[len(b"token "):].decode("utf-8")
+                self.received = 0
+                self._counting = True
+            elif msg_type != protocol.PONG:
+                return msg_type, protocol.decode_text(payload)
+
+    def _stop_recording(self):
+        self._recording = False
+        self._sent.clear()
+        self._sent_size = 0
+        self.sent = 0
+
+    async def _deliver(self, message: Message):
+        if message.msg_type == protocol.RESUME:
+            return
+        if message.msg_type == protocol.CHAT:
+            self.last_message_at = time.time()
+        elif message.msg_type == protocol.JOIN:
+            match = ROOM_ID.search(message.text)
+            if match:
+                self.room_id = int(match.group(1))
+        if self._inbox.full():
+            self._inbox.get_nowait()  # nobody is reading them, keep the latest
+        self._inbox.put_nowait(message)
+        await self._emit("message", message)
+
+    async def _wait_for(self, *msg_types) -> tuple:
+        """
+        Deliver the frames that arrive until one of msg_types does.
+        returns:
+            tuple: (msg_type, text) of that frame.
+        """
+        while True:
+            msg_type, text = await self._next_frame()
+            if msg_type in msg_types:
+                return msg_type, text
+            await self._deliver(Message(msg_type, text))
+
+    async def _open(self, reconnect: bool = True):
+        """
+        Open a connection, and resume the session or go through the handshake on it.
+        args:
+            reconnect (bool): The client was connected before, it goes back to the room it was in instead of self.room.
+        """
+        self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), PING_INTERVAL)
+        self._parser = protocol.FrameParser()
+        self._frames.clear()
+        self._pinged = False
+        resumed = welcomed = False
+        if self.token is not None:
+            resumed, welcomed = await self._resume()
+        if not resumed:
+            await self._handshake(rejoin=reconnect, welcomed=welcomed)
+        self.connected = True
+        outbox, self._outbox = self._outbox, []
+        for frame in outbox:
+            self._write(frame)
+        await self._emit("connected", resumed)
+
+    async def _resume(self) -> tuple:
+        """
+        returns:
+            tuple: (resumed, welcomed), whether the server took the session back and whether its welcome was read already.
+        raises:
+            ServerBusy: If the server refused the connection.
+        """
+        # Not part of either stream, the counts carry on from where the dropped connection left them.
+        self._counting = False
+        self._writer.write(protocol.encode_frame(protocol.RESUME, f"{self.token} {self.received}"))
+        welcomed = False
+        while True:
+            msg_type, text = await self._wait_for(protocol.RESUME, protocol.BUSY, protocol.SYSTEM)
+            if msg_type == protocol.BUSY:
+                raise ServerBusy(text)
+            if msg_type == protocol.SYSTEM:
+                welcomed = True  # the new connection's welcome, written before the answer
+            elif text.startswith("resumed "):
+                break
+            elif text == "expired":
+                logger.info("The session of %s expired, joining again", self.name)
+                self.token = None
+                return False, welcomed
+        self._counting = True
+        server_received = int(text.split()[1])
+        chunks = self._sent_since(server_received)
+        if chunks is None:
+            logger.warning(f"Messages {self.name} sent before the drop are lost, they were no longer kept")
+            self._stop_recording()
+            self._recording = True
+            self.sent = server_received
+        else:
+            for chunk in chunks:
+                self._writer.write(chunk)
+        logger.info("%s resumed its session", self.name)
+        return True, welcomed
+
+    async def _handshake(self, rejoin: bool = False, welcomed: bool = False):
+        """
+        Name, then join or create the room.
+        args:
+            rejoin (bool): Join the room the client was in, with the history since its last message, or stay in the lobby
+                if it was not in one, instead of joining self.room.
+            welcomed (bool): The server's welcome was already read on this connection.
+        """
+        self.token = None
+        self._counting = False
+        self.received = 0
+        self._inflater = protocol.Inflater()
+        self._compressing = False
+        self._stop_recording()
+        offer = [extension for extension, wanted in (("deflate", self.compression), ("resume", self.resume)) if wanted]
+        if offer:
+            self._writer.write(protocol.encode_frame(protocol.OPTIONS, " ".join(offer)))
+            # The server counts the frames after the offer.
+            self._recording = self.resume
+        self._write(protocol.encode_frame(protocol.CHAT, self.name))
+        if not welcomed:
+            msg_type, text = await self._wait_for(protocol.SYSTEM, protocol.BUSY)
+            if msg_type == protocol.BUSY:
+                raise ServerBusy(text)
+        await self._wait_for(protocol.SYSTEM)  # the greeting with the room list
+        if rejoin:
+            if self.room_id is None:
+                return
+            room = f"{self.room_id} since {self.last_message_at}" if self.last_message_at is not None else str(self.room_id)
+        elif self.room is not None:
+            room = str(self.room)
+        else:
+            return
+        self.room_id = None
+        self._write(protocol.encode_frame(protocol.CHAT, room))
+        msg_type, text = await self._wait_for(protocol.JOIN, protocol.SYSTEM)
+        if msg_type == protocol.JOIN:
+            await self._deliver(Message(msg_type, text))
+            return
+        reason = text.partition("\n")[0]
+        if not rejoin:
+            raise ConnectionError(reason)
+        # The room closed or filled up meanwhile, the client stays in the lobby.
+        logger.warning(f"{self.name} could not rejoin its room: {reason}")
+        await self._deliver(Message(msg_type, text))
+
+    async def _run(self):
+        while True:
+            try:
+                while True:
+                    await self._deliver(Message(*await self._next_frame()))
+            except (OSError, EOFError, protocol.ProtocolError) as e:
+                reason = str(e) or type(e).__name__
+            await self._connection_lost(reason)
+            if not await self._reconnect():
+                break
+        self.closed = True
+        self._finish()
+        await self._emit("closed")
+
+    async def _connection_lost(self, reason: str):
+        self.connected = False
+        logger.info("Connection of %s lost: %s", self.name, reason)
+        self._writer.transport.abort()
+        # Frames read but not handled are sent again after a resume, a partial one as well.
+        self._frames.clear()
+        self._parser = protocol.FrameParser()
+        await self._emit("disconnected", reason)
+
+    async def _reconnect(self) -> bool:
+        """
+        returns:
+            bool: True once connected again, False after max_attempts failed attempts.
+        """
+        attempt = 0
+        retry_after = 0.0
+        while self.max_attempts is None or attempt < self.max_attempts:
+            delay = random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_MIN_DELAY * 2 ** attempt))
+            attempt += 1
+            await asyncio.sleep(max(delay, retry_after))
+            retry_after = 0.0
+            try:
+                await self._open()
+                return True
+            except ServerBusy as e:
+                retry_after = e.retry_after
+                self._writer.transport.abort()
+            except (OSError, EOFError, asyncio.TimeoutError, protocol.ProtocolError) as e:
+                logger.info("Reconnect attempt %d of %s failed: %s", attempt, self.name, e)
+                if self._writer is not None:
+                    self._writer.transport.abort()
+        return False
+
+if __name__ == "__main__":
+    pass
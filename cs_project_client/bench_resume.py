@@ -0,0 +1,155 @@
+"""
+Reconnect storm test of the resumable sessions.
+Starts the server as a subprocess, connects a swarm of async clients in rooms of two that chat continuously, numbering
+their messages, then drops every connection at once, a few times. Runs once with resumable sessions and once without,
+and reports how long the swarm took to be back, the server CPU time the storms cost, and the messages lost or
+duplicated. Without sessions the clients go through the handshake again and rejoin their rooms, if still open.
+
+usage: python bench_resume.py [--clients 200] [--rate 2] [--storms 2] [--interval 3]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import async_client
+import protocol
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cs_project_server", "socket_server.py")
+
+class SwarmMember:
+    def __init__(self, client: async_client.ChatClient):
+        self.client = client
+        self.sent = 0
+        # The next sequence number expected from the peer, and the delivery problems seen.
+        self.expected = 0
+        self.lost = 0
+        self.duplicated = 0
+        self.reconnected_at = None
+        client.on("message", self.on_message)
+        client.on("connected", self.on_connected)
+
+    def on_message(self, message: async_client.Message):
+        if message.msg_type != protocol.CHAT or "]: seq " not in message.text:
+            return
+        seq = int(message.text.rpartition(" ")[2])
+        if seq < self.expected:
+            self.duplicated += 1
+            return
+        self.lost += seq - self.expected
+        self.expected = seq + 1
+
+    def on_connected(self, resumed: bool):
+        self.reconnected_at = time.monotonic()
+
+def cpu_seconds(pid: int) -> float:
+    """User and system CPU time of a process, 0 where /proc is not available."""
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            fields = stat.read().rpartition(")")[2].split()
+    except OSError:
+        return 0.0
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+async def build_swarm(count: int, port: int, resume: bool) -> list:
+    members = []
+    for index in range(0, count - count % 2, 2):
+        creator = async_client.ChatClient(f"swarm{index}", room="new", port=port, resume=resume)
+        await creator.connect()
+        joiner = async_client.ChatClient(f"swarm{index + 1}", room=creator.room_id, port=port, resume=resume)
+        await joiner.connect()
+        members += [SwarmMember(creator), SwarmMember(joiner)]
+    return members
+
+async def chat(members: list, seconds: float, rate: float):
+    """Every member sends rate messages per second, spread over the swarm."""
+    interval = 1 / (rate * len(members))
+    deadline = time.monotonic() + seconds
+    turn = 0
+    while time.monotonic() < deadline:
+        member = members[turn % len(members)]
+        await member.client.send(f"seq {member.sent}")
+        member.sent += 1
+        turn += 1
+        await asyncio.sleep(interval)
+
+async def storm(members: list, rate: float, server_pid: int) -> tuple:
+    """
+    Drop every connection at once and keep chatting until all the clients are connected again.
+    returns:
+        tuple: (the reconnect times in seconds, the server CPU seconds spent meanwhile).
+    """
+    cpu = cpu_seconds(server_pid)
+    started = time.monotonic()
+    for member in members:
+        member.reconnected_at = None
+        member.client._writer.transport.abort()
+    while any(member.reconnected_at is None for member in members) and time.monotonic() - started < 60:
+        await chat(members, 0.1, rate)
+    times = [member.reconnected_at - started for member in members if member.reconnected_at is not None]
+    return times, cpu_seconds(server_pid) - cpu
+
+async def run(port: int, args, resume: bool):
+    env = dict(os.environ, SERVER_PORT=str(port), SERVER_MODE="loop", MAX_CONNECTIONS=str(args.clients + 100),
+               METRICS_PORT="0", LOG_LEVEL="WARNING")
+    # stdin stays open, the admin console would end the process on EOF.
+    server = subprocess.Popen([sys.executable, SERVER], env=env, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.05)
+        members = await build_swarm(args.clients, port, resume)
+        await chat(members, args.interval, args.rate)
+        times, cpu = [], 0.0
+        for _ in range(args.storms):
+            storm_times, storm_cpu = await storm(members, args.rate, server.pid)
+            times += storm_times
+            cpu += storm_cpu
+            await chat(members, args.interval, args.rate)
+        # Let the last messages arrive.
+        await asyncio.sleep(1)
+        sent = sum(member.sent for member in members)
+        delivered = sum(member.expected for member in members)
+        lost = sum(member.lost for member in members) + sent - delivered
+        duplicated = sum(member.duplicated for member in members)
+        back = len(times) // args.storms if args.storms else len(members)
+        in_rooms = sum(member.client.room_id is not None for member in members)
+        for member in members:
+            await member.client.close()
+        return sent, back, in_rooms, times, cpu, lost, duplicated
+    finally:
+        server.stdin.write(b"exit\n")
+        server.stdin.flush()
+        try:
+            server.wait(5)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=2, help="messages per second per client")
+    parser.add_argument("--storms", type=int, default=2, help="times every connection is dropped at once")
+    parser.add_argument("--interval", type=float, default=3, help="seconds of chat before, between and after the storms")
+    args = parser.parse_args()
+
+    print(f"{args.clients} clients, {args.storms} storms")
+    print(f"{'sessions':>8} | {'sent':>6} | {'back':>5} | {'in rooms':>8} | {'median s':>8} | {'max s':>6} | {'server cpu s':>12} | {'lost':>6} | {'duplicated':>10}")
+    for resume in (True, False):
+        sent, back, in_rooms, times, cpu, lost, duplicated = asyncio.run(run(free_port(), args, resume))
+        print(f"{'resume' if resume else 'none':>8} | {sent:>6} | {back:>5} | {in_rooms:>8} | {statistics.median(times or [0]):>8.3f} | "
+              f"{max(times, default=0):>6.3f} | {cpu:>12.3f} | {lost:>6} | {duplicated:>10}")
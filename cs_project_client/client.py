@@ -4,34 +4,94 @@ import threading
 import dotenv
 import utils
 from utils import logger
-import time
+import weakref
+import collections
+import protocol
 import tkinter as tk
 from tkinter import scrolledtext, messagebox
 dotenv.load_dotenv()
-MAX_PACKET_SIZE = int(os.getenv("MAX_PACKET_SIZE", 1024))
+# Ask the server for deflate compression; messages under COMPRESSION_MIN_SIZE bytes are sent as they are.
+COMPRESSION = os.getenv("COMPRESSION", "none").lower() == "deflate"
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", 6))
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 256))
+# The GUI renders the received messages in batches every RENDER_INTERVAL milliseconds and keeps the last
+# MAX_SCROLLBACK_LINES lines, older ones are trimmed.
+RENDER_INTERVAL = int(os.getenv("RENDER_INTERVAL", 50))
+MAX_SCROLLBACK_LINES = int(os.getenv("MAX_SCROLLBACK_LINES", 5000))
 
 def start_client(host=os.getenv("SERVER_HOST", "127.0.0.1"), port=int(os.getenv("SERVER_PORT", 10000))):
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     client_socket.connect((host, port))
     return client_socket
 
+# Per socket frame parser, (msg_type, text) frames that were read but not returned yet and the inflater of compressed frames.
+_receive_state = weakref.WeakKeyDictionary()
+# Sockets on which the server accepted compression.
+_compressing = weakref.WeakSet()
+
+def _state(client_socket: socket.socket) -> tuple:
+    if client_socket not in _receive_state:
+        _receive_state[client_socket] = (protocol.FrameParser(), collections.deque(), protocol.Inflater())
+    return _receive_state[client_socket]
+
+def request_compression(client_socket: socket.socket):
+    """
+    Offer deflate compression to the server. The answer is handled by get_frame(), messages are compressed once it accepted.
+    """
+    _state(client_socket)
+    client_socket.sendall(protocol.encode_frame(protocol.OPTIONS, "deflate"))
+
+def get_frame(client_socket: socket.socket) -> tuple:
+    """
+    Receive the next framed message from the server.
+    returns:
+        tuple: (msg_type, text), (None, "") if the server closed the connection.
+    """
+    parser, pending, inflater = _state(client_socket)
+    while not pending:
+        if not parser.recv_from(client_socket):
+            return None, ""
+        for msg_type, flags, payload in parser.frames():
+            # payload is a view of the receive buffer, only valid in this iteration.
+            payload = inflater.decompress(payload, flags)
+            if msg_type == protocol.OPTIONS:
+                if payload == b"deflate":
+                    _compressing.add(client_socket)
+            elif msg_type == protocol.PING:
+                # The server's liveness check, answered here so every reader of the connection keeps it alive.
+                client_socket.sendall(protocol.encode_frame(protocol.PONG, payload))
+            elif msg_type != protocol.PONG:
+                pending.append((msg_type, protocol.decode_text(payload)))
+    return pending.popleft()
+
 def get_message(client_socket: socket.socket) -> str:
-    data = client_socket.recv(MAX_PACKET_SIZE)
-    return data.decode("utf-8")
+    """
+    Receive the next framed message from the server.
+    returns:
+        str: The message text, or an empty string if the server closed the connection.
+    """
+    return get_frame(client_socket)[1]
 
 def listen_for_messages(client_socket: socket.socket):
     while True:
         try:
-            message = get_message(client_socket)
+            # Blocks until the server sends something.
+            msg_type, message = get_frame(client_socket)
+            if msg_type is None:
+                logger.info("The server closed the connection")
+                return
             if message:
                 utils.cprint(f"{message}", "green")
-            time.sleep(0.1)
         except Exception as e:
             logger.error(f"Error receiving message: {e}")
             raise e
 
 def send_message(client_socket: socket.socket, message: str):
-    client_socket.sendall(message.encode("utf-8"))
+    payload = message.encode("utf-8")
+    if client_socket in _compressing and len(payload) >= COMPRESSION_MIN_SIZE:
+        client_socket.sendall(protocol.encode_frame(protocol.CHAT, protocol.deflate(payload, COMPRESSION_LEVEL), protocol.FLAG_DEFLATE))
+    else:
+        client_socket.sendall(protocol.encode_frame(protocol.CHAT, payload))
 
 def send_messages_loop(client_socket: socket.socket):
     while True:
@@ -48,6 +108,9 @@ class ClientGUI:
         self.root.minsize(600, 500)
         self.client_socket = None
         self.is_connected = False
+        # (text, tag) lines waiting for the next render, appended from any thread. A burst larger than the scrollback
+        # pushes out the oldest lines, they would be trimmed right after being rendered anyway.
+        self.pending_lines = collections.deque(maxlen=MAX_SCROLLBACK_LINES)
 
         self.bg_color = "#2b2b2b"
         self.fg_color = "#ffffff"
@@ -61,6 +124,7 @@ class ClientGUI:
         self.root.configure(bg=self.bg_color)
 
         self.create_widgets()
+        self.root.after(RENDER_INTERVAL, self.render_pending)
 
     def create_widgets(self):
         title_label = tk.Label(
@@ -244,10 +308,37 @@ class ClientGUI:
         self.send_button.bind("<Leave>", lambda e: self.send_button.config(bg=self.button_bg) if self.send_button['state'] == tk.NORMAL else None)
 
     def append_message(self, message, tag="info"):
-        self.messages_text.config(state=tk.NORMAL)
-        self.messages_text.insert(tk.END, message + "\n", tag)
-        self.messages_text.see(tk.END)
-        self.messages_text.config(state=tk.DISABLED)
+        """
+        Queue a line for the next render, safe to call from the network thread.
+        """
+        self.pending_lines.append((message + "\n", tag))
+
+    def render_pending(self):
+        """
+        Render the queued lines with one insert and at most one scroll, then trim the scrollback.
+        Runs on the Tk main loop every RENDER_INTERVAL milliseconds.
+        """
+        if self.pending_lines:
+            # Consecutive lines with the same tag are inserted as one string: [text, tag, text, tag, ...].
+            chunks = []
+            for _ in range(len(self.pending_lines)):
+                line, tag = self.pending_lines.popleft()
+                if chunks and chunks[-1] == tag:
+                    chunks[-2] += line
+                else:
+                    chunks += [line, tag]
+            # Only follow new messages if the user did not scroll up to read older ones.
+            at_bottom = self.messages_text.yview()[1] >= 1.0
+            self.messages_text.config(state=tk.NORMAL)
+            self.messages_text.insert(tk.END, *chunks)
+            # The text always ends with a newline, the line after it is empty.
+            lines = int(self.messages_text.index("end-1c").split(".")[0]) - 1
+            if lines > MAX_SCROLLBACK_LINES:
+                self.messages_text.delete("1.0", f"{lines - MAX_SCROLLBACK_LINES + 1}.0")
+            self.messages_text.config(state=tk.DISABLED)
+            if at_bottom:
+                self.messages_text.see(tk.END)
+        self.root.after(RENDER_INTERVAL, self.render_pending)
 
     def connect_to_server(self):
         try:
@@ -256,11 +347,19 @@ class ClientGUI:
 
             self.append_message(f"Connecting to {host}:{port}...", "info")
             self.client_socket = start_client(host, port)
+            if COMPRESSION:
+                request_compression(self.client_socket)
+
+            msg_type, welcome_msg = get_frame(self.client_socket)
+            if msg_type == protocol.BUSY:
+                # Refused by the server's admission control, the message says when to retry.
+                self.client_socket.close()
+                self.client_socket = None
+                self.append_message(welcome_msg, "error")
+                return
             self.is_connected = True
 
             self.append_message("Connected to server", "info")
-
-            welcome_msg = get_message(self.client_socket)
             self.append_message(f"{welcome_msg}", "received")
 
             threading.Thread(target=self.listen_for_messages_gui, daemon=True).start()
@@ -297,10 +396,15 @@ class ClientGUI:
     def listen_for_messages_gui(self):
         while self.is_connected:
             try:
-                message = get_message(self.client_socket)
+                # Blocks until the server sends something, the lines are rendered by render_pending().
+                msg_type, message = get_frame(self.client_socket)
+                if msg_type is None:
+                    if self.is_connected:
+                        self.append_message("The server closed the connection", "error")
+                        self.is_connected = False
+                    break
                 if message:
                     self.append_message(f"{message}", "received")
-                time.sleep(0.1)
             except Exception as e:
                 if self.is_connected:
                     logger.error(f"Error receiving message: {e}")
@@ -0,0 +1,315 @@
+"""
+Headless load generator and latency benchmark for the chat server.
+
+Opens many simulated users with the client's start_client/send_message/get_message primitives,
+runs the real name -> 'new'/room id handshake, groups the users into rooms and drives chat traffic.
+Reports connect rate, handshake time, end-to-end delivery latency percentiles, throughput and
+the server's RSS, and writes them as JSON so runs of different versions can be compared.
+
+Start the server with a MAX_CONNECTIONS above --users and without the per client rate limits (off by default,
+CLIENT_MESSAGE_RATE / CLIENT_BYTE_RATE would throttle --rate above them), e.g.
+    MAX_CONNECTIONS=5000 LOG_LEVEL=WARNING python socket_server.py
+    python load_test.py --users 2000 --rate 5 --duration 20 --server-pid <pid> --output results.json
+"""
+import argparse
+import json
+import os
+import re
+import threading
+import time
+import resource
+import client
+import protocol
+from utils import logger
+
+ROOM_CREATED = re.compile(r"New chat room (\d+) created")
+JOIN_REFUSED = re.compile(r"Chat room \d+ is full or does not exist")
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(values: list) -> dict:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.50),
+        "p99": percentile(values, 0.99),
+        "p999": percentile(values, 0.999),
+        "max": max(values, default=0.0),
+    }
+
+def server_rss_kb(pid: int) -> int:
+    """
+    returns:
+        int: The resident set size of the process in KiB, 0 if it can't be read.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+class ServerBusy(Exception):
+    """The server's admission control refused the connection."""
+
+class JoinRefused(Exception):
+    """The server did not let the user into its room."""
+
+class SimulatedUser:
+    def __init__(self, index: int, room_slot, stats):
+        self.index = index
+        self.name = f"load{index}"
+        self.room_slot = room_slot
+        self.stats = stats
+        self.socket = None
+
+    def connect(self, host: str, port: int, compression: bool = False):
+        start = time.perf_counter()
+        self.socket = client.start_client(host, port)
+        if compression:
+            client.request_compression(self.socket)
+        connected = time.perf_counter()
+        msg_type, welcome = client.get_frame(self.socket)
+        if msg_type == protocol.BUSY:
+            self.socket.close()
+            self.socket = None
+            raise ServerBusy(welcome)
+        client.send_message(self.socket, self.name)
+        client.get_message(self.socket)  # room list
+        if self.room_slot.creator is self:
+            client.send_message(self.socket, "new")
+            try:
+                while True:
+                    message = client.get_message(self.socket)
+                    if not message:
+                        raise ConnectionError("The server closed the connection before the room was created")
+                    created = ROOM_CREATED.search(message)
+                    if created:
+                        break
+                self.room_slot.room_id = created.group(1)
+            finally:
+                # Without a room the joiners waiting for it fail right away too.
+                self.room_slot.ready.set()
+        else:
+            if not self.room_slot.ready.wait(60):
+                raise TimeoutError("Room creator did not finish its handshake")
+            if self.room_slot.room_id is None:
+                raise ConnectionError("Room creator lost its connection")
+            client.send_message(self.socket, self.room_slot.room_id)
+            # Only a user in the room receives its messages, a refused one would count them as lost.
+            while True:
+                msg_type, text = client.get_frame(self.socket)
+                if msg_type is None:
+                    raise ConnectionError("The server closed the connection before answering the join")
+                if msg_type == protocol.JOIN:
+                    break
+                if JOIN_REFUSED.search(text):
+                    raise JoinRefused(text.splitlines()[0])
+        self.stats.record_handshake(connected - start, time.perf_counter() - start)
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def receive(self):
+        try:
+            while True:
+                message = client.get_message(self.socket)
+                if not message:
+                    break
+                received = time.perf_counter_ns()
+                # Chat lines look like "[name]: <sent_ns> <padding>"
+                _, _, body = message.partition("]: ")
+                sent, _, _ = body.partition(" ")
+                if sent.isdigit():
+                    self.stats.record_delivery((received - int(sent)) / 1e6, len(message))
+        except OSError:
+            pass
+        finally:
+            self.stats.record_disconnect(self)
+
+class RoomSlot:
+    def __init__(self, creator=None):
+        self.creator = creator
+        self.room_id = None
+        self.ready = threading.Event()
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connect_times = []
+        self.handshake_times = []
+        self.latencies = []
+        self.sent = 0
+        self.received = 0
+        self.received_bytes = 0
+        self.errors = 0
+        self.refused = 0
+        self.join_failures = 0
+        self.disconnects = 0
+        self.stopping = False
+
+    def record_handshake(self, connect_seconds: float, handshake_seconds: float):
+        with self.lock:
+            self.connect_times.append(connect_seconds * 1000)
+            self.handshake_times.append(handshake_seconds * 1000)
+
+    def record_delivery(self, latency_ms: float, size: int):
+        with self.lock:
+            self.latencies.append(latency_ms)
+            self.received += 1
+            self.received_bytes += size
+
+    def record_disconnect(self, user: SimulatedUser):
+        with self.lock:
+            if not self.stopping:
+                self.disconnects += 1
+
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def run(args) -> dict:
+    raise_file_limit()
+    threading.stack_size(256 * 1024)
+    stats = Stats()
+    users = []
+    for index in range(args.users):
+        if index % args.room_size == 0:
+            slot = RoomSlot()
+        user = SimulatedUser(index, slot, stats)
+        if slot.creator is None:
+            slot.creator = user
+        users.append(user)
+
+    def connect(user: SimulatedUser):
+        try:
+            user.connect(args.host, args.port, args.compression)
+            threading.Thread(target=user.receive, daemon=True).start()
+        except ServerBusy as e:
+            logger.warning(f"User {user.name} was refused: {e}")
+            with stats.lock:
+                stats.refused += 1
+        except JoinRefused as e:
+            logger.warning(f"User {user.name} could not join room {user.room_slot.room_id}: {e}")
+            user.close()
+            with stats.lock:
+                stats.join_failures += 1
+        except Exception as e:
+            logger.error(f"User {user.name} failed to connect: {e}")
+            user.close()
+            with stats.lock:
+                stats.errors += 1
+
+    rss_samples = []
+    connect_start = time.perf_counter()
+    connectors = []
+    for user in users:
+        thread = threading.Thread(target=connect, args=(user,), daemon=True)
+        thread.start()
+        connectors.append(thread)
+        if args.connect_rate:
+            time.sleep(1 / args.connect_rate)
+    for thread in connectors:
+        thread.join()
+    connect_seconds = time.perf_counter() - connect_start
+    connected = [user for user in users if user.socket is not None]
+    print(f"{len(connected)}/{args.users} users joined their rooms in {connect_seconds:.2f}s")
+
+    padding = "x" * max(0, args.message_size - 20)
+    interval = 1 / (args.rate * len(connected)) if connected and args.rate else 0
+    traffic_start = time.perf_counter()
+    next_send = traffic_start
+    next_sample = traffic_start
+    while connected and time.perf_counter() - traffic_start < args.duration:
+        for user in connected:
+            now = time.perf_counter()
+            if now >= next_sample and args.server_pid:
+                rss_samples.append(server_rss_kb(args.server_pid))
+                next_sample = now + 1
+            if interval:
+                next_send += interval
+                if next_send > now:
+                    time.sleep(next_send - now)
+            try:
+                client.send_message(user.socket, f"{time.perf_counter_ns()} {padding}")
+                stats.sent += 1
+            except OSError:
+                stats.errors += 1
+            if time.perf_counter() - traffic_start >= args.duration:
+                break
+    traffic_seconds = time.perf_counter() - traffic_start
+    time.sleep(args.drain)
+    stats.stopping = True
+    if args.server_pid:
+        rss_samples.append(server_rss_kb(args.server_pid))
+    for user in connected:
+        try:
+            user.socket.close()
+        except OSError:
+            pass
+
+    with stats.lock:
+        return {
+            "label": args.label,
+            "timestamp": time.time(),
+            "config": {key: value for key, value in vars(args).items() if key not in ("output", "label")},
+            "users": args.users,
+            "joined": len(connected),
+            "errors": stats.errors,
+            "refused": stats.refused,
+            "join_failures": stats.join_failures,
+            "unexpected_disconnects": stats.disconnects,
+            "connect_rate_per_s": len(connected) / connect_seconds if connect_seconds else 0.0,
+            "connect_ms": summarize(stats.connect_times),
+            "handshake_ms": summarize(stats.handshake_times),
+            "latency_ms": summarize(stats.latencies),
+            "sent": stats.sent,
+            "delivered": stats.received,
+            "sent_per_s": stats.sent / traffic_seconds if traffic_seconds else 0.0,
+            "delivered_per_s": stats.received / traffic_seconds if traffic_seconds else 0.0,
+            "delivered_bytes_per_s": stats.received_bytes / traffic_seconds if traffic_seconds else 0.0,
+            "server_rss_kb": {"max": max(rss_samples, default=0), "last": rss_samples[-1] if rss_samples else 0},
+        }
+
+def print_report(result: dict):
+    print(f"joined          {result['joined']}/{result['users']} (errors {result['errors']}, refused as busy {result['refused']}, "
+          f"refused joins {result['join_failures']}, unexpected disconnects {result['unexpected_disconnects']})")
+    print(f"connect rate    {result['connect_rate_per_s']:.1f} connections/s")
+    for name in ("connect_ms", "handshake_ms", "latency_ms"):
+        values = result[name]
+        print(f"{name:<15} p50 {values['p50']:.2f}  p99 {values['p99']:.2f}  p999 {values['p999']:.2f}  max {values['max']:.2f}")
+    print(f"throughput      sent {result['sent_per_s']:.0f} msg/s, delivered {result['delivered_per_s']:.0f} msg/s "
+          f"({result['delivered_bytes_per_s'] / 1024:.0f} KiB/s)")
+    if result["server_rss_kb"]["max"]:
+        print(f"server rss      max {result['server_rss_kb']['max']} KiB, last {result['server_rss_kb']['last']} KiB")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=os.getenv("SERVER_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("SERVER_PORT", 10000)))
+    parser.add_argument("--users", type=int, default=100, help="simulated users")
+    parser.add_argument("--room-size", type=int, default=2, help="users per room, must not exceed the server's MAX_CHAT_SIZE")
+    parser.add_argument("--connect-rate", type=float, default=0, help="new connections per second, 0 for as fast as possible")
+    parser.add_argument("--rate", type=float, default=1, help="messages per second per user, 0 for as fast as possible")
+    parser.add_argument("--message-size", type=int, default=64, help="approximate message size in bytes")
+    parser.add_argument("--compression", action="store_true", help="negotiate deflate compression")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of traffic")
+    parser.add_argument("--drain", type=float, default=1, help="seconds to wait for in-flight messages at the end")
+    parser.add_argument("--server-pid", type=int, default=0, help="server process to sample the RSS of")
+    parser.add_argument("--label", default="", help="free text stored in the results, e.g. the version under test")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    result = run(args)
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
@@ -0,0 +1,299 @@
+import os
+import struct
+import threading
+import time
+import zlib
+
+# Wire format shared by the server, the client and the capture analysis (keep the copies of this file identical).
+# Every message is one frame: a fixed header followed by `length` bytes of payload.
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct("!BBHI")  # version, message type, flags, payload length
+HEADER_SIZE = HEADER.size
+MAX_FRAME_SIZE = int(os.getenv("MAX_FRAME_SIZE", 64 * 1024))
+# Size of the pooled buffers sockets are read into, a frame that does not fit gets a buffer of its own.
+RECV_BUFFER_SIZE = int(os.getenv("RECV_BUFFER_SIZE", 64 * 1024))
+
+# Message types
+CHAT = 1        # a chat line, also used for the plain text lobby inputs (name, 'new', room id)
+JOIN = 2        # join request ('new' or a room id) / join confirmation
+LIST_ROOMS = 3  # room list request: "" or "page <n>" for one page, "subscribe" to get ROOM_UPDATE frames as well,
+                # "unsubscribe"; the reply is "version <v> page <n> of <pages>, <rooms> rooms" and a "<id> <label>" line per room
+SYSTEM = 4      # server notices
+BROADCAST = 5   # server wide announcements
+BUSY = 6        # the server refused the connection, the payload says when to retry
+PING = 7        # liveness check, either side answers with a PONG echoing the payload
+PONG = 8
+OPTIONS = 9     # extension negotiation: the client offers "deflate" and/or "resume", the server answers the ones it accepts or "none"
+RESUME = 10     # resumable sessions: the server's "token <token>", a new connection's "<token> <bytes received>" answered
+                # with "resumed <bytes received>" or "expired", and the client's "end" when it leaves for good
+ROOM_UPDATE = 11 # room list changes for subscribed lobby clients: "version <v>", then "add <id> <label>",
+                # "update <id> <label>", "full <id>" or "remove <id>" lines, each with the room's state as of version v
+
+MESSAGE_TYPES = {CHAT, JOIN, LIST_ROOMS, SYSTEM, BROADCAST, BUSY, PING, PONG, OPTIONS, RESUME, ROOM_UPDATE}
+
+# Frame flags
+FLAG_DEFLATE = 0x1  # the payload is raw deflate data
+FLAG_CONTEXT = 0x2  # with FLAG_DEFLATE: compressed with the connection's streaming context, which the receiver
+                    # must inflate in order. Without it the payload is compressed on its own and can be shared.
+
+class ProtocolError(Exception):
+    pass
+
+def encode_frame(msg_type: int, payload, flags: int = 0) -> bytes:
+    """
+    Build one frame.
+    args:
+        msg_type (int): One of the message type constants.
+        payload (str | bytes): The payload, str payloads are encoded as UTF-8.
+        flags (int): Frame flags.
+    returns:
+        bytes: The encoded frame.
+    """
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame payload of {len(payload)} bytes exceeds {MAX_FRAME_SIZE}")
+    return HEADER.pack(PROTOCOL_VERSION, msg_type, flags, len(payload)) + payload
+
+def decode_text(payload) -> str:
+    """
+    Decode a text payload. A frame always carries whole characters, however the bytes were split between reads,
+    so only a malformed or truncated sequence can fail; it becomes U+FFFD instead of an error that drops the connection.
+    args:
+        payload (bytes | memoryview): The frame payload.
+    returns:
+        str: The text.
+    """
+    try:
+        return str(payload, "utf-8")
+    except UnicodeDecodeError:
+        return str(payload, "utf-8", "replace")
+
+class BufferPool:
+    """
+    Free list of receive buffers. It grows when more reads are in progress at once than there are free buffers,
+    and every trim_interval seconds it drops the free buffers that the busiest moment of the interval did not need.
+    """
+    def __init__(self, size: int, trim_interval: float = 10.0):
+        self.size = size
+        self.trim_interval = trim_interval
+        self.free = []
+        self.in_use = 0
+        self.peak = 0
+        self.trimmed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bytearray:
+        with self._lock:
+            self.in_use += 1
+            if self.in_use > self.peak:
+                self.peak = self.in_use
+            if self.free:
+                return self.free.pop()
+        return bytearray(self.size)
+
+    def release(self, buffer: bytearray):
+        with self._lock:
+            self.in_use -= 1
+            now = time.monotonic()
+            if now - self.trimmed_at >= self.trim_interval:
+                del self.free[max(0, self.peak - self.in_use):]
+                self.peak = self.in_use
+                self.trimmed_at = now
+            self.free.append(buffer)
+
+receive_pool = BufferPool(RECV_BUFFER_SIZE)
+
+class FrameParser:
+    """
+    Incremental frame parser over pooled buffers. A socket is read straight into a buffer borrowed from the pool,
+    and the frames are parsed in place, their payloads are memoryview slices of it. The buffer goes back to the pool
+    as soon as no partial frame is left in it, so an idle connection holds no buffer at all.
+    """
+    def __init__(self, pool: BufferPool = receive_pool):
+        self.pool = pool
+        self.buffer = None
+        # The unparsed bytes are buffer[start:end].
+        self.start = 0
+        self.end = 0
+
+    def _room(self, needed: int) -> memoryview:
+        """
+        returns:
+            memoryview: The free space after the unparsed bytes, at least needed bytes of it.
+        """
+        if self.buffer is None:
+            self.buffer = self.pool.acquire() if needed <= self.pool.size else bytearray(needed)
+            self.start = self.end = 0
+        elif len(self.buffer) - self.end < needed:
+            pending = self.end - self.start
+            if pending + needed > len(self.buffer):
+                # A frame larger than a pooled buffer, or a short read of many frames: give the unparsed bytes more room.
+                buffer = bytearray(pending + max(needed, self._frame_size()))
+                buffer[:pending] = self.buffer[self.start:self.end]
+                self._give_back()
+                self.buffer = buffer
+            else:
+                self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        return memoryview(self.buffer)[self.end:]
+
+    def _frame_size(self) -> int:
+        """
+        returns:
+            int: The full size of the frame at the start of the unparsed bytes, 0 if its header is incomplete.
+        """
+        if self.end - self.start < HEADER_SIZE:
+            return 0
+        return HEADER_SIZE + HEADER.unpack_from(self.buffer, self.start)[3]
+
+    def _give_back(self):
+        if self.buffer is not None and len(self.buffer) == self.pool.size:
+            self.pool.release(self.buffer)
+        self.buffer = None
+
+    def recv_from(self, sock) -> int:
+        """
+        Read from the socket into the parser's buffer.
+        returns:
+            int: The number of bytes read, 0 if the peer closed the connection.
+        raises:
+            OSError: As sock.recv_into, BlockingIOError if a non-blocking socket has nothing to read.
+        """
+        room = self._room(max(1, self._frame_size() - (self.end - self.start)))
+        received = 0
+        try:
+            received = sock.recv_into(room)
+            self.end += received
+        finally:
+            room.release()
+            if not received and self.start == self.end:
+                self._give_back()
+        return received
+
+    def append(self, data: bytes):
+        """
+        Add bytes that were read some other way.
+        """
+        room = self._room(len(data))
+        room[:len(data)] = data
+        room.release()
+        self.end += len(data)
+
+    def frames(self):
+        """
+        Parse the complete frames, a single read can hold many of them and a frame can span reads.
+        yields:
+            tuple: (msg_type, flags, payload) of each frame. payload is a memoryview only valid until the next frame
+            is requested, copy it or decode it to keep it.
+        raises:
+            ProtocolError: If the data is not a valid frame.
+        """
+        if self.buffer is None:
+            return
+        view = memoryview(self.buffer)
+        try:
+            while self.end - self.start >= HEADER_SIZE:
+                version, msg_type, flags, length = HEADER.unpack_from(self.buffer, self.start)
+                if version != PROTOCOL_VERSION:
+                    raise ProtocolError(f"Unsupported protocol version {version}")
+                if length > MAX_FRAME_SIZE:
+                    raise ProtocolError(f"Frame payload of {length} bytes exceeds {MAX_FRAME_SIZE}")
+                frame_end = self.start + HEADER_SIZE + length
+                if frame_end > self.end:
+                    break
+                payload = view[self.start + HEADER_SIZE:frame_end]
+                self.start = frame_end
+                yield msg_type, flags, payload
+                payload.release()
+        finally:
+            view.release()
+            if self.start == self.end:
+                self._give_back()
+
+    def feed(self, data: bytes) -> list:
+        """
+        Add received bytes and return the frames completed by them.
+        args:
+            data (bytes): The bytes read from the socket.
+        returns:
+            list: (msg_type, flags, payload) tuples, payload is bytes.
+        """
+        self.append(data)
+        return [(msg_type, flags, bytes(payload)) for msg_type, flags, payload in self.frames()]
+
+    def unparsed(self) -> bytes:
+        """
+        returns:
+            bytes: The bytes received but not parsed yet, the start of an incomplete frame.
+        """
+        return bytes(self.buffer[self.start:self.end]) if self.buffer is not None else b""
+
+def deflate(payload: bytes, level: int) -> bytes:
+    """
+    Compress a payload on its own, so the result can be sent to any connection.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(payload) + compressor.flush()
+
+def deflate_frame(frame: bytes, level: int) -> bytes:
+    """
+    returns:
+        bytes: The encoded frame with its payload compressed on its own.
+    """
+    version, msg_type, flags, length = HEADER.unpack_from(frame)
+    return encode_frame(msg_type, deflate(frame[HEADER_SIZE:], level), flags | FLAG_DEFLATE)
+
+def inflate(payload: bytes, context=None) -> bytes:
+    """
+    Decompress a FLAG_DEFLATE payload.
+    args:
+        payload (bytes): The compressed payload.
+        context: The connection's zlib decompress object for FLAG_CONTEXT payloads, None for the ones compressed on their own.
+    returns:
+        bytes: The payload.
+    raises:
+        ProtocolError: If the payload is not valid deflate data or inflates past MAX_FRAME_SIZE.
+    """
+    decompressor = context if context is not None else zlib.decompressobj(-zlib.MAX_WBITS)
+    try:
+        data = decompressor.decompress(payload, MAX_FRAME_SIZE)
+    except zlib.error as e:
+        raise ProtocolError(f"Invalid compressed payload: {e}")
+    if decompressor.unconsumed_tail:
+        raise ProtocolError(f"Compressed payload inflates past {MAX_FRAME_SIZE} bytes")
+    return data
+
+class Deflater:
+    """
+    Compresses the payloads sent to one connection. With a context, every payload is compressed with the
+    same zlib stream, so repeated words across messages compress too; the frames must then reach the peer
+    in the order they were compressed, and none may be dropped.
+    """
+    def __init__(self, level: int, context: bool = True):
+        self.level = level
+        self.context = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS) if context else None
+
+    def compress(self, payload: bytes) -> tuple:
+        """
+        returns:
+            tuple: (compressed payload, frame flags).
+        """
+        if self.context is None:
+            return deflate(payload, self.level), FLAG_DEFLATE
+        return self.context.compress(payload) + self.context.flush(zlib.Z_SYNC_FLUSH), FLAG_DEFLATE | FLAG_CONTEXT
+
+class Inflater:
+    """
+    Decompresses the payloads received on one connection, keeping the streaming context of FLAG_CONTEXT frames.
+    """
+    def __init__(self):
+        self.context = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def decompress(self, payload: bytes, flags: int) -> bytes:
+        if not flags & FLAG_DEFLATE:
+            return payload
+        return inflate(payload, self.context if flags & FLAG_CONTEXT else None)
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,131 @@
+"""
+Benchmark of the accept path.
+Starts the server in this process on an ephemeral port and lets concurrent connectors open connections
+that read their first frame and close. Reports the connections accepted per second and the time from
+connect() to the welcome frame, for the event loop accepting one connection per wakeup and a burst of them,
+and for the threaded server. The storm test then holds more connections open than the server admits
+and checks that every extra one gets a busy frame right away instead of hanging in the backlog.
+
+usage: python bench_accept.py [--connections 5000] [--concurrency 64] [--storm 2000] [--limit 500]
+"""
+import argparse
+import socket
+import threading
+import time
+import concurrent.futures
+import shared_data
+import protocol
+import chat
+import event_loop
+from connection import ConnectionHandler
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def start_server(mode: str, burst: int) -> tuple:
+    """
+    returns:
+        tuple: (port, stop callback).
+    """
+    listener = ConnectionHandler.start_server("127.0.0.1", 0)
+    port = listener.getsockname()[1]
+    if mode == "threaded":
+        shared_data.event_loop = None
+        # The accept thread blocks for good, it dies with the benchmark.
+        threading.Thread(target=ConnectionHandler.handle_new_client_connections, args=(listener,), daemon=True).start()
+        return port, lambda: None
+    loop = event_loop.EventLoop(listener)
+    loop.accept_burst = burst
+    thread = threading.Thread(target=loop.run)
+    thread.start()
+
+    def stop():
+        loop.stop()
+        thread.join()
+        listener.close()
+        shared_data.event_loop = None
+    return port, stop
+
+def first_frame(port: int, hold: list = None) -> tuple:
+    """
+    Connect and read the first frame.
+    args:
+        hold (list): Keep the socket open by appending it here, closed right away if None.
+    returns:
+        tuple: (msg_type, seconds from connect() to the frame), msg_type is None if the server closed first.
+    """
+    start = time.perf_counter()
+    sock = socket.create_connection(("127.0.0.1", port))
+    parser = protocol.FrameParser()
+    frames = []
+    while not frames:
+        data = sock.recv(4096)
+        if not data:
+            break
+        frames = parser.feed(data)
+    elapsed = time.perf_counter() - start
+    if hold is None:
+        sock.close()
+    else:
+        hold.append(sock)
+    return (frames[0][0] if frames else None), elapsed
+
+def wait_closed():
+    """Let the server notice the closed connections so the next run starts with free slots."""
+    deadline = time.perf_counter() + 10
+    while shared_data.registry.connection_count() and time.perf_counter() < deadline:
+        time.sleep(0.01)
+
+def churn(mode: str, burst: int, connections: int, concurrency: int) -> dict:
+    ConnectionHandler.max_connections = 0
+    port, stop = start_server(mode, burst)
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        start = time.perf_counter()
+        results = list(pool.map(lambda _: first_frame(port), range(connections)))
+        elapsed = time.perf_counter() - start
+    wait_closed()
+    stop()
+    times = [seconds * 1000 for msg_type, seconds in results if msg_type == protocol.SYSTEM]
+    return {"per_second": len(times) / elapsed, "p50": percentile(times, 0.5), "p99": percentile(times, 0.99), "max": max(times, default=0.0)}
+
+def storm(mode: str, connections: int, limit: int, concurrency: int) -> dict:
+    ConnectionHandler.max_connections = limit
+    port, stop = start_server(mode, 64)
+    held = []
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(lambda _: first_frame(port, held), range(connections)))
+    for sock in held:
+        sock.close()
+    wait_closed()
+    stop()
+    busy = [seconds * 1000 for msg_type, seconds in results if msg_type == protocol.BUSY]
+    return {
+        "welcomed": sum(1 for msg_type, seconds in results if msg_type == protocol.SYSTEM),
+        "busy": len(busy),
+        "busy_p99": percentile(busy, 0.99),
+        "busy_max": max(busy, default=0.0),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=5000, help="connections opened and closed per mode")
+    parser.add_argument("--concurrency", type=int, default=64, help="connections in flight at once")
+    parser.add_argument("--storm", type=int, default=2000, help="connections held open in the storm test")
+    parser.add_argument("--limit", type=int, default=500, help="MAX_CONNECTIONS during the storm test")
+    args = parser.parse_args()
+
+    modes = [("loop, 1 per wakeup", "loop", 1), ("loop, burst 64", "loop", 64), ("threaded", "threaded", 64)]
+    print(f"{'accept path':>18} | {'accepted/s':>10} | {'p50 ms':>7} | {'p99 ms':>7} | {'max ms':>7}")
+    for name, mode, burst in modes:
+        result = churn(mode, burst, args.connections, args.concurrency)
+        print(f"{name:>18} | {result['per_second']:>10.0f} | {result['p50']:>7.2f} | {result['p99']:>7.2f} | {result['max']:>7.2f}")
+
+    print()
+    print(f"{args.storm} connections held open against MAX_CONNECTIONS={args.limit}")
+    print(f"{'server':>18} | {'welcomed':>8} | {'busy':>6} | {'busy p99 ms':>11} | {'busy max ms':>11}")
+    for mode in ("loop", "threaded"):
+        result = storm(mode, args.storm, args.limit, args.concurrency)
+        print(f"{mode:>18} | {result['welcomed']:>8} | {result['busy']:>6} | {result['busy_p99']:>11.2f} | {result['busy_max']:>11.2f}")
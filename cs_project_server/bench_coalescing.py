@@ -0,0 +1,141 @@
+"""
+Benchmark of the event loop's write path.
+Runs a real EventLoop over socket pairs: one member of a room sends chat messages at a fixed rate,
+the others' ends are drained by a reader thread. Reports the write system calls and the loop thread's
+CPU time per message for one send call per frame (the previous behaviour), one vectored sendmsg per
+connection and loop iteration, sendmsg with flush delays and sendmsg from fan-out threads.
+
+usage: python bench_coalescing.py [--sizes 2,10,50,200] [--rate 2000] [--duration 2] [--delays 0.002,0.005] [--fanout-threads 4]
+"""
+import argparse
+import selectors
+import socket
+import threading
+import time
+import concurrent.futures
+import shared_data
+import protocol
+import chat
+import metrics
+import event_loop
+from client_handler import Client
+
+def per_frame_write(loop: event_loop.EventLoop, client: Client):
+    """The previous behaviour: one send call per queued frame."""
+    loop._delayed.pop(client, None)
+    if client.socket is None:
+        return
+    try:
+        for chunk in client.outbound.pending():
+            sent = client.socket.send(chunk)
+            metrics.WRITE_CALLS.inc()
+            client.outbound.consume(sent)
+            if sent < len(chunk):
+                break
+    except BlockingIOError:
+        pass
+    loop.update_interest(client)
+
+class Receiver:
+    """Drains the room members' ends of the socket pairs and counts the delivered frames."""
+    def __init__(self, ends: list):
+        self.selector = selectors.DefaultSelector()
+        for end in ends:
+            end.setblocking(False)
+            self.selector.register(end, selectors.EVENT_READ, protocol.FrameParser())
+        self.delivered = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            for key, events in self.selector.select(0.1):
+                try:
+                    data = key.fileobj.recv(65536)
+                except BlockingIOError:
+                    continue
+                self.delivered += len(key.data.feed(data))
+
+def run(size: int, rate: float, duration: float, delay: float, per_frame: bool, fanout_threads: int = 0) -> dict:
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    loop = event_loop.EventLoop(listener)
+    loop.flush_delay = delay
+    if fanout_threads:
+        loop.fanout_threads = fanout_threads
+        loop._writers = concurrent.futures.ThreadPoolExecutor(fanout_threads)
+    if per_frame:
+        loop._write = lambda client: per_frame_write(loop, client)
+    # Set before the room exists so it starts no manager thread.
+    shared_data.event_loop = loop
+    chat.Chat._max_chat_size = size
+    room = chat.Chat()
+    shared_data.registry.add_room(room)
+    ends = []
+    for i in range(size):
+        server_end, client_end = socket.socketpair()
+        client = Client(("bench", i), server_end, client_id=i, client_name=f"user{i}")
+        loop.register_client(client)
+        room.add_client(client)
+        ends.append(client_end)
+    sender = ends[0]
+    receiver = Receiver(ends[1:])
+    cpu = {}
+
+    def run_loop():
+        start = time.thread_time()
+        loop.run()
+        cpu["loop"] = time.thread_time() - start
+
+    threads = [threading.Thread(target=run_loop), threading.Thread(target=receiver.run)]
+    for thread in threads:
+        thread.start()
+    calls_before = metrics.WRITE_CALLS.value
+    frame = protocol.encode_frame(protocol.CHAT, "x" * 64)
+    messages = int(rate * duration)
+    start = time.perf_counter()
+    for i in range(messages):
+        sender.sendall(frame)
+        pause = start + (i + 1) / rate - time.perf_counter()
+        if pause > 0:
+            time.sleep(pause)
+    expected = messages * (size - 1)
+    deadline = time.perf_counter() + 10
+    while receiver.delivered < expected and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    loop.stop()
+    threads[0].join()
+    receiver.running = False
+    threads[1].join()
+    calls = metrics.WRITE_CALLS.value - calls_before
+    for end in ends:
+        end.close()
+    for client in list(room.chat_clients):
+        client.socket.close()
+    shared_data.registry.remove_room(room)
+    listener.close()
+    return {
+        "delivered": receiver.delivered / expected,
+        "calls_per_message": calls / messages,
+        "cpu_us_per_message": cpu["loop"] / messages * 1e6,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="2,10,50,200")
+    parser.add_argument("--rate", type=float, default=2000, help="messages per second sent to the room")
+    parser.add_argument("--duration", type=float, default=2)
+    parser.add_argument("--delays", default="0.002,0.005", help="flush delays to compare, in seconds")
+    parser.add_argument("--fanout-threads", type=int, default=4, help="fan-out writer threads to compare, 0 to skip")
+    args = parser.parse_args()
+
+    modes = [("send per frame", 0.0, True, 0), ("sendmsg", 0.0, False, 0)]
+    modes += [(f"sendmsg +{float(delay) * 1000:g}ms", float(delay), False, 0) for delay in args.delays.split(",") if delay]
+    if args.fanout_threads:
+        modes.append((f"sendmsg {args.fanout_threads} threads", 0.0, False, args.fanout_threads))
+    print(f"{'room size':>9} | {'write path':>18} | {'delivered':>9} | {'syscalls/msg':>12} | {'cpu us/msg':>10}")
+    for size in (int(size) for size in args.sizes.split(",")):
+        for name, delay, per_frame, fanout_threads in modes:
+            result = run(size, args.rate, args.duration, delay, per_frame, fanout_threads)
+            print(f"{size:>9} | {name:>18} | {result['delivered']:>9.0%} | "
+                  f"{result['calls_per_message']:>12.2f} | {result['cpu_us_per_message']:>10.1f}")
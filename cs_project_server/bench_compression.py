@@ -0,0 +1,107 @@
+"""
+Benchmark of the per message compression.
+Compresses a stream of chat-like messages of several sizes and reports the bytes on the wire per message and
+the CPU time to compress and inflate one, without compression, with each message compressed on its own
+(what fan-out and broadcasts share between recipients) and with the connection's streaming context.
+Then measures a room's fan-out with every member compressing, building the compressed frame once versus
+once per recipient with their streaming contexts.
+
+usage: python bench_compression.py [--sizes 64,256,1024,4096] [--messages 2000] [--level 6] [--room-size 100]
+"""
+import argparse
+import random
+import time
+import protocol
+import chat
+from bench_fanout import build_room, drain
+
+WORDS = ("the", "a", "to", "and", "you", "is", "it", "that", "what", "are", "this", "for", "meeting", "tomorrow",
+         "lunch", "server", "deploy", "build", "broken", "fixed", "thanks", "please", "review", "room", "chat",
+         "message", "later", "sounds", "good", "see", "ok", "why", "when", "where", "who", "latency", "ship")
+
+def chat_messages(size: int, count: int) -> list:
+    generator = random.Random(size)
+    messages = []
+    for i in range(count):
+        words = []
+        while sum(len(word) + 1 for word in words) < size:
+            words.append(generator.choice(WORDS))
+        messages.append(f"[user{i % 7}]: {' '.join(words)}"[:size].encode("utf-8"))
+    return messages
+
+def wire_cost(messages: list, mode: str, level: int) -> dict:
+    """
+    returns:
+        dict: Bytes on the wire and microseconds to compress and to inflate, per message.
+    """
+    deflater = protocol.Deflater(level, context=(mode == "stream"))
+    inflater = protocol.Inflater()
+    frames = []
+    start = time.perf_counter()
+    for payload in messages:
+        if mode == "none":
+            frames.append(protocol.encode_frame(protocol.CHAT, payload))
+        else:
+            data, flags = deflater.compress(payload)
+            frames.append(protocol.encode_frame(protocol.CHAT, data, flags))
+    compress_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for msg_type, flags, payload in protocol.FrameParser().feed(b"".join(frames)):
+        inflater.decompress(payload, flags)
+    inflate_seconds = time.perf_counter() - start
+    return {
+        "bytes": sum(len(frame) for frame in frames) / len(messages),
+        "compress_us": compress_seconds / len(messages) * 1e6,
+        "inflate_us": inflate_seconds / len(messages) * 1e6,
+    }
+
+def per_recipient_fan_out(room: chat.Chat, from_client, message: str):
+    """Compressing for every recipient with its own streaming context, nothing is shared."""
+    for client in room.chat_clients:
+        if client is not from_client:
+            client.send_frame(protocol.CHAT, f"[{from_client.client_name}]: {message}", sender=from_client)
+
+def fan_out_cost(size: int, messages: list, dispatch) -> float:
+    """
+    returns:
+        float: Microseconds to queue one message to the whole room.
+    """
+    room = build_room(size)
+    for client in room.chat_clients:
+        client.enable_compression()
+    sender = room.chat_clients[0]
+    elapsed = 0.0
+    for payload in messages:
+        start = time.perf_counter()
+        dispatch(room, sender, payload.decode("utf-8"))
+        elapsed += time.perf_counter() - start
+        drain(room)
+    return elapsed / len(messages) * 1e6
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="64,256,1024,4096", help="message sizes in bytes")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--level", type=int, default=6, help="zlib compression level")
+    parser.add_argument("--room-size", type=int, default=100)
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    print(f"{'size':>5} | {'mode':>10} | {'wire bytes':>10} | {'ratio':>5} | {'compress us':>11} | {'inflate us':>10}")
+    for size in sizes:
+        messages = chat_messages(size, args.messages)
+        plain = None
+        for mode in ("none", "standalone", "stream"):
+            result = wire_cost(messages, mode, args.level)
+            plain = plain or result["bytes"]
+            print(f"{size:>5} | {mode:>10} | {result['bytes']:>10.1f} | {result['bytes'] / plain:>5.2f} | "
+                  f"{result['compress_us']:>11.2f} | {result['inflate_us']:>10.2f}")
+
+    print()
+    print(f"fan-out to {args.room_size} compressing members, us per message")
+    print(f"{'size':>5} | {'shared frame':>12} | {'per recipient':>13}")
+    for size in sizes:
+        messages = chat_messages(size, min(args.messages, 200))
+        shared = fan_out_cost(args.room_size, messages, chat.Chat.dispatch)
+        per_recipient = fan_out_cost(args.room_size, messages, per_recipient_fan_out)
+        print(f"{size:>5} | {shared:>12.1f} | {per_recipient:>13.1f}")
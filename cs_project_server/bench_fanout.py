@@ -0,0 +1,86 @@
+"""
+Micro-benchmark of room fan-out.
+Compares the encode-once path (Chat.dispatch) with encoding the frame again for every recipient,
+and reports the memory allocated and the distinct frame buffers created per delivered message.
+
+usage: python bench_fanout.py [--messages 200] [--sizes 2,10,100,1000] [--message-size 200]
+"""
+import argparse
+import time
+import tracemalloc
+import shared_data
+import protocol
+import chat
+from client_handler import Client
+
+class _NullLoop:
+    """Stands in for the event loop so nothing is written, the chats start no manager threads and timers never fire."""
+    def schedule_write(self, client):
+        pass
+
+    def update_interest(self, client):
+        pass
+
+    def call_later(self, delay, callback):
+        pass
+
+def build_room(size: int) -> chat.Chat:
+    loop = _NullLoop()
+    shared_data.event_loop = loop
+    chat.Chat._max_chat_size = size
+    room = chat.Chat()
+    for i in range(size):
+        client = Client(("bench", i), object(), client_id=i, client_name=f"user{i}")
+        client.loop = loop
+        room.add_client(client)
+    return room
+
+def per_recipient_dispatch(room: chat.Chat, from_client: Client, message: str):
+    """The previous behaviour: build and encode the message again for every recipient."""
+    for other_client in room.chat_clients:
+        if other_client is not from_client:
+            other_client.send(protocol.encode_frame(protocol.CHAT, f"[{from_client.client_name}]: {message}"), from_client)
+
+def drain(room: chat.Chat):
+    for client in room.chat_clients:
+        client.outbound.consume(client.outbound.size)
+
+def measure(room: chat.Chat, dispatch, messages: int, message: str) -> dict:
+    sender = room.chat_clients[0]
+    recipients = len(room.chat_clients) - 1
+    allocated = 0
+    buffers = 0
+    elapsed = 0.0
+    tracemalloc.start()
+    for _ in range(messages):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        dispatch(room, sender, message)
+        elapsed += time.perf_counter() - start
+        allocated += tracemalloc.get_traced_memory()[1] - before
+        buffers += len({id(frame) for client in room.chat_clients for frame in client.outbound.frames})
+        drain(room)
+    tracemalloc.stop()
+    delivered = messages * recipients
+    return {
+        "bytes_per_delivery": allocated / delivered,
+        "buffers_per_message": buffers / messages,
+        "us_per_delivery": elapsed / delivered * 1e6,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--sizes", default="2,10,100,1000")
+    parser.add_argument("--message-size", type=int, default=200)
+    args = parser.parse_args()
+    message = "x" * args.message_size
+
+    print(f"{'room size':>10} | {'path':>13} | {'bytes/delivery':>14} | {'buffers/msg':>11} | {'us/delivery':>11}")
+    for size in (int(size) for size in args.sizes.split(",")):
+        room = build_room(size)
+        for name, dispatch in (("encode-once", chat.Chat.dispatch), ("per-recipient", per_recipient_dispatch)):
+            result = measure(room, dispatch, args.messages, message)
+            print(f"{size:>10} | {name:>13} | {result['bytes_per_delivery']:>14.1f} | "
+                  f"{result['buffers_per_message']:>11.1f} | {result['us_per_delivery']:>11.2f}")
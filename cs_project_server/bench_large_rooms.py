@@ -0,0 +1,87 @@
+"""
+Benchmark of large rooms.
+Measures the cost of one chat message as the room grows, which should stay linear in the members,
+and what a crowd joining the room costs with batched and with immediate presence notifications.
+
+usage: python bench_large_rooms.py [--sizes 10,100,1000,5000] [--messages 200]
+"""
+import argparse
+import time
+import shared_data
+import chat
+from bench_fanout import build_room, drain
+from client_handler import Client
+
+class _TimerLoop:
+    """Stands in for the event loop, timers only run when the benchmark fires them."""
+    def __init__(self):
+        self.timers = []
+
+    def schedule_write(self, client):
+        pass
+
+    def update_interest(self, client):
+        pass
+
+    def call_later(self, delay, callback):
+        self.timers.append(callback)
+
+    def fire(self):
+        timers, self.timers = self.timers, []
+        for callback in timers:
+            callback()
+
+def message_cost(size: int, messages: int) -> dict:
+    room = build_room(size)
+    sender = room.chat_clients[0]
+    elapsed = 0.0
+    for _ in range(messages):
+        start = time.perf_counter()
+        room.dispatch(sender, "x" * 64)
+        elapsed += time.perf_counter() - start
+        drain(room)
+    return {"us_per_message": elapsed / messages * 1e6, "ns_per_member": elapsed / messages / (size - 1) * 1e9}
+
+def join_cost(size: int, interval: float) -> dict:
+    """
+    Let size clients join one by one, firing the presence timer every 100 joins as if they trickled in.
+    """
+    loop = _TimerLoop()
+    shared_data.event_loop = loop
+    chat.PRESENCE_INTERVAL = interval
+    chat.Chat._max_chat_size = size
+    room = chat.Chat()
+    clients = [Client(("bench", i), object(), client_id=i, client_name=f"user{i}") for i in range(size)]
+    start = time.perf_counter()
+    for i, client in enumerate(clients):
+        client.loop = loop
+        # Immediate notifications queue up to size frames per member, more than a slow consumer may have.
+        client.outbound.high_watermark = size * 1024
+        room.add_client(client)
+        room.notify_presence(client, "joined")
+        if i % 100 == 99:
+            loop.fire()
+    loop.fire()
+    elapsed = time.perf_counter() - start
+    frames = sum(len(member.outbound) for member in room.chat_clients)
+    drain(room)
+    return {"ms": elapsed * 1000, "frames": frames}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,100,1000,5000")
+    parser.add_argument("--messages", type=int, default=200)
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    print(f"{'members':>8} | {'us/message':>10} | {'ns/member':>9}")
+    for size in sizes:
+        result = message_cost(size, args.messages)
+        print(f"{size:>8} | {result['us_per_message']:>10.1f} | {result['ns_per_member']:>9.0f}")
+
+    print()
+    print(f"{'members':>8} | {'presence':>9} | {'join all ms':>11} | {'frames queued':>13}")
+    for size in sizes:
+        for name, interval in (("immediate", 0), ("batched", 1)):
+            result = join_cost(size, interval)
+            print(f"{size:>8} | {name:>9} | {result['ms']:>11.1f} | {result['frames']:>13}")
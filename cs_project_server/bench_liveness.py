@@ -0,0 +1,80 @@
+"""
+Benchmark of the liveness checks.
+Watches many idle connections that answer every ping, and advances a simulated clock one tick at a time.
+Reports the time one tick of checks takes with the timer wheel, which only visits the connections that are due,
+and with a scan of every registered client on each tick. The wheel's cost per tick should not depend on the
+number of idle connections beyond the share of them that is due in that tick.
+
+usage: python bench_liveness.py [--sizes 1000,10000,100000] [--seconds 60] [--scan-ticks 5]
+"""
+import argparse
+import time
+import shared_data
+import chat
+import connection
+from connection import ConnectionHandler
+from client_handler import Client
+from timer_wheel import TimerWheel
+from utils import PING_INTERVAL, LIVENESS_TICK
+
+class _Clock:
+    now = 0.0
+
+def idle_clients(size: int, clock: _Clock) -> list:
+    """
+    Connections spread evenly over one ping interval, each answering a ping right away.
+    """
+    clients = []
+    for i in range(size):
+        client = Client(("bench", i), object(), client_id=i, client_name=f"user{i}")
+        client.last_seen = clock.now - PING_INTERVAL * i / size
+        client.send_frame = lambda msg_type, payload, sender=None, client=client: setattr(client, "last_seen", clock.now)
+        clients.append(client)
+    return clients
+
+def wheel_cost(size: int, seconds: float) -> dict:
+    clock = _Clock()
+    clock.now = time.monotonic()
+    connection.liveness_checks = TimerWheel(LIVENESS_TICK)
+    for client in idle_clients(size, clock):
+        connection.liveness_checks.schedule(ConnectionHandler.check_liveness(client, clock.now)[1], client, clock.now)
+    ticks = []
+    for _ in range(int(seconds / LIVENESS_TICK)):
+        clock.now += LIVENESS_TICK
+        start = time.perf_counter()
+        ConnectionHandler.remove_disconnected_clients(clock.now)
+        ticks.append(time.perf_counter() - start)
+    return {"avg_ms": sum(ticks) / len(ticks) * 1000, "max_ms": max(ticks) * 1000, "watched": len(connection.liveness_checks)}
+
+def scan_cost(size: int, ticks: int) -> dict:
+    """The alternative: look at every registered client on every tick."""
+    clock = _Clock()
+    clock.now = time.monotonic()
+    clients = idle_clients(size, clock)
+    for client in clients:
+        shared_data.registry.add_client(client)
+    elapsed = []
+    for _ in range(ticks):
+        clock.now += LIVENESS_TICK
+        start = time.perf_counter()
+        for client in shared_data.registry.all_clients():
+            ConnectionHandler.check_liveness(client, clock.now)
+        elapsed.append(time.perf_counter() - start)
+    for client in clients:
+        shared_data.registry.remove_client(client)
+    return {"avg_ms": sum(elapsed) / len(elapsed) * 1000, "max_ms": max(elapsed) * 1000}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--seconds", type=float, default=60, help="simulated seconds of timer wheel ticks")
+    parser.add_argument("--scan-ticks", type=int, default=5, help="ticks of the full scan, 0 to skip it")
+    args = parser.parse_args()
+
+    print(f"ping interval {PING_INTERVAL:g}s, tick {LIVENESS_TICK:g}s")
+    print(f"{'connections':>11} | {'wheel avg ms':>12} | {'wheel max ms':>12} | {'scan avg ms':>11} | {'scan max ms':>11}")
+    for size in (int(size) for size in args.sizes.split(",")):
+        wheel = wheel_cost(size, args.seconds)
+        assert wheel["watched"] == size, "a connection was dropped"
+        scan = scan_cost(size, args.scan_ticks) if args.scan_ticks else {"avg_ms": 0.0, "max_ms": 0.0}
+        print(f"{size:>11} | {wheel['avg_ms']:>12.3f} | {wheel['max_ms']:>12.3f} | {scan['avg_ms']:>11.3f} | {scan['max_ms']:>11.3f}")
@@ -0,0 +1,127 @@
+"""
+Benchmark of the lobby's room list.
+Fills the server with open rooms, then answers lobby requests for the room list the previous way, building the text of
+every room for each request, and from the cached versioned pages, with one room changing every --change-every requests
+so the cache is rebuilt as it would be on a busy server. Then measures what a room change costs when it is pushed as
+a ROOM_UPDATE frame to the subscribed lobby clients, against each of them asking for the whole list again.
+
+usage: python bench_lobby.py [--rooms 1000,10000,100000] [--members 3] [--requests 2000] [--change-every 10] [--subscribers 10000]
+"""
+import argparse
+import logging
+import time
+import utils
+import shared_data
+import chat
+import lobby
+from client_handler import Client
+
+class _QuietLoop:
+    """Stands in for the event loop: nothing is written, no manager threads, timers never fire."""
+    def schedule_write(self, client):
+        pass
+
+    def update_interest(self, client):
+        pass
+
+    def call_later(self, delay, callback):
+        pass
+
+def fill(rooms: int, members: int) -> list:
+    """
+    Open rooms with members clients each, one seat left, recorded in a fresh room list.
+    returns:
+        list: The rooms.
+    """
+    loop = _QuietLoop()
+    shared_data.event_loop = loop
+    shared_data.registry = shared_data.Registry()
+    lobby.room_list = lobby.RoomList(interval=0)
+    shared_data.registry.room_listeners.append(lobby.room_list.on_room)
+    chat.Chat._max_chat_size = members + 1
+    client_id = 0
+    opened = []
+    for _ in range(rooms):
+        room = chat.Chat()
+        shared_data.registry.add_room(room)
+        for _ in range(members):
+            client = Client(("bench", client_id), object(), client_id=client_id, client_name=f"user{client_id}")
+            client.loop = loop
+            room.add_client(client)
+            client_id += 1
+        opened.append(room)
+    return opened
+
+def legacy_list() -> str:
+    """The previous list_available_rooms: the text of every open room, built for each request."""
+    available_rooms = [str(room) + "\n" for room in shared_data.registry.available_rooms()]
+    return ", ".join(available_rooms) if available_rooms else "No available rooms"
+
+def change(room: chat.Chat, number: int):
+    """A member leaves and another joins, the room's label changes twice."""
+    member = room.chat_clients[-1]
+    room.remove_client(member)
+    member.client_name = f"renamed{number}"
+    room.add_client(member)
+
+def request_cost(rooms: list, requests: int, change_every: int, answer) -> dict:
+    elapsed = 0.0
+    size = 0
+    for i in range(requests):
+        if i % change_every == 0:
+            change(rooms[i % len(rooms)], i)
+        start = time.perf_counter()
+        text = answer()
+        elapsed += time.perf_counter() - start
+        size += len(text)
+    return {"us": elapsed / requests * 1e6, "bytes": size // requests}
+
+def push_cost(rooms: list, subscribers: int, changes: int) -> dict:
+    """
+    Time to record a room change and queue it to every subscriber, and the bytes each of them gets per change.
+    """
+    loop = shared_data.event_loop
+    clients = []
+    for i in range(subscribers):
+        client = Client(("lobby", i), object(), client_id=-1 - i, client_name=f"idle{i}")
+        client.loop = loop
+        shared_data.registry.add_client(client)
+        lobby.room_list.subscribe(client)
+        clients.append(client)
+    elapsed = 0.0
+    received = 0
+    for i in range(changes):
+        start = time.perf_counter()
+        change(rooms[i % len(rooms)], i)
+        elapsed += time.perf_counter() - start
+        received += clients[0].outbound.size
+        for client in clients:
+            client.outbound.consume(client.outbound.size)
+    list_bytes = len(legacy_list().encode("utf-8"))
+    return {"us": elapsed / changes * 1e6, "bytes": received // changes, "list_bytes": list_bytes}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", default="1000,10000,100000")
+    parser.add_argument("--members", type=int, default=3, help="members of each room")
+    parser.add_argument("--requests", type=int, default=2000, help="room list requests per variant")
+    parser.add_argument("--change-every", type=int, default=10, help="requests between two room changes")
+    parser.add_argument("--subscribers", type=int, default=10000, help="lobby clients subscribed to the changes")
+    parser.add_argument("--changes", type=int, default=100, help="room changes pushed to the subscribers")
+    args = parser.parse_args()
+    # Every join and leave logs a line, bench_logging measures that.
+    utils.logger.setLevel(logging.WARNING)
+
+    print(f"{'rooms':>7} | {'list':>8} | {'us/request':>10} | {'bytes/reply':>11}")
+    for rooms in (int(rooms) for rooms in args.rooms.split(",")):
+        opened = fill(rooms, args.members)
+        for name, answer in (("rebuilt", legacy_list), ("cached", lobby.room_list.text)):
+            result = request_cost(opened, args.requests if name == "cached" else max(1, args.requests // 10), args.change_every, answer)
+            print(f"{rooms:>7} | {name:>8} | {result['us']:>10.1f} | {result['bytes']:>11}")
+
+    # With the rooms of the last size.
+    push = push_cost(opened, args.subscribers, args.changes)
+    print()
+    print(f"{args.subscribers} subscribed lobby clients, {rooms} rooms")
+    print(f"{'us/change':>10} | {'bytes/subscriber':>16} | {'whole list bytes':>16}")
+    print(f"{push['us']:>10.1f} | {push['bytes']:>16} | {push['list_bytes']:>16}")
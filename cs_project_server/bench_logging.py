@@ -0,0 +1,60 @@
+"""
+Benchmark of the message path with the different logging setups.
+Pushes chat frames through ConnectionHandler.handle_frame into a two client room and reports
+the messages handled per second, and how long the log writer needed to catch up afterwards.
+
+usage: python bench_logging.py [--messages 50000] [--message-size 64]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import utils
+import protocol
+import shared_data
+from bench_fanout import build_room, drain
+import connection
+
+# name: (async writer, level, log every Nth message in full, 0 for summaries only)
+MODES = {
+    "off": (True, "WARNING", 0),
+    "sync, every message": (False, "DEBUG", 1),
+    "async, every message": (True, "DEBUG", 1),
+    "async, summaries": (True, "INFO", 0),
+}
+
+def run_mode(async_mode: bool, level: str, sample_every: int, messages: int, payload: bytes) -> dict:
+    utils.close_logger(utils.logger)
+    utils.setup_logger(utils.logger.name, level, async_mode)
+    connection.message_log.sample_every = sample_every
+    connection.message_log.interval = 1
+    room = build_room(2)
+    shared_data.registry.add_room(room)
+    sender = room.chat_clients[0]
+    start = time.perf_counter()
+    for i in range(messages):
+        connection.ConnectionHandler.handle_frame(sender, protocol.CHAT, payload)
+        if i % 1000 == 0:
+            drain(room)
+    elapsed = time.perf_counter() - start
+    flush_start = time.perf_counter()
+    utils.close_logger(utils.logger)
+    shared_data.registry.remove_room(room)
+    return {"messages_per_s": messages / elapsed, "flush_s": time.perf_counter() - flush_start}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--message-size", type=int, default=64)
+    args = parser.parse_args()
+    payload = b"x" * args.message_size
+
+    os.chdir(tempfile.mkdtemp(prefix="bench_logging"))
+    console, sys.stderr = sys.stderr, open(os.devnull, "w")
+    results = {name: run_mode(*mode, args.messages, payload) for name, mode in MODES.items()}
+    sys.stderr = console
+
+    print(f"{'logging':>22} | {'messages/s':>10} | {'writer flush s':>14}")
+    for name, result in results.items():
+        print(f"{name:>22} | {result['messages_per_s']:>10.0f} | {result['flush_s']:>14.3f}")
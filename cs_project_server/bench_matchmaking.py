@@ -0,0 +1,113 @@
+"""
+Benchmark of matchmaking.
+Seats a crowd of waiting users in open rooms, timing the upkeep of the indexes as they join, then measures the
+time-to-match of lobby requests, half 'any' and half 'with <name>' of a random waiting user: with the registry's indexes
+(ConnectionHandler.assign_client_to_room_by_users), and with a scan of the open rooms and their members as a lookup
+without them would do. The time covers the lookup and the join, up to the JOIN frame queued to the client.
+A 'with' request for a user whose room filled up in the meantime is not matched.
+
+usage: python bench_matchmaking.py [--waiting 100000] [--room-size 4] [--requests 10000] [--scan-requests 200]
+"""
+import argparse
+import logging
+import random
+import time
+import utils
+import shared_data
+import chat
+from connection import ConnectionHandler
+from client_handler import Client
+
+class _QuietLoop:
+    """Stands in for the event loop: nothing is written, no manager threads, presence timers never fire."""
+    def schedule_write(self, client):
+        pass
+
+    def update_interest(self, client):
+        pass
+
+    def call_later(self, delay, callback):
+        pass
+
+def seat_waiting(waiting: int, room_size: int, seed: int) -> tuple:
+    """
+    Put waiting users in fresh rooms of 1 to room_size - 1 members, all of them open.
+    returns:
+        tuple: (the waiting users' names, seconds it took).
+    """
+    loop = _QuietLoop()
+    shared_data.event_loop = loop
+    shared_data.registry = shared_data.Registry()
+    chat.Chat._max_chat_size = room_size
+    rng = random.Random(seed)
+    clients = [Client(("waiting", i), object(), client_id=i, client_name=f"user{i}") for i in range(waiting)]
+    start = time.perf_counter()
+    room = None
+    seats = 0
+    for client in clients:
+        if seats == 0:
+            room = chat.Chat()
+            shared_data.registry.add_room(room)
+            seats = rng.randint(1, room_size - 1)
+        client.loop = loop
+        room.add_client(client)
+        seats -= 1
+    return [client.client_name for client in clients], time.perf_counter() - start
+
+def scan_match(names: list):
+    """The lookup without indexes: every open room, and every member of the candidates, for each request."""
+    best = None
+    for room in shared_data.registry.available_rooms():
+        if names and not set(names) <= {client.client_name for client in room.chat_clients}:
+            continue
+        if best is None or len(room.members) > len(best.members):
+            best = room
+    return best
+
+def scan_assign(client: Client, names: list) -> bool:
+    room = scan_match(names)
+    return room is not None and ConnectionHandler.assign_client_to_room_by_id(client, room.chat_id)
+
+def run(assign, waiting: int, room_size: int, requests: int, seed: int) -> dict:
+    names, seat_seconds = seat_waiting(waiting, room_size, seed)
+    rng = random.Random(seed + 1)
+    loop = shared_data.event_loop
+    times = []
+    matched = 0
+    for i in range(requests):
+        client = Client(("joining", i), object(), client_id=waiting + i, client_name=f"joiner{i}")
+        client.loop = loop
+        shared_data.registry.add_client(client)
+        wanted = [rng.choice(names)] if i % 2 else None
+        start = time.perf_counter()
+        if assign(client, wanted):
+            matched += 1
+        times.append(time.perf_counter() - start)
+        client.outbound.consume(client.outbound.size)
+    times.sort()
+    return {
+        "seat_ms": seat_seconds * 1000,
+        "matched": matched,
+        "mean_us": sum(times) / len(times) * 1e6,
+        "p50_us": times[len(times) // 2] * 1e6,
+        "p99_us": times[min(len(times) - 1, len(times) * 99 // 100)] * 1e6,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--waiting", type=int, default=100000, help="users waiting in open rooms")
+    parser.add_argument("--room-size", type=int, default=4, help="seats per room")
+    parser.add_argument("--requests", type=int, default=10000, help="matchmaking requests with the indexes")
+    parser.add_argument("--scan-requests", type=int, default=200, help="matchmaking requests with the scan")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    # Every join logs a line, bench_logging measures that.
+    utils.logger.setLevel(logging.WARNING)
+
+    print(f"{args.waiting} waiting users, rooms of {args.room_size}")
+    print(f"{'lookup':>7} | {'requests':>8} | {'matched':>7} | {'seat all ms':>11} | {'mean us':>9} | {'p50 us':>9} | {'p99 us':>9}")
+    for name, assign, requests in (("indexed", ConnectionHandler.assign_client_to_room_by_users, args.requests),
+                                   ("scan", scan_assign, args.scan_requests)):
+        result = run(assign, args.waiting, args.room_size, requests, args.seed)
+        print(f"{name:>7} | {requests:>8} | {result['matched']:>7} | {result['seat_ms']:>11.1f} | "
+              f"{result['mean_us']:>9.1f} | {result['p50_us']:>9.1f} | {result['p99_us']:>9.1f}")
@@ -0,0 +1,141 @@
+"""
+Benchmark of the rate limits.
+First the cost of the limiter state: the memory of a token bucket for every connection and the time to charge a frame.
+Then starts the server in this process and lets one client flood its room with chat messages as fast as its socket
+takes them, under each policy. Reports the frames the client got onto the wire, the chat messages the server handled
+per second against the configured rate, the frames counted as throttled, and what happened to the flooding client.
+
+usage: python bench_rate_limit.py [--connections 100000] [--rate 20] [--seconds 5] [--mode loop]
+"""
+import argparse
+import selectors
+import socket
+import threading
+import time
+import tracemalloc
+import shared_data
+import protocol
+import chat
+import event_loop
+import metrics
+import rate_limit
+from connection import ConnectionHandler
+
+def state_cost(connections: int) -> dict:
+    limit = rate_limit.RateLimit(20, 64 * 1024)
+    tracemalloc.start()
+    buckets = [limit.bucket() for _ in range(connections)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    now = time.monotonic()
+    for bucket in buckets:
+        limit.take(bucket, 100, now)
+    elapsed = time.perf_counter() - start
+    return {"bytes": size / connections, "take_us": elapsed / connections * 1e6}
+
+def start_server(mode: str) -> tuple:
+    """
+    returns:
+        tuple: (port, stop callback).
+    """
+    listener = ConnectionHandler.start_server("127.0.0.1", 0)
+    port = listener.getsockname()[1]
+    if mode == "threaded":
+        shared_data.event_loop = None
+        threading.Thread(target=ConnectionHandler.handle_new_client_connections, args=(listener,), daemon=True).start()
+        return port, lambda: None
+    loop = event_loop.EventLoop(listener)
+    thread = threading.Thread(target=loop.run)
+    thread.start()
+
+    def stop():
+        loop.stop()
+        thread.join()
+        listener.close()
+        shared_data.event_loop = None
+    return port, stop
+
+def join_new_room(port: int) -> socket.socket:
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.sendall(protocol.encode_frame(protocol.CHAT, "flooder") + protocol.encode_frame(protocol.CHAT, "new"))
+    parser = protocol.FrameParser()
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            raise ConnectionError("closed during the handshake")
+        if any(msg_type == protocol.JOIN for msg_type, flags, payload in parser.feed(data)):
+            return sock
+
+def flood(port: int, seconds: float, size: int) -> dict:
+    """
+    Send chat frames as fast as the socket takes them, reading whatever the server sends back.
+    returns:
+        dict: The frames written, the notices received and whether the server closed the connection.
+    """
+    sock = join_new_room(port)
+    sock.setblocking(False)
+    frame = protocol.encode_frame(protocol.CHAT, "x" * size)
+    stream = frame * 256
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+    parser = protocol.FrameParser()
+    written = notices = 0
+    closed = False
+    deadline = time.monotonic() + seconds
+    while not closed and time.monotonic() < deadline:
+        for key, events in selector.select(0.05):
+            if events & selectors.EVENT_READ:
+                try:
+                    data = sock.recv(65536)
+                except ConnectionError:
+                    data = b""
+                if not data:
+                    closed = True
+                    break
+                notices += sum(1 for msg_type, flags, payload in parser.feed(data) if msg_type == protocol.SYSTEM)
+            if events & selectors.EVENT_WRITE:
+                offset = written * len(frame) % len(stream)
+                try:
+                    written += sock.send(stream[offset:]) // len(frame)
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    closed = True
+                    break
+    selector.close()
+    sock.close()
+    return {"written": written, "notices": notices, "closed": closed}
+
+def run(mode: str, policy: str, rate: float, seconds: float, size: int) -> dict:
+    rate_limit.client_limit = rate_limit.RateLimit(rate, 0, policy=policy)
+    port, stop = start_server(mode)
+    handled = metrics.MESSAGES.value
+    throttled = sum(child.value for child in list(metrics.THROTTLED.children.values()))
+    result = flood(port, seconds, size)
+    result["handled_per_second"] = (metrics.MESSAGES.value - handled) / seconds
+    result["throttled"] = sum(child.value for child in list(metrics.THROTTLED.children.values())) - throttled
+    deadline = time.monotonic() + 5
+    while shared_data.registry.connection_count() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    stop()
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=100000, help="buckets for the state cost")
+    parser.add_argument("--rate", type=float, default=20, help="messages per second allowed to the flooding client")
+    parser.add_argument("--seconds", type=float, default=5, help="seconds of flooding per policy")
+    parser.add_argument("--size", type=int, default=64, help="chat message size in bytes")
+    parser.add_argument("--mode", default="loop", choices=("loop", "threaded"))
+    args = parser.parse_args()
+
+    cost = state_cost(args.connections)
+    print(f"{args.connections} buckets: {cost['bytes']:.0f} bytes and {cost['take_us']:.2f} us to charge a frame per connection")
+    print()
+    print(f"one client flooding at full speed, limit {args.rate:g} messages/s, {args.mode} server")
+    print(f"{'policy':>10} | {'written':>8} | {'handled/s':>9} | {'throttled':>9} | {'notices':>7} | {'closed':>6}")
+    for policy in rate_limit.POLICIES:
+        result = run(args.mode, policy, args.rate, args.seconds, args.size)
+        print(f"{policy:>10} | {result['written']:>8} | {result['handled_per_second']:>9.1f} | {result['throttled']:>9} | "
+              f"{result['notices']:>7} | {str(result['closed']):>6}")
@@ -0,0 +1,107 @@
+"""
+Benchmark of the receive path.
+Streams small chat frames through a socket pair as fast as a writer thread can send them, and parses them on this
+thread the old way, recv() of MAX_BUFFER_SIZE bytes appended to a growing bytearray with every payload copied out,
+and the pooled way, recv_into() a buffer borrowed from the pool with the payloads parsed in place and only decoded.
+Reports the CPU time of the reading thread per message and the reads it took, then repeats the run under tracemalloc
+for the peak memory allocated while parsing.
+
+usage: python bench_receive.py [--messages 200000] [--sizes 16,64,256] [--read-size 1024]
+"""
+import argparse
+import socket
+import threading
+import time
+import tracemalloc
+import protocol
+from protocol import HEADER, HEADER_SIZE, PROTOCOL_VERSION
+
+class LegacyParser:
+    """The parser before the buffer pool: a bytearray per connection and a bytes copy of every payload."""
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> list:
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        offset = 0
+        end = len(buffer)
+        while end - offset >= HEADER_SIZE:
+            version, msg_type, flags, length = HEADER.unpack_from(buffer, offset)
+            if version != PROTOCOL_VERSION:
+                raise protocol.ProtocolError(f"Unsupported protocol version {version}")
+            frame_end = offset + HEADER_SIZE + length
+            if frame_end > end:
+                break
+            frames.append((msg_type, flags, bytes(buffer[offset + HEADER_SIZE:frame_end])))
+            offset = frame_end
+        if offset:
+            del buffer[:offset]
+        return frames
+
+def legacy_reader(sock: socket.socket, read_size: int) -> tuple:
+    parser = LegacyParser()
+    messages = reads = 0
+    while True:
+        data = sock.recv(read_size)
+        reads += 1
+        if not data:
+            return messages, reads
+        for msg_type, flags, payload in parser.feed(data):
+            payload.decode("utf-8")
+            messages += 1
+
+def pooled_reader(sock: socket.socket, read_size: int) -> tuple:
+    parser = protocol.FrameParser()
+    messages = reads = 0
+    while True:
+        received = parser.recv_from(sock)
+        reads += 1
+        if not received:
+            return messages, reads
+        for msg_type, flags, payload in parser.frames():
+            str(payload, "utf-8")
+            messages += 1
+
+def stream(size: int, messages: int) -> bytes:
+    frames = [protocol.encode_frame(protocol.CHAT, f"[user{i % 7}]: ".encode("utf-8").ljust(size, b"x")) for i in range(100)]
+    return b"".join(frames) * (messages // 100)
+
+def run(reader, data: bytes, read_size: int, traced: bool = False) -> dict:
+    reading, writing = socket.socketpair()
+
+    def write():
+        writing.sendall(data)
+        writing.close()
+    writer = threading.Thread(target=write)
+    if traced:
+        tracemalloc.start()
+    writer.start()
+    start = time.thread_time()
+    messages, reads = reader(reading, read_size)
+    cpu = time.thread_time() - start
+    peak = 0
+    if traced:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    writer.join()
+    reading.close()
+    return {"messages": messages, "cpu_us": cpu / messages * 1e6, "reads": reads, "peak_kib": peak / 1024}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--sizes", default="16,64,256", help="payload sizes in bytes")
+    parser.add_argument("--read-size", type=int, default=1024, help="bytes per recv() of the old path, MAX_BUFFER_SIZE")
+    args = parser.parse_args()
+
+    print(f"pooled buffers of {protocol.RECV_BUFFER_SIZE} bytes, recv() of {args.read_size} bytes on the old path")
+    print(f"{'size':>5} | {'path':>6} | {'cpu us/msg':>10} | {'reads':>7} | {'peak KiB':>8}")
+    for size in (int(size) for size in args.sizes.split(",")):
+        data = stream(size, args.messages)
+        for name, reader in (("legacy", legacy_reader), ("pooled", pooled_reader)):
+            result = run(reader, data, args.read_size)
+            assert result["messages"] == args.messages // 100 * 100, "messages were lost"
+            peak = run(reader, data, args.read_size, traced=True)["peak_kib"]
+            print(f"{size:>5} | {name:>6} | {result['cpu_us']:>10.2f} | {result['reads']:>7} | {peak:>8.1f}")
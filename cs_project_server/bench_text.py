@@ -0,0 +1,30 @@
+"""
+Benchmark of the text decoding on the receive path.
+Reports the decoding time per message of valid multilingual text (Hebrew, emoji, combining marks, CJK),
+strict str() against decode_text(). The split and malformed payload checks are in test_protocol.py.
+
+usage: python bench_text.py [--messages 100000]
+"""
+import argparse
+import time
+import protocol
+from text_samples import MESSAGES
+
+def decode_cost(messages: int) -> dict:
+    payloads = [message.encode("utf-8") for message in MESSAGES] * (messages // len(MESSAGES))
+    results = {}
+    for name, decode in (("str()", lambda payload: str(payload, "utf-8")), ("decode_text", protocol.decode_text)):
+        start = time.perf_counter()
+        for payload in payloads:
+            decode(memoryview(payload))
+        results[name] = (time.perf_counter() - start) / len(payloads) * 1e6
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=100000, help="messages decoded for the timing")
+    args = parser.parse_args()
+
+    print(f"{'decoder':>11} | {'us/msg':>6}")
+    for name, cost in decode_cost(args.messages).items():
+        print(f"{name:>11} | {cost:>6.3f}")
@@ -0,0 +1,184 @@
+"""
+Swarm test of the zero-downtime upgrade.
+Starts the server as a subprocess with an upgrade socket, connects a swarm of clients in rooms of two that chat
+continuously, numbering their messages, then starts new server processes that take over one after the other.
+Checks that no connection dropped and every message was delivered exactly once and in order, and reports how long
+each upgrade took and the worst delivery latency around it.
+
+usage: python bench_upgrade.py [--clients 200] [--rate 5] [--upgrades 2] [--interval 3]
+"""
+import argparse
+import os
+import re
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import protocol
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "socket_server.py")
+
+class SwarmClient:
+    def __init__(self, index: int, port: int):
+        self.index = index
+        self.name = f"swarm{index}"
+        self.socket = socket.create_connection(("127.0.0.1", port))
+        self.parser = protocol.FrameParser()
+        self.peer = None
+        self.sent = 0
+        # The next sequence number expected from the peer, and the delivery problems seen.
+        self.expected = 0
+        self.lost = 0
+        self.duplicated = 0
+        self.closed = False
+
+    def expect(self, pattern) -> str:
+        """Blocking read until a frame matches, used during the handshake."""
+        while True:
+            data = self.socket.recv(65536)
+            if not data:
+                raise ConnectionError(f"{self.name} was closed during the handshake")
+            for msg_type, flags, payload in self.parser.feed(data):
+                match = pattern.search(payload.decode("utf-8"))
+                if match:
+                    return match.group(1)
+
+    def send_next(self):
+        self.socket.sendall(protocol.encode_frame(protocol.CHAT, f"{self.sent} {time.monotonic()}"))
+        self.sent += 1
+
+    def on_readable(self, latencies: list):
+        try:
+            data = self.socket.recv(65536)
+        except ConnectionError:
+            data = b""
+        if not data:
+            self.closed = True
+            return
+        for msg_type, flags, payload in self.parser.feed(data):
+            if msg_type != protocol.CHAT:
+                continue
+            seq, sent_at = payload.decode("utf-8").partition("]: ")[2].split()
+            seq = int(seq)
+            latencies.append((time.monotonic(), time.monotonic() - float(sent_at)))
+            if seq < self.expected:
+                self.duplicated += 1
+                continue
+            self.lost += seq - self.expected
+            self.expected = seq + 1
+
+def start_server(env: dict) -> subprocess.Popen:
+    # stdin stays open, the admin console would end the process on EOF.
+    return subprocess.Popen([sys.executable, SERVER], env=env, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+
+def build_swarm(count: int, port: int) -> list:
+    clients = []
+    for index in range(0, count - count % 2, 2):
+        creator, joiner = SwarmClient(index, port), SwarmClient(index + 1, port)
+        creator.socket.sendall(protocol.encode_frame(protocol.CHAT, creator.name) + protocol.encode_frame(protocol.CHAT, "new"))
+        room_id = creator.expect(re.compile(r"New chat room (\d+) created"))
+        joiner.socket.sendall(protocol.encode_frame(protocol.CHAT, joiner.name) + protocol.encode_frame(protocol.CHAT, room_id))
+        joiner.expect(re.compile(r"Joined chat room (\d+)"))
+        creator.peer, joiner.peer = joiner, creator
+        clients += [creator, joiner]
+    return clients
+
+def chat(clients: list, seconds: float, rate: float, latencies: list, selector: selectors.BaseSelector):
+    """Every client sends rate messages per second, spread over the swarm, and reads whatever arrives. Rate 0 only reads."""
+    interval = 1 / (rate * len(clients)) if rate else 0
+    deadline = time.monotonic() + seconds
+    next_send = time.monotonic() if rate else float("inf")
+    turn = 0
+    while time.monotonic() < deadline:
+        for key, events in selector.select(max(0.0, min(next_send, deadline) - time.monotonic())):
+            key.data.on_readable(latencies)
+            if key.data.closed:
+                selector.unregister(key.fileobj)
+        while next_send <= time.monotonic():
+            client = clients[turn % len(clients)]
+            if not client.closed:
+                try:
+                    client.send_next()
+                except OSError:
+                    client.closed = True
+            turn += 1
+            next_send += interval
+
+def wait_exit(process: subprocess.Popen, timeout: float) -> bool:
+    try:
+        process.wait(timeout)
+        return True
+    except subprocess.TimeoutExpired:
+        return False
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=5, help="messages per second per client")
+    parser.add_argument("--upgrades", type=int, default=2, help="new server processes taking over one after the other")
+    parser.add_argument("--interval", type=float, default=3, help="seconds of chat before, between and after the upgrades")
+    parser.add_argument("--port", type=int, default=0, help="server port, a free one by default")
+    args = parser.parse_args()
+
+    port = args.port
+    if not port:
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+    directory = tempfile.mkdtemp(prefix="chat-upgrade-")
+    env = dict(os.environ, SERVER_PORT=str(port), UPGRADE_SOCKET=os.path.join(directory, "upgrade.sock"),
+               MAX_CONNECTIONS=str(args.clients + 100), METRICS_PORT="0", LOG_LEVEL="WARNING")
+    server = start_server(env)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            break
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+    clients = build_swarm(args.clients, port)
+    selector = selectors.DefaultSelector()
+    for client in clients:
+        client.socket.setblocking(False)
+        selector.register(client.socket, selectors.EVENT_READ, client)
+    latencies = []
+    upgrades = []
+    chat(clients, args.interval, args.rate, latencies, selector)
+    for _ in range(args.upgrades):
+        started = time.monotonic()
+        successor = start_server(env)
+        # Keep chatting while the old process hands over, it exits once the new one has everything.
+        while server.poll() is None and time.monotonic() - started < 30:
+            chat(clients, 0.05, args.rate, latencies, selector)
+        finished = time.monotonic()
+        if not wait_exit(server, 1):
+            server.kill()
+            print("the old server did not exit, the upgrade failed")
+        upgrades.append((started, finished))
+        server = successor
+        chat(clients, args.interval, args.rate, latencies, selector)
+    # Let the last messages arrive.
+    chat(clients, 1, 0, latencies, selector)
+
+    sent = sum(client.sent for client in clients)
+    delivered = sum(client.expected for client in clients)
+    print(f"{len(clients)} clients, {args.upgrades} upgrades, {sent} messages sent")
+    print(f"connections dropped: {sum(client.closed for client in clients)}")
+    print(f"messages lost: {sum(client.lost for client in clients) + sent - delivered}, duplicated: {sum(client.duplicated for client in clients)}")
+    print(f"{'upgrade':>7} | {'seconds':>7} | {'max latency ms':>14}")
+    for number, (started, finished) in enumerate(upgrades, 1):
+        around = [latency for at, latency in latencies if started <= at <= finished + 1]
+        print(f"{number:>7} | {finished - started:>7.3f} | {max(around, default=0.0) * 1000:>14.1f}")
+    steady = [latency for at, latency in latencies if not any(started <= at <= finished + 1 for started, finished in upgrades)]
+    print(f"max latency outside the upgrades: {max(steady, default=0.0) * 1000:.1f} ms")
+    for client in clients:
+        client.socket.close()
+    server.stdin.write(b"exit\n")
+    server.stdin.flush()
+    if not wait_exit(server, 5):
+        server.kill()
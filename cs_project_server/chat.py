@@ -1,22 +1,79 @@
 import threading
-from utils import logger, MAX_BUFFER_SIZE
+from utils import logger, MAX_BUFFER_SIZE, MAX_CHAT_SIZE, PRESENCE_INTERVAL, HISTORY_REPLAY_COUNT
 import socket_server
 import shared_data
+import protocol
+import metrics
+import history
+import rate_limit
 from client_handler import Client
+import queue
 import time
-import os
+
+# Names listed in a room's description and in a batched presence notification.
+LISTED_NAMES = 10
+
+def describe_names(names: list) -> str:
+    """
+    returns:
+        str: The names joined with commas, the ones past LISTED_NAMES summarized as a count.
+    """
+    if len(names) > LISTED_NAMES:
+        return f"{', '.join(names[:LISTED_NAMES])} and {len(names) - LISTED_NAMES} others"
+    if len(names) > 1:
+        return f"{', '.join(names[:-1])} and {names[-1]}"
+    return names[0]
+
+def first_room_id(first: int, step: int) -> int:
+    """
+    Ids are not reused across restarts while the rooms' histories are kept, or a new room would replay the
+    conversation of an unrelated old room with the same id.
+    args:
+        first (int): The first id of the sequence.
+        step (int): Its step.
+    returns:
+        int: The first id of first, first + step, ... past the rooms of the previous runs.
+    """
+    if history.store is None or history.store.next_room_id <= first:
+        return first
+    return first + -(-(history.store.next_room_id - first) // step) * step
 
 class Chat:
-    _chat_id = 1
-    _max_chat_size = os.getenv("MAX_CHAT_SIZE", 2)
-    def __init__(self, client1: Client = None):
-        self.chat_id = Chat._chat_id
-        Chat._chat_id += 1
-        self.chat_clients = []
+    _chat_id = first_room_id(1, 1)
+    # Ids advance by this step, workers of a multi-process server use disjoint id sequences.
+    _chat_id_step = 1
+    _max_chat_size = MAX_CHAT_SIZE
+    def __init__(self, client1: Client = None, chat_id: int = None):
+        """
+        args:
+            client1 (Client): The client creating the room, its first member.
+            chat_id (int): The id of a closed room opened again, a new id by default.
+        """
+        if chat_id is None:
+            chat_id = Chat._chat_id
+            Chat._chat_id += Chat._chat_id_step
+        self.chat_id = chat_id
+        # client_id -> Client, and the tuple the fan-out iterates, rebuilt only when the membership changes.
+        self.members = {}
+        self.chat_clients = ()
+        self._lock = threading.RLock()
         self.full = False
+        # ("joined" | "left", client) events waiting for the next presence notification.
+        self._presence = []
+        self._presence_scheduled = False
+        # (sender, message) pairs pushed by the members' listeners, None tells the manager to stop.
+        self.message_queue = queue.SimpleQueue()
+        # Kept here so counting a message is one increment, no label lookup.
+        self.message_counter = metrics.ROOM_MESSAGES.labels(str(self.chat_id))
+        # Token bucket of the chat messages posted in the room, None without a per room limit.
+        self.rate_bucket = rate_limit.room_limit.bucket()
+        # Persistent log of the chat messages, None unless HISTORY_DIR is set.
+        self.history = history.store.room(self.chat_id) if history.store is not None else None
         if client1:
             self.add_client(client1)
-        threading.Thread(target=self.chatManager).start()
+        if shared_data.event_loop is None:
+            # In event loop mode messages are dispatched by the loop as they arrive.
+            threading.Thread(target=self.chatManager).start()
 
     def add_client(self, client: Client) -> bool:
         """
@@ -27,79 +84,218 @@ class Chat:
         returns:
             bool: True if the client was added, False otherwise.
         """
-        if len(self.chat_clients) < int(Chat._max_chat_size):
-            self.chat_clients.append(client)
+        with self._lock:
+            if len(self.members) >= Chat._max_chat_size:
+                return False
+            self.members[client.client_id] = client
+            self.chat_clients = tuple(self.members.values())
             client.room_id = self.chat_id
-            if len(self.chat_clients) == int(Chat._max_chat_size):
-                self.full = True
-            return True
-        return False
+            self.full = len(self.members) == Chat._max_chat_size
+        shared_data.registry.update_room(self, joined=client)
+        shared_data.registry.update_client(client)
+        return True
 
-    def broadcast(self, message: str):
+    def fan_out(self, frame: bytes, exclude: Client = None):
+        """
+        Queue one already encoded frame to every client in the chat.
+        The same immutable frame object is shared by all the recipients' outbound queues, and so is its compressed variant.
+
+        args:
+            frame (bytes): The encoded frame.
+            exclude (Client): A client that should not receive it, the sender.
+        """
+        variants = {}
         for client in self.chat_clients:
+            if client is exclude:
+                continue
             try:
-                client.socket.sendall(message.encode("utf-8"))
+                client.send_shared(frame, variants, sender=exclude)
             except Exception as e:
                 logger.error(f"Failed to send message to {client.address}: {e}")
+                metrics.SEND_FAILURES.inc()
+                if exclude is not None:
+                    self.remove_client(client)
+
+    def broadcast(self, message: str):
+        self.fan_out(protocol.encode_frame(protocol.SYSTEM, message))
 
     def send_message(self,from_client: Client, to_client: Client, message: str):
         try:
             message = f"[{from_client.client_name}]: {message}"
-            to_client.socket.sendall(message.encode("utf-8"))
+            to_client.send_frame(protocol.CHAT, message, sender=from_client)
         except Exception as e:
             logger.error(f"Failed to send message to {to_client.address}: {e}")
             self.remove_client(to_client)
 
 
     def send_message_to_all(self, message: str):
-        for client in self.chat_clients:
-            try:
-                client.socket.sendall(message.encode("utf-8"))
-            except Exception as e:
-                logger.error(f"Failed to send message to {client.address}: {e}")
+        self.fan_out(protocol.encode_frame(protocol.SYSTEM, message))
+
+    def notify_presence(self, client: Client, event: str):
+        """
+        Tell the members that a client joined or left. Events are batched into one message per PRESENCE_INTERVAL,
+        so a crowd joining a large room costs one fan-out and not one per joiner.
+
+        args:
+            client (Client): The client that joined or left.
+            event (str): "joined" or "left".
+        """
+        with self._lock:
+            self._presence.append((event, client))
+            if self._presence_scheduled:
+                return
+            self._presence_scheduled = True
+        if not PRESENCE_INTERVAL:
+            self.flush_presence()
+        elif shared_data.event_loop is not None:
+            shared_data.event_loop.call_later(PRESENCE_INTERVAL, self.flush_presence)
+        else:
+            timer = threading.Timer(PRESENCE_INTERVAL, self.flush_presence)
+            timer.daemon = True
+            timer.start()
+
+    def flush_presence(self):
+        with self._lock:
+            events, self._presence = self._presence, []
+            self._presence_scheduled = False
+        if not events or not self.members:
+            return
+        if len(events) == 1:
+            event, client = events[0]
+            if event == "joined":
+                # The joiner already knows.
+                self.fan_out(protocol.encode_frame(protocol.SYSTEM, f"{client.client_name} has joined the chat room.\n"), exclude=client)
+            else:
+                self.send_message_to_all(f"{client.client_name} has left the chat.\n")
+            return
+        joined = [client.client_name for event, client in events if event == "joined"]
+        left = [client.client_name for event, client in events if event == "left"]
+        message = ""
+        if joined:
+            message += f"{describe_names(joined)} joined the chat room.\n"
+        if left:
+            message += f"{describe_names(left)} left the chat.\n"
+        self.send_message_to_all(message)
+
+    def dispatch(self, from_client: Client, message: str):
+        """
+        Deliver a message from one client to every other client in the chat.
+        The frame is built and encoded once, not once per recipient.
+
+        args:
+            from_client (Client): The client that sent the message.
+            message (str): The message to deliver.
+        """
+        start = time.perf_counter()
+        frame = protocol.encode_frame(protocol.CHAT, f"[{from_client.client_name}]: {message}")
+        self.fan_out(frame, exclude=from_client)
+        metrics.FANOUT.observe(time.perf_counter() - start)
+        if self.history is not None:
+            self.history.append(frame)
+        metrics.MESSAGES.inc()
+        self.message_counter.inc()
+
+    def replay_history(self, client: Client, last: int = None, since: float = None):
+        """
+        Send the room's recorded messages to a client that just joined, straight from the mapped log segments.
+
+        args:
+            client (Client): The client that joined.
+            last (int): Replay this many of the last messages, defaults to HISTORY_REPLAY_COUNT.
+            since (float): Replay the messages from this unix timestamp on instead.
+        """
+        if self.history is None:
+            return
+        if last is None and since is None:
+            last = HISTORY_REPLAY_COUNT
+        # Kept well under the outbound limit so a long replay can't get the joiner evicted.
+        chunks = self.history.replay(last=last, since=since, max_bytes=client.outbound.high_watermark // 2)
+        if not chunks:
+            return
+        client.send_frame(protocol.SYSTEM, "Earlier messages:\n")
+        if client.deflater is None:
+            for chunk in chunks:
+                client.send(chunk)
+            return
+        # Recompressed frame by frame with the client's streaming context, consecutive messages share most words.
+        parser = protocol.FrameParser()
+        for chunk in chunks:
+            for msg_type, flags, payload in parser.feed(chunk):
+                client.send_frame(msg_type, payload)
+
+    def post(self, from_client: Client, message: str):
+        """
+        Queue a message for delivery, waking up the chat manager.
+
+        args:
+            from_client (Client): The client that sent the message.
+            message (str): The message to deliver.
+        """
+        if shared_data.event_loop is not None:
+            # The loop already runs on data arrival, deliver right away.
+            self.dispatch(from_client, message)
+        else:
+            self.message_queue.put((from_client, message))
 
     def chatManager(self):
         logger.info(f"Starting chat {self.chat_id}")
         while True:
-            for client in self.chat_clients:
-                if client.socket is None:
-                    logger.info(f"Client {client.address} disconnected from chat {self.chat_id}")
-                    self.chat_clients.remove(client)
-                    if len(self.chat_clients) == 0:
-                        self.close_chat()
-                        return
-
-                if client.message_queue:
-                    message = client.message_queue.pop(0)
-                    for other_client in self.chat_clients:
-                        if other_client != client:
-                            self.send_message(client, other_client, message)
-            time.sleep(0.1)  # Prevent busy waiting
+            # Sleep until something arrives, then drain everything queued so far in one batch.
+            batch = [self.message_queue.get()]
+            try:
+                while True:
+                    batch.append(self.message_queue.get_nowait())
+            except queue.Empty:
+                pass
+            for item in batch:
+                if item is None:
+                    logger.info(f"Chat {self.chat_id} manager stopped")
+                    return
+                from_client, message = item
+                self.dispatch(from_client, message)
 
     def close_chat(self):
-        logger.info("Closing chat {self.chat_id}")
+        logger.info("Closing chat %s", self.chat_id)
         for client in self.chat_clients:
             try:
+                if client.loop is not None:
+                    client.loop.unregister(client)
                 client.socket.close()
             except Exception as e:
                 logger.error(f"Error closing connection for {client.address}: {e}")
-        self.chat_clients.clear()
-        if self in shared_data.chat_rooms:
-            shared_data.chat_rooms.remove(self)
+        with self._lock:
+            members = self.chat_clients
+            self.members.clear()
+            self.chat_clients = ()
+        self.message_queue.put(None)
+        metrics.ROOM_MESSAGES.remove(str(self.chat_id))
+        if self.history is not None:
+            history.store.close_room(self.chat_id)
+        shared_data.registry.remove_room(self, members)
 
     def remove_client(self, client: Client):
-        if client in self.chat_clients:
-            self.chat_clients.remove(client)
+        with self._lock:
+            if self.members.get(client.client_id) is not client:
+                return
+            del self.members[client.client_id]
+            self.chat_clients = tuple(self.members.values())
             client.room_id = None
             self.full = False
-            self.send_message_to_all(f"{client.client_name} has left the chat.\n")
-            logger.info(f"Client {client.address} removed from chat {self.chat_id}")
-            if len(self.chat_clients) == 0:
-                self.close_chat()
+        shared_data.registry.update_room(self, left=client)
+        shared_data.registry.update_client(client)
+        logger.info("Client %s removed from chat %s", client.address, self.chat_id)
+        if len(self.members) == 0:
+            self.close_chat()
+        else:
+            self.notify_presence(client, "left")
 
 
     def __repr__(self):
-        return f"Chat Room: {self.chat_id} | Users: {(",".join([client.client_name for client in self.chat_clients]))}"
+        members = self.chat_clients
+        names = ','.join([client.client_name for client in members[:LISTED_NAMES]])
+        if len(members) > LISTED_NAMES:
+            names += f" (+{len(members) - LISTED_NAMES} more)"
+        return f"Chat Room: {self.chat_id} | Users: {names}"
 
 if __name__ == "__main__":
     pass
\ No newline at end of file
@@ -1,7 +1,28 @@
-from utils import logger, MAX_BUFFER_SIZE
+from utils import logger, FLUSH_DELAY, FLUSH_BYTES, COMPRESSION_LEVEL, COMPRESSION_MIN_SIZE
 import socket_server
 import shared_data
+import os
 import socket
+import threading
+import time
+import protocol
+import outbound
+import rate_limit
+import metrics
+import sessions
+
+# Most buffers one sendmsg call accepts.
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+
+def configure_socket(client_socket: socket.socket):
+    """
+    Writes are already coalesced per connection, so Nagle's algorithm would only add delay.
+    TCP_CORK is left off: one sendmsg call hands the kernel the whole batch anyway.
+    """
+    try:
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass  # not a TCP socket
 
 class Client:
     def __init__(self, address, client_socket, client_id, client_name):
@@ -10,45 +31,241 @@ class Client:
         self.client_id = client_id
         self.client_name = client_name
         self.room_id = None
-        self.message_queue = []
+        # Set once the connection counts against the registry's connection limits.
+        self.admitted = False
+        # Monotonic accept time, the handshake histogram measures from here until the client joins a room.
+        self.connected_at = time.monotonic()
+        # Liveness: when the client last sent anything and when it was pinged without answering yet, the bytes written so far,
+        # and since when queued output has been waiting without any of it being written (None if not stalled).
+        self.last_seen = self.connected_at
+        self.pinged_at = None
+        self.bytes_sent = 0
+        self.stalled_since = None
+        self.stalled_bytes_sent = 0
+        self.parser = protocol.FrameParser()
+        # Set by the event loop when the connection is driven by it instead of a listen thread.
+        self.loop = None
+        self.outbound = outbound.OutboundQueue()
+        # Set once the client negotiated compression, see enable_compression().
+        self.deflater = None
+        self._deflate_lock = None
+        self.reading_paused = False
+        # Rate limiting: the connection's token bucket (None without a per connection limit), whether the event loop
+        # stopped handling its frames until it is back under a limit, and whether it was told its messages are dropped.
+        self.rate_bucket = rate_limit.client_limit.bucket()
+        self.throttled = False
+        self.rate_notified = False
+        # Resumable session (see sessions.py), None unless the client asked for one, and whether its connection
+        # dropped and the session waits for a new one.
+        self.session = None
+        self.detached = False
+        # Threaded mode only: cleared while reading is paused, and the thread draining the outbound queue.
+        self._can_read = threading.Event()
+        self._can_read.set()
+        self._writer = None
+
+    def send(self, data: bytes, sender=None):
+        """
+        Queue raw bytes for the client, they are written by the event loop or by the client's writer thread.
+        args:
+            data (bytes): The encoded data to send.
+            sender (Client): The client the data comes from, if any, for the pause policy.
+        """
+        if self.socket is None and not self.detached:
+            raise ConnectionError(f"Client {self.address} is disconnected")
+        if self.detached and self.outbound.size + len(data) > self.outbound.high_watermark // 2:
+            # Nothing drains a detached session's queue, it ends instead of holding the senders back.
+            # Half the limit leaves room for the stream resent in front of it when the client resumes.
+            self.disconnect_client("Session buffer full.")
+            return
+        if not self.outbound.push(data, sender):
+            logger.warning(f"Client {self.address} is too slow, {self.outbound.size} bytes pending. Disconnecting.")
+            metrics.EVICTIONS.inc()
+            self.disconnect_client("Slow consumer.")
+            return
+        if self.detached:
+            return  # written once the client resumes
+        if self.loop is not None:
+            self.loop.schedule_write(self)
+        elif self._writer is None:
+            self._writer = threading.Thread(target=self._write_pending, daemon=True)
+            self._writer.start()
+
+    def send_frame(self, msg_type: int, payload, sender=None):
+        """
+        Encode and send one frame to the client.
+        args:
+            msg_type (int): The protocol message type.
+            payload (str | bytes): The frame payload.
+            sender (Client): The client the frame comes from, if any.
+        """
+        if self.deflater is None:
+            self.send(protocol.encode_frame(msg_type, payload), sender)
+            return
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        if len(payload) < COMPRESSION_MIN_SIZE:
+            self.send(protocol.encode_frame(msg_type, payload), sender)
+            return
+        # Frames of the streaming context must be queued in the order they were compressed.
+        with self._deflate_lock:
+            data, flags = self.deflater.compress(payload)
+            self.send(protocol.encode_frame(msg_type, data, flags), sender)
+
+    def send_shared(self, frame: bytes, variants: dict, sender=None):
+        """
+        Send an encoded frame that goes to many clients. Its compressed variant is built once, by the first
+        recipient that wants it, and kept in variants for the other recipients with the same settings.
+        args:
+            frame (bytes): The uncompressed encoded frame.
+            variants (dict): Compression level -> compressed frame, shared by the recipients of this frame.
+            sender (Client): The client the frame comes from, if any.
+        """
+        if self.deflater is not None and len(frame) - protocol.HEADER_SIZE >= COMPRESSION_MIN_SIZE:
+            variant = variants.get(self.deflater.level)
+            if variant is None:
+                variant = variants[self.deflater.level] = protocol.deflate_frame(frame, self.deflater.level)
+            frame = variant
+        self.send(frame, sender)
 
-    def listen(self):
+    def enable_compression(self, context: bool = True):
+        """
+        Compress the frames sent to this client from now on.
+        args:
+            context (bool): Compress the frames sent only to it with a streaming context, which compresses better.
+        """
+        # A dropped frame would break the peer's copy of the streaming context.
+        context = context and self.outbound.policy != outbound.DROP_OLDEST
+        self._deflate_lock = threading.Lock()
+        self.deflater = protocol.Deflater(COMPRESSION_LEVEL, context)
+
+    def write_batch(self, chunks: list) -> bool:
+        """
+        Write queued frames in one vectored sendmsg call.
+        args:
+            chunks (list): The pending chunks of the outbound queue.
+        returns:
+            bool: True if every chunk of the batch was written.
+        """
+        batch = chunks[:IOV_MAX]
+        try:
+            sent = self.socket.sendmsg(batch)
+        except OSError:
+            # Nothing was written, the frames of the batch may be dropped again.
+            self.outbound.consume(0)
+            raise
+        metrics.WRITE_CALLS.inc()
+        metrics.BYTES_OUT.inc(sent)
+        self.bytes_sent += sent
+        if self.session is not None:
+            self.session.record(batch, sent)
+        self.outbound.consume(sent)
+        return sent == sum(len(chunk) for chunk in batch)
+
+    def _write_pending(self):
+        """
+        Threaded mode writer, drains the outbound queue until the client disconnects.
+        """
         try:
             while True:
-                data = self.socket.recv(MAX_BUFFER_SIZE).decode("utf-8")
-                if data:
-                    logger.info(f"Received message from {self.address}: {data}")
-                    self.message_queue.append(data)
-                else:
-                    logger.info(f"Client {self.address} disconnected.")
-                    self.disconnect_client("Client disconnected.")
-                    break
-        except Exception as e:
-            logger.error(f"Error receiving message from {self.address}: {e}")
-            self.disconnect_client("Error receiving message.")
+                chunks = self.outbound.wait_pending()
+                if not chunks:
+                    return
+                if FLUSH_DELAY and self.outbound.size < FLUSH_BYTES:
+                    # Let more messages queue up, bounded by the delay and the byte threshold.
+                    time.sleep(FLUSH_DELAY)
+                    chunks = self.outbound.pending()
+                if chunks:
+                    self.write_batch(chunks)
+        except (OSError, AttributeError) as e:
+            if self.socket is not None:
+                metrics.SEND_FAILURES.inc()
+                logger.error(f"Failed to send message to {self.address}: {e}")
+                self.disconnect_client("Error sending message.")
+
+    def pause_reading(self):
+        """
+        Stop reading from this client until resume_reading() is called, letting TCP push back on it.
+        """
+        self.reading_paused = True
+        if self.loop is not None:
+            self.loop.update_interest(self)
+        else:
+            self._can_read.clear()
+
+    def resume_reading(self):
+        self.reading_paused = False
+        if self.loop is not None:
+            self.loop.update_interest(self)
+        else:
+            self._can_read.set()
+
+    def throttle(self, delay: float):
+        """
+        Stop handling and reading this client's frames for delay seconds, letting TCP push back on it.
+        In threaded mode this is called on the client's own reader thread, which just sleeps.
+        """
+        if self.loop is None:
+            time.sleep(delay)
+            return
+        self.throttled = True
+        self.loop.update_interest(self)
+        self.loop.call_later(delay, self._end_throttle)
+
+    def _end_throttle(self):
+        self.throttled = False
+        if self.socket is not None and self.loop is not None:
+            self.loop.update_interest(self)
+            # Frames already read may be waiting in the parser, no new data would wake them up.
+            self.loop.handle_data(self)
+
+    def frames(self):
+        """
+        Blocking reader used in threaded mode, yields every frame the client sends until it disconnects.
+        yields:
+            tuple: (msg_type, flags, payload) of each received frame, payload is only valid until the next one.
+        """
+        while True:
+            self._can_read.wait()
+            received = self.parser.recv_from(self.socket)
+            if not received:
+                return
+            self.last_seen = time.monotonic()
+            metrics.BYTES_IN.inc(received)
+            yield from self.parser.frames()
+
+    def connection_lost(self, reason: str = ""):
+        """
+        The connection failed or stopped answering. A client with a session keeps its place for a new connection
+        to resume it, any other is disconnected.
+        """
+        if not sessions.detach(self, reason):
+            self.disconnect_client(reason)
 
     def disconnect_client(self, reason: str = ""):
+        sessions.end(self)
+        if self.loop is not None:
+            self.loop.unregister(self)
         try:
             self.socket.shutdown(socket.SHUT_RDWR)
-        except OSError:
+        except (OSError, AttributeError):
             pass  # already closed / not connected
         try:
             self.socket.close()
-        except OSError:
-            pass
-        try:
-            shared_data.clients.remove(self)
-        except ValueError:
+        except (OSError, AttributeError):
             pass
-        logger.info(f"Client {getattr(self, 'address', '?')} disconnected. {reason}")
+        shared_data.registry.remove_client(self)
+        shared_data.registry.close_connection(self)
+        logger.info("Client %s disconnected. %s", getattr(self, "address", "?"), reason)
         self.socket = None
-        for chat in shared_data.chat_rooms:
-            if chat.chat_id == self.room_id:
-                chat.remove_client(self)
-                break
+        self.outbound.close()
+        self._can_read.set()
+        chat_room = shared_data.registry.get_room(self.room_id)
+        if chat_room:
+            chat_room.remove_client(self)
 
     def __repr__(self):
         return f"Client({self.client_name}, {self.address}, ID: {self.client_id}, Room: {self.room_id})"
 
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    pass
@@ -0,0 +1,270 @@
+from utils import logger
+import os
+import time
+import json
+import base64
+import socket
+import selectors
+import threading
+import itertools
+import multiprocessing
+import utils
+import shared_data
+import metrics
+import protocol
+import chat
+import event_loop
+import socket_server
+import lobby
+from connection import ConnectionHandler
+from client_handler import Client
+
+# Control messages between the supervisor and the workers are JSON datagrams on a SOCK_SEQPACKET
+# socket pair, client sockets travel alongside them as SCM_RIGHTS file descriptors.
+CONTROL_BUFFER_SIZE = 1024 * 1024
+STATUS_CLIENTS_LIMIT = 1000
+REQUEST_TIMEOUT = 5
+
+def owner_of(room_id: int, workers: int) -> int:
+    """
+    returns:
+        int: The index of the worker that owns the room, room ids are interleaved between workers.
+    """
+    return (room_id - 1) % workers
+
+def send_control(link: socket.socket, message: dict, fds: list = None):
+    data = json.dumps(message).encode("utf-8")
+    if fds:
+        socket.send_fds(link, [data], fds)
+    else:
+        link.send(data)
+
+def recv_control(link: socket.socket, max_fds: int = 4):
+    """
+    returns:
+        tuple: (message, fds), message is None once the other side closed the link.
+    """
+    data, fds, flags, address = socket.recv_fds(link, CONTROL_BUFFER_SIZE, max_fds)
+    if not data:
+        return None, fds
+    return json.loads(data), fds
+
+class Supervisor:
+    """
+    Parent process of a multi-process server. It starts the workers, routes handed off connections
+    to the worker that owns the room, relays room announcements and answers admin commands
+    by collecting every worker's reply.
+    """
+    def __init__(self, count: int):
+        self.count = count
+        self.links = []
+        self.processes = []
+        self._request_ids = itertools.count(1)
+        self._replies = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        # Without SO_REUSEPORT the workers share one inherited listening socket instead.
+        shared_socket = None if hasattr(socket, "SO_REUSEPORT") else ConnectionHandler.start_server()
+        for index in range(self.count):
+            link, worker_link = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            process = multiprocessing.Process(target=run_worker, args=(index, self.count, worker_link, shared_socket), daemon=True)
+            process.start()
+            worker_link.close()
+            self.links.append(link)
+            self.processes.append(process)
+        logger.info(f"Started {self.count} worker processes")
+        threading.Thread(target=self._route, daemon=True).start()
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for link in self.links:
+            link.close()
+
+    def _route(self):
+        selector = selectors.DefaultSelector()
+        for index, link in enumerate(self.links):
+            selector.register(link, selectors.EVENT_READ, index)
+        while selector.get_map():
+            for key, events in selector.select():
+                try:
+                    message, fds = recv_control(key.fileobj)
+                except OSError:
+                    message, fds = None, []
+                if message is None:
+                    logger.error(f"Worker {key.data} exited")
+                    selector.unregister(key.fileobj)
+                    continue
+                self._handle(key.data, message, fds)
+
+    def _handle(self, index: int, message: dict, fds: list):
+        match message["type"]:
+            case "handoff":
+                owner = owner_of(message["room_id"], self.count)
+                try:
+                    send_control(self.links[owner], message, fds)
+                except OSError as e:
+                    logger.error(f"Failed to hand off client {message['client_id']} to worker {owner}: {e}")
+                for fd in fds:
+                    os.close(fd)
+            case "room" | "relay_broadcast":
+                for other, link in enumerate(self.links):
+                    if other != index:
+                        send_control(link, message)
+            case "reply":
+                with self._lock:
+                    pending = self._replies.get(message["request_id"])
+                if pending:
+                    results, done = pending
+                    results.append(message["result"])
+                    if len(results) == self.count:
+                        done.set()
+
+    def request(self, command: str, **arguments) -> list:
+        """
+        Run an admin command on every worker.
+        args:
+            command (str): The command, "status", "stats" or "broadcast".
+        returns:
+            list: The replies of the workers that answered in time.
+        """
+        request_id = next(self._request_ids)
+        results, done = [], threading.Event()
+        with self._lock:
+            self._replies[request_id] = (results, done)
+        for link in self.links:
+            send_control(link, {"type": command, "request_id": request_id, **arguments})
+        done.wait(REQUEST_TIMEOUT)
+        with self._lock:
+            self._replies.pop(request_id, None)
+        return list(results)
+
+class Worker:
+    """
+    Cluster side of one worker process, it runs on the worker's event loop.
+    """
+    def __init__(self, index: int, count: int, link: socket.socket, loop: event_loop.EventLoop):
+        self.index = index
+        self.count = count
+        self.link = link
+        self.loop = loop
+
+    def owns(self, room_id: int) -> bool:
+        return owner_of(room_id, self.count) == self.index
+
+    def publish_room(self, chat_id: int, chat_room):
+        """
+        Registry listener, tells the other workers about changes of this worker's open rooms.
+        """
+        label = str(chat_room) if chat_room is not None and not chat_room.full else None
+        send_control(self.link, {"type": "room", "id": chat_id, "label": label, "full": chat_room is not None and chat_room.full})
+
+    def relay_broadcast(self, message: str, exclude_busy_users: bool, room_news: bool = False):
+        send_control(self.link, {"type": "relay_broadcast", "message": message, "exclude_busy_users": exclude_busy_users,
+                                 "room_news": room_news})
+
+    def handoff(self, client: Client, room_id: int, replay: dict = None):
+        """
+        Pass a lobby client to the worker that owns the room, with its name and any unread or unsent bytes.
+        Whether the room is open is only known there: this worker hears of the other workers' rooms after the fact,
+        a room created a moment ago may not be in its lobby yet. The owner joins the client or refuses and answers it.
+        """
+        self.loop.unregister(client)
+        shared_data.registry.remove_client(client)
+        shared_data.registry.close_connection(client)
+        pending = b"".join(bytes(chunk) for chunk in client.outbound.pending())
+        state = {
+            "type": "handoff",
+            "room_id": room_id,
+            "replay": replay or {},
+            "client_id": client.client_id,
+            "client_name": client.client_name,
+            "address": list(client.address),
+            "connected_at": client.connected_at,
+            "received": base64.b64encode(client.parser.unparsed()).decode("ascii"),
+            "pending": base64.b64encode(pending).decode("ascii"),
+            "compression": client.deflater is not None,
+        }
+        send_control(self.link, state, [client.socket.fileno()])
+        logger.info(f"Handed client {client.address} off to worker {owner_of(room_id, self.count)} for room {room_id}")
+        client.loop = None
+        client.outbound.close()
+        client.socket.close()
+        client.socket = None
+        return True
+
+    def _adopt(self, state: dict, fd: int):
+        client_socket = socket.socket(fileno=fd)
+        client = Client(tuple(state["address"]), client_socket, client_id=state["client_id"], client_name=state["client_name"])
+        # Already admitted by the worker that accepted it, it moves over whatever this worker's limits say.
+        client.admitted = shared_data.registry.open_connection(client.address[0])
+        # Monotonic time is system wide, the handshake keeps counting from the original accept.
+        client.connected_at = state["connected_at"]
+        self.loop.register_client(client)
+        ConnectionHandler.watch(client)
+        if state.get("compression"):
+            # The streaming context stays behind in the other worker, later frames are compressed on their own.
+            client.enable_compression(context=False)
+        pending = base64.b64decode(state["pending"])
+        if pending:
+            client.send(pending)
+        shared_data.registry.add_client(client)
+        room_id = state["room_id"]
+        if ConnectionHandler.assign_client_to_room_by_id(client, room_id, state.get("replay")):
+            client.send_frame(protocol.JOIN, f"Joined chat room {room_id}.\n")
+            metrics.HANDSHAKE.observe(time.monotonic() - client.connected_at)
+        else:
+            client.send_frame(protocol.SYSTEM, f"Chat room {room_id} is full or does not exist.\nPlease select another room: {ConnectionHandler.list_available_rooms()} :\n")
+        self.loop.handle_data(client, base64.b64decode(state["received"]))
+
+    def on_control(self):
+        message, fds = recv_control(self.link)
+        if message is None:
+            logger.info(f"Supervisor is gone, stopping worker {self.index}")
+            self.loop.stop()
+            return
+        match message["type"]:
+            case "room":
+                lobby.room_list.set(message["id"], message["label"], lobby.FULL if message.get("full") else lobby.REMOVE)
+            case "handoff":
+                self._adopt(message, fds[0])
+            case "relay_broadcast":
+                socket_server.broadcast_message(message["message"], message["exclude_busy_users"], relay=False,
+                                                room_news=message.get("room_news", False))
+            case "broadcast":
+                success = socket_server.broadcast_message(message["message"], message["exclude_busy_users"], relay=False)
+                self._reply(message, {"success": success})
+            case "status":
+                clients = shared_data.registry.all_clients()
+                self._reply(message, {"count": len(clients), "clients": [repr(client) for client in clients[:STATUS_CLIENTS_LIMIT]]})
+            case "stats":
+                self._reply(message, metrics.summary())
+
+    def _reply(self, request: dict, result: dict):
+        result.update(worker=self.index, pid=os.getpid())
+        send_control(self.link, {"type": "reply", "request_id": request["request_id"], "result": result})
+
+def run_worker(index: int, count: int, link: socket.socket, shared_socket: socket.socket = None):
+    """
+    Entry point of a worker process: own slices of the client and room id space, listen on the shared port
+    and run an event loop.
+    """
+    shared_data.supervisor = None  # inherited from the parent when the worker was forked
+    ConnectionHandler._client_id = index
+    ConnectionHandler._client_id_step = count
+    chat.Chat._chat_id = chat.first_room_id(index + 1, count)
+    chat.Chat._chat_id_step = count
+    server_socket = shared_socket or ConnectionHandler.start_server(reuse_port=True)
+    loop = event_loop.EventLoop(server_socket)
+    worker = Worker(index, count, link, loop)
+    shared_data.cluster = worker
+    shared_data.registry.room_listeners.append(worker.publish_room)
+    loop.add_reader(link, worker.on_control)
+    if utils.METRICS_PORT:
+        metrics.start_http_server(utils.METRICS_HOST, utils.METRICS_PORT + 1 + index)
+    logger.info(f"Worker {index} started (pid {os.getpid()})")
+    loop.run()
+
+if __name__ == "__main__":
+    pass
@@ -1,76 +1,372 @@
-from utils import logger, MAX_CONNECTIONS, MAX_BUFFER_SIZE
+from utils import logger, LogSampler, MAX_CONNECTIONS, MAX_CONNECTIONS_PER_IP, BUSY_RETRY_AFTER, LISTEN_BACKLOG, MAX_BUFFER_SIZE
+from utils import PING_INTERVAL, IDLE_TIMEOUT, HANDSHAKE_TIMEOUT, WRITE_TIMEOUT, LIVENESS_TICK, COMPRESSION
 import socket
 import threading
 import os
 import time
 import chat
+import history
 import socket_server
 import shared_data
-from client_handler import Client
+import protocol
+import metrics
+import rate_limit
+import sessions
+import lobby
+from client_handler import Client, configure_socket
+from timer_wheel import TimerWheel
+
+# Chat messages and lobby inputs are too frequent to log one line each.
+message_log = LogSampler(logger, "chat messages received")
+lobby_log = LogSampler(logger, "lobby inputs received")
+# A connection storm refuses thousands of clients a second.
+refused_log = LogSampler(logger, "connections refused as busy")
+# One pending liveness check per connection, only the checks that are due are visited.
+liveness_checks = TimerWheel(LIVENESS_TICK)
 
 class ConnectionHandler:
     _client_id = 0
+    # Ids advance by this step, workers of a multi-process server use disjoint id sequences.
+    _client_id_step = 1
+    WELCOME_MESSAGE = "Welcome! Please write your name: "
+    # Admission limits, 0 for none. Class attributes so a benchmark can change them at runtime.
+    max_connections = MAX_CONNECTIONS
+    max_connections_per_ip = MAX_CONNECTIONS_PER_IP
+    # Two clients joining the same closed room must not open it twice.
+    _reopen_lock = threading.Lock()
 
     @staticmethod
-    def start_server(host=os.getenv("SERVER_HOST", "127.0.0.1"), port=int(os.getenv("SERVER_PORT", 10000))) -> socket.socket:
+    def start_server(host=os.getenv("SERVER_HOST", "127.0.0.1"), port=int(os.getenv("SERVER_PORT", 10000)), reuse_port: bool = False) -> socket.socket:
         """
         Start a socket server.
         args:
             host (str): The host IP address to bind the server to, defaults to env parameter.
             port (int): The port number to bind the server to, defaults to env parameter.
+            reuse_port (bool): Set SO_REUSEPORT so several worker processes can listen on the same port.
         returns:
             socket.socket: The server socket.
         """
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server_socket.bind((host, port))
-        server_socket.listen()
+        server_socket.listen(LISTEN_BACKLOG)
         logger.info(f"Server listen on {host}:{port}")
         return server_socket
 
     @staticmethod
-    def list_available_rooms() -> str:
+    def next_client_id() -> int:
+        ConnectionHandler._client_id += ConnectionHandler._client_id_step
+        return ConnectionHandler._client_id
+
+    @staticmethod
+    def admit(client_socket: socket.socket, address) -> bool:
         """
-        List available chat rooms.
+        Admission control for a just accepted connection. A connection over the limits gets a busy frame
+        telling it when to retry and is closed at once, without starting a handshake.
+        args:
+            client_socket (socket.socket): The accepted socket.
+            address (tuple): The peer address.
         returns:
-            str: A string representation of available chat rooms.
+            bool: True if the connection was admitted and counts against the limits until it disconnects.
         """
+        if shared_data.registry.open_connection(address[0], ConnectionHandler.max_connections, ConnectionHandler.max_connections_per_ip):
+            metrics.ACCEPTED.inc()
+            return True
+        if ConnectionHandler.max_connections and shared_data.registry.connection_count() >= ConnectionHandler.max_connections:
+            reason, message = "total", f"Server busy, retry after {BUSY_RETRY_AFTER} seconds."
+        else:
+            reason, message = "per_ip", f"Too many connections from {address[0]}, retry after {BUSY_RETRY_AFTER} seconds."
+        metrics.REFUSED.labels(reason).inc()
+        refused_log.record("Refusing connection from %s: %s", address, message)
+        try:
+            # Never wait on a refused client, the frame fits in an empty socket buffer or is lost.
+            client_socket.setblocking(False)
+            client_socket.send(protocol.encode_frame(protocol.BUSY, message))
+        except OSError:
+            pass
+        client_socket.close()
+        return False
 
-        available_rooms = [str(chat) + "\n" for chat in shared_data.chat_rooms if not chat.full]
-        return ", ".join(available_rooms) if available_rooms else "No available rooms"
+    @staticmethod
+    def list_available_rooms(page: int = 1) -> str:
+        """
+        List available chat rooms, one page of them.
+        args:
+            page (int): The page, from 1.
+        returns:
+            str: A string representation of available chat rooms, cached until the rooms change.
+        """
+        return lobby.room_list.text(page)
 
     @staticmethod
-    def wait_room_for_client(client_socket, address):
-        logger.info(f"Accepted connection from {address}")
+    def list_rooms(client: Client, request: str):
+        """
+        Answer a LIST_ROOMS request: '' or 'page <n>' for a page of the rooms, 'subscribe' for the first page and
+        the changes after it, 'unsubscribe' to stop them.
+        args:
+            client (Client): The client asking.
+            request (str): The request payload.
+        """
+        parts = request.split()
+        page = 1
+        if parts == ["unsubscribe"]:
+            lobby.room_list.unsubscribe(client)
+            return
+        if parts == ["subscribe"]:
+            if client.room_id is None:
+                lobby.room_list.subscribe(client)
+        elif len(parts) == 2 and parts[0] == "page" and parts[1].isdigit():
+            page = int(parts[1])
+        client.send_frame(protocol.LIST_ROOMS, lobby.room_list.listing(page))
+
+    @staticmethod
+    def wait_room_for_client(client_socket, address, client_id: int):
+        logger.info("Accepted connection from %s", address)
+        configure_socket(client_socket)
+        client: Client = Client(address, client_socket, client_id=client_id, client_name=None)
+        client.admitted = True
+        ConnectionHandler.watch(client)
         try:
-            client_socket.sendall("Welcome! Please write your name: ".encode("utf-8"))
-            client_name: str = client_socket.recv(MAX_BUFFER_SIZE).decode("utf-8").strip()
-            logger.info(f"Client {address} set name to {client_name}")
-            if shared_data.chat_rooms and any(not chat.full for chat in shared_data.chat_rooms):
-                client_socket.sendall(f"Hello {client_name}, join Available chat rooms (type the id):\n{ConnectionHandler.list_available_rooms()}\nor create new chat (type 'new')".encode("utf-8"))
-            else:
-                client_socket.sendall(f"Hello {client_name}, currently there are no available rooms\nSend 'new' to create chat or wait for rooms (refresh by sending a message)".encode("utf-8"))
-            client: Client = Client(address, client_socket, client_id=ConnectionHandler._client_id, client_name=client_name)
-            shared_data.clients.append(client)
-            while True:
-                data = client_socket.recv(MAX_BUFFER_SIZE).decode("utf-8")
-                if data == "new":
-                    ConnectionHandler.create_new_chat(client)
-                    break
-                else:
-                    try:
-                        room_id = int(data)
-                        if ConnectionHandler.assign_client_to_room_by_id(client, room_id):
-                            client_socket.sendall(f"Joined chat room {room_id}.\n".encode("utf-8"))
-                            break
-                        else:
-                            client_socket.sendall(f"Chat room {room_id} is full or does not exist.\nPlease select another room: {ConnectionHandler.list_available_rooms()} :\n".encode("utf-8"))
-                    except ValueError:
-                        client_socket.sendall(f"Please select a room to join:\n{ConnectionHandler.list_available_rooms()}\n".encode("utf-8"))
-
-                logger.info(f"Received data from {client_name} {address}: {data}")
+            client.send_frame(protocol.SYSTEM, ConnectionHandler.WELCOME_MESSAGE)
+            # The handshake thread keeps reading for the client once it joined a room.
+            for msg_type, flags, payload in client.frames():
+                ConnectionHandler.handle_frame(client, msg_type, payload, flags)
+                if client.socket is None:
+                    return  # disconnected while handling the frame
+            logger.info("Client %s disconnected.", address)
+            client.disconnect_client("Client disconnected.")
         except Exception as e:
             logger.error(f"Error handling client {address}: {e}")
-            client_socket.close()
+            client.disconnect_client("Error receiving message.")
+
+    @staticmethod
+    def handle_frame(client: Client, msg_type: int, payload: bytes, flags: int = 0):
+        """
+        Route one frame according to the client's handshake state: name, lobby or chat.
+        args:
+            client (Client): The client that sent the frame.
+            msg_type (int): The protocol message type.
+            payload (bytes): The frame payload.
+            flags (int): The frame flags.
+        returns:
+            None
+        """
+        if client.session is not None:
+            client.session.received += protocol.HEADER_SIZE + len(payload)
+        if not ConnectionHandler.rate_limit(client, msg_type, len(payload)):
+            return
+        if flags & protocol.FLAG_DEFLATE:
+            # Clients compress each payload on its own, the server keeps no context for them.
+            payload = protocol.inflate(payload)
+        if msg_type == protocol.OPTIONS:
+            ConnectionHandler.negotiate(client, protocol.decode_text(payload))
+            return
+        if msg_type == protocol.PONG:
+            return  # receiving it was the point
+        if msg_type == protocol.RESUME:
+            ConnectionHandler.handle_resume(client, protocol.decode_text(payload))
+            return
+        if msg_type == protocol.PING:
+            client.send_frame(protocol.PONG, payload)
+            return
+        if msg_type == protocol.LIST_ROOMS:
+            ConnectionHandler.list_rooms(client, protocol.decode_text(payload))
+            return
+        if msg_type not in (protocol.CHAT, protocol.JOIN):
+            return
+        # payload is a view of the receive buffer, decoding it is the one copy made of a message.
+        message = protocol.decode_text(payload)
+        if client.client_name is None:
+            if msg_type == protocol.CHAT:
+                client.client_name = message.strip()
+                ConnectionHandler.greet_client(client)
+        elif client.room_id is None:
+            ConnectionHandler.handle_lobby_input(client, message)
+        elif msg_type == protocol.CHAT:
+            message_log.record("Received message from %s: %s", client.address, message)
+            chat_room = shared_data.registry.get_room(client.room_id)
+            if chat_room:
+                chat_room.post(client, message)
+
+    @staticmethod
+    def rate_limit(client: Client, msg_type: int, size: int) -> bool:
+        """
+        Charge a frame read from the client to its rate limit, and a chat message to its room's, applying the
+        limit's policy when one is exceeded.
+        args:
+            client (Client): The client that sent the frame.
+            msg_type (int): The protocol message type.
+            size (int): The payload size on the wire.
+        returns:
+            bool: True if the frame should be handled, False if it was dropped or the client disconnected.
+        """
+        if msg_type == protocol.PONG:
+            return True  # answers the server's own ping
+        buckets = []
+        if client.rate_bucket is not None:
+            buckets.append(("client", rate_limit.client_limit, client.rate_bucket))
+        if msg_type == protocol.CHAT and client.room_id is not None and rate_limit.room_limit:
+            chat_room = shared_data.registry.get_room(client.room_id)
+            if chat_room is not None and chat_room.rate_bucket is not None:
+                buckets.append(("room", rate_limit.room_limit, chat_room.rate_bucket))
+        if not buckets:
+            return True
+        now = time.monotonic()
+        exceeded = None
+        delay = 0.0
+        for name, limit, bucket in buckets:
+            if limit.policy == rate_limit.PAUSE:
+                # Every limit is charged, the frame is handled either way.
+                wait = limit.charge(bucket, size, now)
+            else:
+                wait = limit.take(bucket, size, now)
+            if wait > delay:
+                exceeded, delay = (name, limit), wait
+            if wait and limit.policy != rate_limit.PAUSE:
+                break
+        if exceeded is None:
+            client.rate_notified = False
+            return True
+        name, limit = exceeded
+        metrics.THROTTLED.labels(name, limit.policy).inc()
+        if limit.policy == rate_limit.PAUSE:
+            client.throttle(delay)
+            return True
+        if limit.policy == rate_limit.DROP:
+            if not client.rate_notified:
+                # Once until a message goes through again, a notice per dropped frame would let a flood double the traffic.
+                client.rate_notified = True
+                client.send_frame(protocol.SYSTEM, "You are sending too fast, messages are dropped until you slow down.")
+            return False
+        client.disconnect_client(f"Over the {name} rate limit.")
+        return False
+
+    @staticmethod
+    def negotiate(client: Client, offer: str):
+        """
+        Answer a client's OPTIONS frame, usually sent right after the welcome message.
+        args:
+            client (Client): The client.
+            offer (str): The extensions the client supports, separated by spaces.
+        returns:
+            None
+        """
+        extensions = offer.split()
+        accepted = []
+        if "deflate" in extensions and COMPRESSION == "deflate" and client.deflater is None:
+            accepted.append("deflate")
+        if "resume" in extensions and client.session is None and sessions.enabled():
+            accepted.append("resume")
+        if not accepted:
+            if not ("deflate" in extensions and client.deflater is not None):
+                client.send_frame(protocol.OPTIONS, "none")
+            return  # an offer repeated once compression is on gets no answer
+        # Answered before enabling them, the client only inflates what comes after the answer.
+        client.send_frame(protocol.OPTIONS, " ".join(accepted))
+        if "deflate" in accepted:
+            client.enable_compression()
+            logger.info("Client %s negotiated deflate compression", client.address)
+        if "resume" in accepted:
+            sessions.start(client)
+
+    @staticmethod
+    def handle_resume(client: Client, request: str):
+        """
+        Handle a RESUME frame: "end" forgets the client's session, and as the first frame of a new connection
+        "<token> <bytes received>" takes over the session it names.
+        args:
+            client (Client): The client that sent the frame.
+            request (str): The frame payload.
+        returns:
+            None
+        """
+        if request == "end":
+            sessions.end(client)
+        elif client.client_name is None and client.session is None:
+            sessions.resume(client, request)
+
+    @staticmethod
+    def greet_client(client: Client):
+        """
+        Register a client that just picked its name and show it the available rooms.
+        args:
+            client (Client): The client, with its name already set.
+        returns:
+            None
+        """
+        logger.info("Client %s set name to %s", client.address, client.client_name)
+        if len(lobby.room_list):
+            client.send_frame(protocol.SYSTEM, f"Hello {client.client_name}, join Available chat rooms (type the id):\n{ConnectionHandler.list_available_rooms()}\nor create new chat (type 'new'), join any open room (type 'any') or the room of some users (type 'with <name>')")
+        else:
+            client.send_frame(protocol.SYSTEM, f"Hello {client.client_name}, currently there are no available rooms\nSend 'new' to create chat, 'any' to be matched with the next user or wait for rooms (refresh by sending a message)")
+        shared_data.registry.add_client(client)
+
+    @staticmethod
+    def handle_lobby_input(client: Client, data: str) -> bool:
+        """
+        Handle one lobby input of a client that has not joined a room yet.
+        args:
+            client (Client): The client in the lobby.
+            data (str): The received input: 'new', a room id, 'any' for any open room, 'with <name> [<name> ...]'
+                or 'rooms <page>' for a page of the room list.
+        returns:
+            bool: True if the client is now in a chat room, False otherwise.
+        """
+        joined = False
+        if data == "new":
+            ConnectionHandler.create_new_chat(client)
+            joined = True
+        elif data == "rooms" or data.startswith("rooms "):
+            page = data.split()[1:]
+            client.send_frame(protocol.SYSTEM, ConnectionHandler.list_available_rooms(int(page[0]) if page and page[0].isdigit() else 1))
+        elif data == "any" or data.startswith("with "):
+            names = data.split()[1:]
+            if ConnectionHandler.assign_client_to_room_by_users(client, names):
+                client.send_frame(protocol.JOIN, f"Joined chat room {client.room_id}.\n")
+                joined = True
+            elif not names:
+                # No open room: open one, the next 'any' request joins it.
+                ConnectionHandler.create_new_chat(client)
+                joined = True
+            else:
+                client.send_frame(protocol.SYSTEM, f"No open chat room with {', '.join(names)}.\nPlease select another room: {ConnectionHandler.list_available_rooms()} :\n")
+        else:
+            try:
+                room_id, replay = ConnectionHandler.parse_join(data)
+                if shared_data.cluster is not None and not shared_data.cluster.owns(room_id):
+                    # The room lives in another worker process, which takes over the connection and joins or refuses it.
+                    shared_data.cluster.handoff(client, room_id, replay)
+                elif ConnectionHandler.assign_client_to_room_by_id(client, room_id, replay):
+                    client.send_frame(protocol.JOIN, f"Joined chat room {room_id}.\n")
+                    joined = True
+                else:
+                    client.send_frame(protocol.SYSTEM, f"Chat room {room_id} is full or does not exist.\nPlease select another room: {ConnectionHandler.list_available_rooms()} :\n")
+            except ValueError:
+                client.send_frame(protocol.SYSTEM, f"Please select a room to join:\n{ConnectionHandler.list_available_rooms()}\n")
+
+        if joined:
+            metrics.HANDSHAKE.observe(time.monotonic() - client.connected_at)
+        lobby_log.record("Received data from %s %s: %s", client.client_name, client.address, data)
+        return joined
+
+    @staticmethod
+    def parse_join(data: str) -> tuple:
+        """
+        Parse a request to join a room: its id, optionally followed by 'last <count>' or 'since <unix time>'.
+        args:
+            data (str): The lobby input.
+        returns:
+            tuple: (room_id, replay), replay holds the history to replay as keyword arguments of Chat.replay_history.
+        raises:
+            ValueError: If the input is not a join request.
+        """
+        parts = data.split()
+        if len(parts) == 3 and parts[1] == "last":
+            return int(parts[0]), {"last": int(parts[2])}
+        if len(parts) == 3 and parts[1] == "since":
+            return int(parts[0]), {"since": float(parts[2])}
+        return int(data), {}
 
     @staticmethod
     def create_new_chat(client: Client) :
@@ -78,50 +374,78 @@ class ConnectionHandler:
         Handle creating a new chat room.
         args:
             client (Client): The client requesting a new chat room.
-            client_socket (socket.socket): The client's socket.
         returns:
             None
         """
         new_chat = chat.Chat(client)
-        shared_data.chat_rooms.append(new_chat)
-        logger.info(f"Created new chat room {new_chat.chat_id} for client {client.address}")
-        client.socket.sendall(f"New chat room {new_chat.chat_id} created.\n"
-                              f"Waiting for another client to join...\n".encode("utf-8"))
-        threading.Thread(target=client.listen).start()
-        threading.Thread(target=new_chat.chatManager).start()
-        socket_server.broadcast_message(f"A new chat room has been created by {client.client_name}. Room ID: {new_chat.chat_id}.\n", exclude_busy_users=True)
+        shared_data.registry.add_room(new_chat)
+        logger.info("Created new chat room %s for client %s", new_chat.chat_id, client.address)
+        client.send_frame(protocol.JOIN, f"New chat room {new_chat.chat_id} created.\n"
+                                         f"Waiting for another client to join...\n")
+        socket_server.broadcast_message(f"A new chat room has been created by {client.client_name}. Room ID: {new_chat.chat_id}.\n", exclude_busy_users=True, room_news=True)
 
     @staticmethod
-    def assign_client_to_room_by_id(client: Client, chat_room_id: int) -> bool:
+    def assign_client_to_room_by_id(client: Client, chat_room_id: int, replay: dict = None) -> bool:
         """
         Assign a client to an available chat room.
         args:
             client (Client): The client to assign.
             chat_room_id (int): The ID of the chat room to assign the client to.
+            replay (dict): The 'last' or 'since' history to replay to the client, the default replay if empty.
         returns:
             bool: True if the client was assigned, False otherwise.
         """
-        chat_room = next((chat for chat in shared_data.chat_rooms if chat.chat_id == chat_room_id), None)
+        chat_room = shared_data.registry.get_room(chat_room_id) or ConnectionHandler.reopen_room(chat_room_id)
         if chat_room and not chat_room.full:
-            chat_room.send_message_to_all(f"{client.client_name} has joined the chat room.\n")
-            chat_room.add_client(client)
-            client.socket.sendall(f"Joined chat room {chat_room_id}. You can start chatting now!\n".encode("utf-8"))
-            logger.info(f"Client {client.address} joined chat room {chat_room_id}")
+            if not chat_room.add_client(client):
+                return False
+            chat_room.notify_presence(client, "joined")
+            client.send_frame(protocol.JOIN, f"Joined chat room {chat_room_id}. You can start chatting now!\n")
+            chat_room.replay_history(client, **(replay or {}))
+            logger.info("Client %s joined chat room %s", client.address, chat_room_id)
             client.room_id = chat_room_id
-            threading.Thread(target=client.listen()).start()
             return True
         return False
 
     @staticmethod
-    def assign_client_to_room_by_users(client: Client) -> bool:
+    def reopen_room(chat_room_id: int):
         """
-        Assign a client to an chat room by the users inside.
+        Open a closed room again under its id if its history is still on disk, after its last member left or a restart.
+        args:
+            chat_room_id (int): The room a client asked to join.
+        returns:
+            Chat: The room, None if it has no history.
+        """
+        if history.store is None:
+            return None
+        with ConnectionHandler._reopen_lock:
+            chat_room = shared_data.registry.get_room(chat_room_id)
+            if chat_room is None and history.store.has_room(chat_room_id):
+                chat_room = chat.Chat(chat_id=chat_room_id)
+                shared_data.registry.add_room(chat_room)
+                logger.info("Reopened chat room %s from its history", chat_room_id)
+            return chat_room
+
+    @staticmethod
+    def assign_client_to_room_by_users(client: Client, names: list = None) -> bool:
+        """
+        Assign a client to an open chat room by the users inside, or to any open room.
+        The room comes from the registry's matchmaking indexes, see Registry.match_room, not from a scan of the rooms.
+        In a multi-process server only the rooms of this worker are matched.
         args:
             client (Client): The client to assign.
+            names (list): Names of users that must be in the room, none for any open room.
         returns:
             bool: True if the client was assigned, False otherwise.
         """
-        pass
+        # Another client may take the last seat between the lookup and the join, the room is then no longer open.
+        for _ in range(3):
+            chat_room = shared_data.registry.match_room(names)
+            if chat_room is None:
+                return False
+            if ConnectionHandler.assign_client_to_room_by_id(client, chat_room.chat_id):
+                return True
+        return False
 
     @staticmethod
     def handle_new_client_connections(server_socket: socket.socket):
@@ -133,26 +457,107 @@ class ConnectionHandler:
             None
         """
         logger.info("Server is running and waiting for connections...")
+        threading.Thread(target=ConnectionHandler.reap_idle_clients, daemon=True).start()
         while True:
-            ConnectionHandler.remove_disconnected_clients()
-            time.sleep(1)
-            if len(shared_data.clients) >= MAX_CONNECTIONS:
-                logger.warning("Max connections reached, refusing new connection.")
-                continue
-
             client_socket, address = server_socket.accept()
-            client_handler = threading.Thread(target=ConnectionHandler.wait_room_for_client, args=(client_socket, address))
+            if not ConnectionHandler.admit(client_socket, address):
+                continue
+            # Ids key the registry, so they are taken here and not inside the racing handler threads.
+            client_handler = threading.Thread(target=ConnectionHandler.wait_room_for_client, args=(client_socket, address, ConnectionHandler.next_client_id()))
             client_handler.start()
-            ConnectionHandler._client_id += 1
 
     @staticmethod
-    def remove_disconnected_clients():
+    def watch(client: Client):
+        """
+        Start the liveness checks of a new connection.
+        """
+        liveness_checks.schedule(ConnectionHandler.check_liveness(client, time.monotonic())[1], client)
 
-        try:
-            # clients = [client for client in shared_data.clients if client.socket.fileno() != -1]
-            pass
-        except Exception as e:
-            logger.error(f"Error removing disconnected clients: {e}")
+    @staticmethod
+    def check_liveness(client: Client, now: float) -> tuple:
+        """
+        Ping the client if it has been silent for PING_INTERVAL and decide whether it is dead.
+        args:
+            client (Client): The client to check.
+            now (float): The monotonic time of the check.
+        returns:
+            tuple: (the reason to disconnect it or None, seconds until the next check).
+        """
+        silent = now - client.last_seen
+        if HANDSHAKE_TIMEOUT and client.client_name is None and now - client.connected_at >= HANDSHAKE_TIMEOUT:
+            return "Handshake timeout.", 0
+        if IDLE_TIMEOUT and silent >= IDLE_TIMEOUT:
+            return "Idle timeout.", 0
+        if not client.outbound.size:
+            client.stalled_since = None
+        elif client.stalled_since is None or client.bytes_sent != client.stalled_bytes_sent:
+            client.stalled_since = now
+        elif WRITE_TIMEOUT and now - client.stalled_since >= WRITE_TIMEOUT:
+            return "Write timeout.", 0
+        client.stalled_bytes_sent = client.bytes_sent
+        if client.pinged_at is not None and client.last_seen >= client.pinged_at:
+            client.pinged_at = None  # it answered
+        if PING_INTERVAL and silent >= PING_INTERVAL and client.pinged_at is None:
+            client.send_frame(protocol.PING, b"")
+            client.pinged_at = now
+        # Check again at the earliest deadline. Output queued after this check is noticed by the next one,
+        # which comes at least every half WRITE_TIMEOUT so a stall is seen within 1.5 times the timeout.
+        deadlines = []
+        if HANDSHAKE_TIMEOUT and client.client_name is None:
+            deadlines.append(client.connected_at + HANDSHAKE_TIMEOUT - now)
+        if IDLE_TIMEOUT:
+            deadlines.append(client.last_seen + IDLE_TIMEOUT - now)
+        if PING_INTERVAL and client.pinged_at is None:
+            deadlines.append(client.last_seen + PING_INTERVAL - now)
+        if WRITE_TIMEOUT:
+            deadlines.append(WRITE_TIMEOUT / 2)
+        return None, max(min(deadlines, default=3600), LIVENESS_TICK)
+
+    @staticmethod
+    def remove_disconnected_clients(now: float = None) -> int:
+        """
+        Run the liveness checks that are due and disconnect the dead clients in one pass, which takes them
+        out of their chat room and the registry and frees their connection slot.
+        args:
+            now (float): The monotonic time of the pass, defaults to now.
+        returns:
+            int: The number of disconnected clients.
+        """
+        now = time.monotonic() if now is None else now
+        dead = []
+        for client in liveness_checks.expire(now):
+            if client.detached:
+                # Its one check waits on the wheel until the session is resumed or expires.
+                liveness_checks.schedule(LIVENESS_TICK, client, now)
+                continue
+            if client.socket is None:
+                continue  # gone already, or handed off to another worker
+            try:
+                reason, delay = ConnectionHandler.check_liveness(client, now)
+            except Exception as e:
+                logger.error(f"Error checking client {client.address}: {e}")
+                reason, delay = "Error checking connection.", 0
+            if reason is None:
+                liveness_checks.schedule(delay, client, now)
+            else:
+                dead.append((client, reason))
+        for client, reason in dead:
+            logger.info("Disconnecting %s: %s", client.address, reason)
+            metrics.REAPED.labels(reason).inc()
+            client.connection_lost(reason)
+        return len(dead)
+
+    @staticmethod
+    def reap_idle_clients():
+        """
+        Threaded mode liveness thread, the event loop runs the checks itself.
+        """
+        while True:
+            time.sleep(LIVENESS_TICK)
+            try:
+                ConnectionHandler.remove_disconnected_clients()
+            except Exception as e:
+                logger.error(f"Error removing disconnected clients: {e}")
 
 
 if __name__ == "__main__":
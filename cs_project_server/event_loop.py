@@ -0,0 +1,355 @@
+from utils import logger, ACCEPT_BURST, MAX_BUFFER_SIZE, FLUSH_DELAY, FLUSH_BYTES, FANOUT_THREADS
+import selectors
+import socket
+import threading
+import time
+import heapq
+import itertools
+import collections
+import concurrent.futures
+import shared_data
+import protocol
+import metrics
+from client_handler import Client, configure_socket
+from connection import ConnectionHandler, liveness_checks
+
+# Below this many connections to write in one iteration the fan-out threads are not worth the hand-off.
+PARALLEL_WRITE_MIN = 64
+
+class EventLoop:
+    """
+    Single threaded server core. Accepting, the name/room handshake, reading from clients
+    and room fan-out all run as non-blocking steps on one selector loop.
+    """
+    def __init__(self, server_socket: socket.socket):
+        self.server_socket = server_socket
+        self.server_socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+        # Other threads (the admin console) hand work to the loop through this socket pair.
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self.add_reader(self._wakeup_reader, self._drain_wakeups)
+        self._pending = collections.deque()
+        # Clients whose selector registration other threads asked to update, the fan-out threads resuming senders included.
+        self._pending_interest = collections.deque()
+        self._dirty = set()
+        # Every client the loop drives, the ones whose reads are paused included.
+        self.clients = set()
+        # Clients whose writes are being held back, with the time they must be written by, oldest first.
+        self._delayed = {}
+        self.flush_delay = FLUSH_DELAY
+        self.flush_bytes = FLUSH_BYTES
+        # (deadline, id, callback) heap of call_later() callbacks, and the ones added by other threads.
+        self._timers = []
+        self._timer_ids = itertools.count()
+        self._pending_timers = collections.deque()
+        # sendmsg releases the GIL, so a large fan-out can write from several threads.
+        self.fanout_threads = FANOUT_THREADS
+        self._writers = concurrent.futures.ThreadPoolExecutor(FANOUT_THREADS, thread_name_prefix="fanout") if FANOUT_THREADS else None
+        self.accept_burst = ACCEPT_BURST
+        self._thread_id = None
+        self.running = False
+
+    def run(self):
+        """
+        Run the loop until stop() is called.
+        """
+        self._thread_id = threading.get_ident()
+        self.running = True
+        shared_data.event_loop = self
+        logger.info("Server is running and waiting for connections (event loop mode)...")
+        while self.running:
+            for key, events in self.selector.select(self._select_timeout()):
+                if key.data is None:
+                    self._accept()
+                elif callable(key.data):
+                    key.data()
+                else:
+                    client: Client = key.data
+                    if events & selectors.EVENT_WRITE:
+                        self._write(client)
+                    if events & selectors.EVENT_READ and client.socket is not None:
+                        self._read(client)
+            self._run_timers()
+            ConnectionHandler.remove_disconnected_clients()
+            self._flush_dirty()
+        self.selector.close()
+        if self._writers is not None:
+            self._writers.shutdown(wait=False)
+
+    def stop(self):
+        self.running = False
+        self._wakeup()
+
+    def add_reader(self, sock: socket.socket, callback):
+        """
+        Call callback() on the loop whenever sock is readable.
+        """
+        self.selector.register(sock, selectors.EVENT_READ, callback)
+
+    def _accept(self):
+        """
+        Drain the listen backlog, up to accept_burst connections so a connection storm can't starve the clients.
+        """
+        for _ in range(self.accept_burst):
+            try:
+                client_socket, address = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # Out of file descriptors and the like, the connection stays in the backlog for the next round.
+                logger.error(f"Error accepting connection: {e}")
+                return
+            if not ConnectionHandler.admit(client_socket, address):
+                continue
+            logger.info("Accepted connection from %s", address)
+            client = Client(address, client_socket, client_id=ConnectionHandler.next_client_id(), client_name=None)
+            client.admitted = True
+            self.register_client(client)
+            ConnectionHandler.watch(client)
+            client.send_frame(protocol.SYSTEM, ConnectionHandler.WELCOME_MESSAGE)
+
+    def register_client(self, client: Client):
+        """
+        Let the loop drive an already connected client.
+        """
+        client.socket.setblocking(False)
+        configure_socket(client.socket)
+        client.loop = self
+        self.clients.add(client)
+        self.selector.register(client.socket, selectors.EVENT_READ, client)
+
+    def _read(self, client: Client):
+        try:
+            # Straight into a pooled buffer, no bytes object per read.
+            received = client.parser.recv_from(client.socket)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            logger.error(f"Error receiving message from {client.address}: {e}")
+            client.connection_lost("Error receiving message.")
+            return
+        if not received:
+            logger.info("Client %s disconnected.", client.address)
+            client.connection_lost("Client disconnected.")
+            return
+        client.last_seen = time.monotonic()
+        metrics.BYTES_IN.inc(received)
+        self.handle_data(client)
+
+    @staticmethod
+    def handle_data(client: Client, data: bytes = b""):
+        """
+        Handle every complete frame received from the client.
+        args:
+            client (Client): The client.
+            data (bytes): Bytes received some other way than the loop reading the socket, if any.
+        """
+        try:
+            if data:
+                client.parser.append(data)
+            for msg_type, flags, payload in client.parser.frames():
+                ConnectionHandler.handle_frame(client, msg_type, payload, flags)
+                if client.socket is None or client.loop is None or client.throttled:
+                    break
+        except Exception as e:
+            logger.error(f"Error handling client {client.address}: {e}")
+            client.disconnect_client("Error receiving message.")
+
+    def schedule_write(self, client: Client):
+        """
+        Ask the loop to write the client's outbound queue. Safe to call from any thread.
+        args:
+            client (Client): The client with pending data.
+        """
+        if threading.get_ident() == self._thread_id:
+            self._dirty.add(client)
+        else:
+            self._pending.append(client)
+            self._wakeup()
+
+    def update_interest(self, client: Client):
+        """
+        Register for the events the client currently needs: reads unless paused or throttled, writes while data is pending.
+        Safe to call from any thread, the selector is only changed on the loop: a modify() racing its select() is lost.
+        """
+        if threading.get_ident() != self._thread_id:
+            self._pending_interest.append(client)
+            self._wakeup()
+            return
+        if client.socket is None:
+            return
+        events = 0 if client.reading_paused or client.throttled else selectors.EVENT_READ
+        if client.outbound:
+            events |= selectors.EVENT_WRITE
+        try:
+            key = self.selector.get_key(client.socket)
+            if events == 0:
+                self.selector.unregister(client.socket)
+            elif key.events != events:
+                self.selector.modify(client.socket, events, client)
+        except KeyError:
+            if events:
+                self.selector.register(client.socket, events, client)
+        except ValueError:
+            pass
+
+    def unregister(self, client: Client):
+        self.clients.discard(client)
+        if client.socket is None:
+            return
+        try:
+            self.selector.unregister(client.socket)
+        except (KeyError, ValueError):
+            pass
+        self._dirty.discard(client)
+        self._delayed.pop(client, None)
+
+    def _wakeup(self):
+        try:
+            self._wakeup_writer.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass  # a wakeup is already pending
+
+    def _drain_wakeups(self):
+        try:
+            while self._wakeup_reader.recv(MAX_BUFFER_SIZE):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self._pending:
+            self._dirty.add(self._pending.popleft())
+        self._apply_interest()
+        while self._pending_timers:
+            heapq.heappush(self._timers, self._pending_timers.popleft())
+
+    def _apply_interest(self):
+        while self._pending_interest:
+            client = self._pending_interest.popleft()
+            if client in self.clients:  # not unregistered since
+                self.update_interest(client)
+
+    def call_later(self, delay: float, callback):
+        """
+        Run callback() on the loop after delay seconds. Safe to call from any thread.
+        """
+        timer = (time.monotonic() + delay, next(self._timer_ids), callback)
+        if threading.get_ident() == self._thread_id:
+            heapq.heappush(self._timers, timer)
+        else:
+            self._pending_timers.append(timer)
+            self._wakeup()
+
+    def _run_timers(self):
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            deadline, timer_id, callback = heapq.heappop(self._timers)
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Timer callback {callback} failed: {e}")
+
+    def _select_timeout(self):
+        deadlines = []
+        if self._delayed:
+            deadlines.append(next(iter(self._delayed.values())))
+        if self._timers:
+            deadlines.append(self._timers[0][0])
+        if len(liveness_checks):
+            deadlines.append(liveness_checks.next_deadline())
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def _flush_dirty(self):
+        """
+        Write every connection that got data during this iteration, everything queued for it in one go.
+        With a flush delay the write waits until the delay is over or enough bytes are queued.
+        """
+        dirty, self._dirty = self._dirty, set()
+        if not self.flush_delay:
+            self._write_all(list(dirty))
+            return
+        now = time.monotonic()
+        ready = []
+        for client in dirty:
+            if client.outbound.size >= self.flush_bytes:
+                self._delayed.pop(client, None)
+                ready.append(client)
+            elif client not in self._delayed:
+                self._delayed[client] = now + self.flush_delay
+        # A constant delay keeps the deadlines in insertion order.
+        while self._delayed:
+            client, deadline = next(iter(self._delayed.items()))
+            if deadline > now:
+                break
+            del self._delayed[client]
+            ready.append(client)
+        self._write_all(ready)
+
+    def _write_all(self, clients: list):
+        """
+        Write many connections, split over the fan-out threads when there are enough of them.
+        Only the socket writes run on those threads, selector updates and disconnects stay on the loop.
+        """
+        if self._writers is None or len(clients) < PARALLEL_WRITE_MIN:
+            for client in clients:
+                self._write(client)
+            return
+        slices = [clients[i::self.fanout_threads] for i in range(self.fanout_threads)]
+        failures = []
+        for result in self._writers.map(self._send_all, slices):
+            failures.extend(result)
+        # Senders the writes resumed, their queues drained below the low watermark on the fan-out threads.
+        self._apply_interest()
+        for client, error in failures:
+            self._write_failed(client, error)
+        for client in clients:
+            self.update_interest(client)
+
+    def _send_all(self, clients: list) -> list:
+        """
+        returns:
+            list: (client, error) of the writes that failed.
+        """
+        failures = []
+        for client in clients:
+            try:
+                self._send(client)
+            except OSError as e:
+                failures.append((client, e))
+        return failures
+
+    def _send(self, client: Client):
+        """
+        Write as much of the client's outbound queue as its socket takes.
+        raises:
+            OSError: If the connection failed.
+        """
+        if client.socket is None:
+            return
+        try:
+            chunks = client.outbound.pending()
+            while chunks and client.write_batch(chunks):
+                chunks = client.outbound.pending()
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _write(self, client: Client):
+        self._delayed.pop(client, None)
+        try:
+            self._send(client)
+        except OSError as e:
+            self._write_failed(client, e)
+            return
+        self.update_interest(client)
+
+    def _write_failed(self, client: Client, error: OSError):
+        logger.error(f"Failed to send message to {client.address}: {error}")
+        metrics.SEND_FAILURES.inc()
+        client.connection_lost("Error sending message.")
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,410 @@
+from utils import logger, HISTORY_DIR, HISTORY_SEGMENT_BYTES, HISTORY_MAX_BYTES, HISTORY_MAX_AGE, HISTORY_FSYNC_INTERVAL
+import os
+import mmap
+import time
+import bisect
+import struct
+import threading
+import collections
+import protocol
+
+# Each room keeps its history in HISTORY_DIR/room-<id>/ as numbered segments. A <first seq>.log segment
+# holds the chat frames exactly as they were sent to the clients, back to back, so a replay is a slice of
+# the memory mapped file. Its <first seq>.idx file is a sparse index of (seq, timestamp, offset) entries,
+# one for the first frame of every second and at least one every INDEX_INTERVAL bytes.
+INDEX_ENTRY = struct.Struct("!QdQ")
+INDEX_INTERVAL = 4096
+EXPIRE_INTERVAL = 60
+
+class Segment:
+    def __init__(self, directory: str, first_seq: int):
+        self.first_seq = first_seq
+        self.log_path = os.path.join(directory, f"{first_seq:020d}.log")
+        self.index_path = os.path.join(directory, f"{first_seq:020d}.idx")
+        # Bytes written to the log file, frames in the segment and the sparse index entries.
+        self.size = 0
+        self.count = 0
+        self.index = []
+
+    def load(self):
+        """
+        Read the index of an existing segment and count its frames, cutting off a frame torn by a crash.
+        """
+        entries = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as index_file:
+                data = index_file.read()
+            entries = [INDEX_ENTRY.unpack_from(data, offset) for offset in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size)]
+        size = os.path.getsize(self.log_path)
+        self.index = [entry for entry in entries if entry[2] < size]
+        seq, offset = (self.index[-1][0], self.index[-1][2]) if self.index else (self.first_seq, 0)
+        if size:
+            with open(self.log_path, "rb") as log_file, mmap.mmap(log_file.fileno(), size, access=mmap.ACCESS_READ) as data:
+                while offset + protocol.HEADER.size <= size:
+                    end = offset + protocol.HEADER.size + protocol.HEADER.unpack_from(data, offset)[3]
+                    if end > size:
+                        break
+                    offset, seq = end, seq + 1
+        if offset < size:
+            logger.warning(f"Dropping {size - offset} bytes of a torn frame at the end of {self.log_path}")
+            os.truncate(self.log_path, offset)
+        self.size = offset
+        self.count = seq - self.first_seq
+
+    def offset_of(self, data, seq: int) -> int:
+        """
+        returns:
+            int: The offset of frame seq, found from the closest index entry before it.
+        """
+        position = bisect.bisect_right(self.index, (seq, float("inf"), 0)) - 1
+        current, _, offset = self.index[position] if position >= 0 else (self.first_seq, 0.0, 0)
+        while current < seq:
+            offset += protocol.HEADER.size + protocol.HEADER.unpack_from(data, offset)[3]
+            current += 1
+        return offset
+
+    def offset_since(self, timestamp: float, size: int):
+        """
+        returns:
+            int: The offset of the first frame of the second holding timestamp or later, None if there is none.
+        """
+        for seq, entry_time, offset in self.index:
+            if offset >= size:
+                break
+            if int(entry_time) >= int(timestamp):
+                return offset
+        return None
+
+class RoomHistory:
+    """
+    History of one room. Chat.dispatch only appends the encoded frame to an in-memory tail, the store's
+    writer thread writes it out, so fan-out never waits on the disk.
+    """
+    def __init__(self, store, chat_id: int):
+        self.store = store
+        self.chat_id = chat_id
+        self.directory = os.path.join(store.directory, f"room-{chat_id}")
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.segments = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(".log") and name[:-4].isdigit():
+                segment = Segment(self.directory, int(name[:-4]))
+                segment.load()
+                self.segments.append(segment)
+        self.next_seq = self.segments[-1].first_seq + self.segments[-1].count if self.segments else 0
+        # (seq, timestamp, frame) appended but not written to the log yet.
+        self.pending = collections.deque()
+        self.closed = False
+        # Writer thread only: the open files of the last segment.
+        self._log_file = None
+        self._index_file = None
+
+    def append(self, frame: bytes):
+        """
+        Record a frame, safe to call from any thread.
+        args:
+            frame (bytes): The encoded chat frame.
+        """
+        with self._lock:
+            self.pending.append((self.next_seq, time.time(), frame))
+            self.next_seq += 1
+        self.store.mark_dirty(self)
+
+    def replay(self, last: int = None, since: float = None, max_bytes: int = None) -> list:
+        """
+        Collect the recorded frames to send to a client that just joined.
+        args:
+            last (int): Replay the last messages, this many of them.
+            since (float): Replay everything from this unix timestamp on, to the second.
+            max_bytes (int): Leave out the oldest frames beyond this many bytes.
+        returns:
+            list: The frames as memoryviews of the mapped segments and bytes of the unwritten tail, in order.
+        """
+        with self._lock:
+            segments = [(segment, segment.size) for segment in self.segments]
+            pending = list(self.pending)
+            next_seq = self.next_seq
+        chunks = []
+        if since is None:
+            start_seq = max(0, next_seq - (last or 0))
+            if start_seq >= next_seq:
+                return chunks
+        for position, (segment, size) in enumerate(segments):
+            end_seq = segments[position + 1][0].first_seq if position + 1 < len(segments) else next_seq - len(pending)
+            if size == 0 or (since is None and end_seq <= start_seq):
+                continue
+            try:
+                with open(segment.log_path, "rb") as log_file:
+                    data = mmap.mmap(log_file.fileno(), size, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                continue  # expired since
+            if since is None:
+                offset = segment.offset_of(data, max(start_seq, segment.first_seq))
+            else:
+                offset = segment.offset_since(since, size)
+                if offset is None:
+                    continue
+                since = 0  # every later frame qualifies
+            # The memoryview keeps the mapping alive until the client's outbound queue is done with it.
+            chunks.append(memoryview(data)[offset:size])
+        for seq, timestamp, frame in pending:
+            if (since is None and seq >= start_seq) or (since is not None and int(timestamp) >= int(since)):
+                chunks.append(frame)
+        return chunks if max_bytes is None else trim(chunks, max_bytes)
+
+    def write_pending(self) -> bool:
+        """
+        Writer thread: write the unwritten tail to the log.
+        returns:
+            bool: True if anything was written and the files need an fsync.
+        """
+        with self._lock:
+            batch = list(self.pending)
+        if not batch:
+            return False
+        segment = self.segments[-1] if self.segments else None
+        index = []
+        size = count = 0
+        for seq, timestamp, frame in batch:
+            if segment is None or (segment.size + size >= HISTORY_SEGMENT_BYTES and segment.count + count):
+                if segment is not None:
+                    self._commit(segment, size, count, index)
+                    self.sync()
+                segment = Segment(self.directory, seq)
+                self._open(segment)
+                with self._lock:
+                    self.segments.append(segment)
+                index, size, count = [], 0, 0
+            if self._log_file is None:
+                self._open(segment)
+            offset = segment.size + size
+            last = index[-1] if index else (segment.index[-1] if segment.index else None)
+            if last is None or offset - last[2] >= INDEX_INTERVAL or int(timestamp) != int(last[1]):
+                index.append((seq, timestamp, offset))
+                self._index_file.write(INDEX_ENTRY.pack(seq, timestamp, offset))
+            self._log_file.write(frame)
+            size += len(frame)
+            count += 1
+        self._commit(segment, size, count, index)
+        return True
+
+    def _open(self, segment: Segment):
+        self.close_files()
+        self._log_file = open(segment.log_path, "ab")
+        self._index_file = open(segment.index_path, "ab")
+
+    def _commit(self, segment: Segment, size: int, count: int, index: list):
+        self._log_file.flush()
+        self._index_file.flush()
+        # The frames move from the tail to the segment in one step, a replay sees each of them exactly once.
+        with self._lock:
+            segment.size += size
+            segment.count += count
+            segment.index.extend(index)
+            for _ in range(count):
+                self.pending.popleft()
+
+    def sync(self):
+        for file in (self._log_file, self._index_file):
+            if file is not None:
+                os.fsync(file.fileno())
+
+    def close_files(self):
+        for file in (self._log_file, self._index_file):
+            if file is not None:
+                file.close()
+        self._log_file = self._index_file = None
+
+    def expire(self, now: float):
+        """
+        Expire old segments, keeping the one being written.
+        """
+        with self._lock:
+            segments = list(self.segments)
+        expired = expire_segments(self.directory, [segment.log_path for segment in segments[:-1]], sum(segment.size for segment in segments), now)
+        if expired:
+            with self._lock:
+                self.segments = self.segments[expired:]
+
+def trim(chunks: list, max_bytes: int) -> list:
+    """
+    Drop the oldest whole frames of a replay until it fits in max_bytes.
+    """
+    total = sum(len(chunk) for chunk in chunks)
+    while chunks and total > max_bytes:
+        chunk = chunks[0]
+        offset = 0
+        while offset < len(chunk) and total > max_bytes:
+            frame_size = protocol.HEADER.size + protocol.HEADER.unpack_from(chunk, offset)[3]
+            offset += frame_size
+            total -= frame_size
+        chunks[0] = chunk[offset:]
+        if offset >= len(chunk):
+            chunks.pop(0)
+    return chunks
+
+def expire_segments(directory: str, log_paths: list, total: int, now: float) -> int:
+    """
+    Delete segments, oldest first, while the room is over HISTORY_MAX_BYTES or they are older than HISTORY_MAX_AGE.
+    args:
+        directory (str): The room's history directory.
+        log_paths (list): The log files that may be deleted, oldest first.
+        total (int): The size of the room's history in bytes.
+        now (float): The current unix time.
+    returns:
+        int: The number of deleted segments.
+    """
+    expired = 0
+    for log_path in log_paths:
+        try:
+            size, modified = os.path.getsize(log_path), os.path.getmtime(log_path)
+        except OSError:
+            size, modified = 0, 0
+        if total <= HISTORY_MAX_BYTES and now - modified <= HISTORY_MAX_AGE:
+            break
+        for path in (log_path, log_path[:-4] + ".idx"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= size
+        expired += 1
+    if expired:
+        logger.info(f"Expired {expired} history segments in {directory}")
+    return expired
+
+class HistoryStore:
+    """
+    Owns the rooms' histories and the writer thread. Appends are group committed: the writer writes
+    everything queued since its last round, then fsyncs each touched file once, at most every HISTORY_FSYNC_INTERVAL.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # Past the rooms of the previous runs still on disk: a new room must not reopen an old room's log, see chat.first_room_id.
+        self.next_room_id = 1 + max((int(name[5:]) for name in os.listdir(directory)
+                                     if name.startswith("room-") and name[5:].isdigit()), default=0)
+        self.rooms = {}
+        self._dirty = set()
+        self._ready = threading.Condition(threading.Lock())
+        self._writer = None
+        self._pid = None
+        self._last_expire = 0.0
+
+    def room(self, chat_id: int) -> RoomHistory:
+        """
+        returns:
+            RoomHistory: The history of the room, created or reopened from disk.
+        """
+        with self._ready:
+            if self._writer is None or self._pid != os.getpid():
+                # Started lazily so every worker process of a multi-process server runs its own writer.
+                self._pid = os.getpid()
+                self._writer = threading.Thread(target=self._run, daemon=True)
+                self._writer.start()
+            history = self.rooms.get(chat_id)
+            if history is None:
+                history = self.rooms[chat_id] = RoomHistory(self, chat_id)
+            history.closed = False
+            return history
+
+    def has_room(self, chat_id: int) -> bool:
+        """
+        returns:
+            bool: True if the room has history, written by this run or an earlier one.
+        """
+        with self._ready:
+            if chat_id in self.rooms:
+                return True
+        directory = os.path.join(self.directory, f"room-{chat_id}")
+        try:
+            return any(name.endswith(".log") for name in os.listdir(directory))
+        except OSError:
+            return False
+
+    def close_room(self, chat_id: int):
+        """
+        Close the room's files once its tail was written.
+        """
+        with self._ready:
+            history = self.rooms.get(chat_id)
+            if history is not None:
+                history.closed = True
+                self._dirty.add(history)
+                self._ready.notify()
+
+    def flush(self, timeout: float) -> bool:
+        """
+        Wait until the writer wrote every room's appended frames to the logs, so another process can reopen them.
+        returns:
+            bool: False if it did not catch up within timeout seconds.
+        """
+        with self._ready:
+            self._dirty.update(self.rooms.values())
+            self._ready.notify()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._ready:
+                histories = list(self.rooms.values())
+            if not any(history.pending for history in histories):
+                return True
+            time.sleep(0.005)
+        return False
+
+    def mark_dirty(self, history: RoomHistory):
+        with self._ready:
+            self._dirty.add(history)
+            self._ready.notify()
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not self._dirty:
+                    if not self._ready.wait(EXPIRE_INTERVAL):
+                        break
+                dirty, self._dirty = self._dirty, set()
+            started = time.monotonic()
+            for history in dirty:
+                try:
+                    if history.write_pending():
+                        history.sync()
+                except OSError as e:
+                    logger.error(f"Failed to write the history of room {history.chat_id}: {e}")
+                if history.closed:
+                    with self._ready:
+                        if history.closed and not history.pending:
+                            history.close_files()
+                            self.rooms.pop(history.chat_id, None)
+            if started - self._last_expire >= EXPIRE_INTERVAL:
+                self._last_expire = started
+                try:
+                    self.expire()
+                except OSError as e:
+                    logger.error(f"Failed to expire history segments: {e}")
+            # Let appends pile up until the next commit.
+            time.sleep(max(0.0, HISTORY_FSYNC_INTERVAL - (time.monotonic() - started)))
+
+    def expire(self):
+        now = time.time()
+        for name in os.listdir(self.directory):
+            directory = os.path.join(self.directory, name)
+            # Anything else under the root is not ours to expire.
+            if not name.startswith("room-") or not name[5:].isdigit() or not os.path.isdir(directory):
+                continue
+            with self._ready:
+                history = self.rooms.get(int(name[5:]))
+            if history is not None:
+                history.expire(now)
+                continue
+            # A closed room: nothing writes to it, all of its segments can go.
+            log_paths = sorted(os.path.join(directory, log) for log in os.listdir(directory) if log.endswith(".log"))
+            expire_segments(directory, log_paths, sum(os.path.getsize(path) for path in log_paths), now)
+            if not os.listdir(directory):
+                os.rmdir(directory)
+
+# None when HISTORY_DIR is not set and rooms keep no history.
+store = HistoryStore(HISTORY_DIR) if HISTORY_DIR else None
+
+if __name__ == "__main__":
+    pass
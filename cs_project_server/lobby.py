@@ -0,0 +1,197 @@
+from utils import logger, LOBBY_PAGE_SIZE, ROOM_UPDATE_INTERVAL
+import threading
+import shared_data
+import protocol
+import metrics
+
+# The list of open rooms shown in the lobby, this worker's and, in a multi-process server, the other workers'.
+# It is a versioned snapshot changed one room at a time as rooms open, change and close: a room's label is built once per
+# change instead of once per lobby request, and the ordered list of the rooms and the text of a page once per version.
+# Lobby clients that subscribe get the changes pushed as ROOM_UPDATE frames, batched over ROOM_UPDATE_INTERVAL seconds,
+# and no longer the new room broadcasts. A change line carries the room's state, not a difference from the previous
+# one, so applying it to a snapshot that already has it does no harm.
+
+# Kinds of change.
+ADD = "add"
+UPDATE = "update"
+FULL = "full"
+REMOVE = "remove"
+
+class RoomList:
+    def __init__(self, page_size: int = LOBBY_PAGE_SIZE, interval: float = ROOM_UPDATE_INTERVAL):
+        self.page_size = max(1, page_size)
+        self.interval = interval
+        self._lock = threading.RLock()
+        self.version = 0
+        self.labels = {}  # chat_id -> lobby label of the open room, in the order the rooms opened
+        # (chat_id, label) pairs of the open rooms as of the current version, built when a page is first asked for.
+        self._snapshot = None
+        self._texts = {}  # (format, page) -> text of the page as of the current version
+        self._changes = {}  # chat_id -> kind of its change not pushed to the subscribers yet
+        self._flush_scheduled = False
+        self.subscribers = {}  # client_id -> Client
+
+    def on_room(self, chat_id: int, chat_room):
+        """
+        Registry listener, records the change of one of this worker's rooms.
+        """
+        with self._lock:
+            # The label is read under the lock, so of two concurrent changes of a room the later state is kept.
+            if chat_room is None:
+                self.set(chat_id, None, REMOVE)
+            elif chat_room.full:
+                self.set(chat_id, None, FULL)
+            else:
+                self.set(chat_id, str(chat_room))
+
+    def set(self, chat_id: int, label: str, gone: str = REMOVE):
+        """
+        Record the new state of a room.
+        args:
+            chat_id (int): The room.
+            label (str): Its lobby label, None if it is no longer open.
+            gone (str): FULL or REMOVE, why it is no longer open.
+        """
+        with self._lock:
+            previous = self.labels.get(chat_id)
+            if label == previous:
+                return
+            if label is None:
+                del self.labels[chat_id]
+                kind = gone
+            else:
+                self.labels[chat_id] = label
+                kind = ADD if previous is None else UPDATE
+            self.version += 1
+            self._snapshot = None
+            self._texts.clear()
+            if not self.subscribers:
+                return
+            pending = self._changes.get(chat_id)
+            if pending == ADD and label is None:
+                del self._changes[chat_id]  # opened and gone since the last push, the subscribers never saw it
+            elif pending != ADD:
+                self._changes[chat_id] = kind
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        if not self.interval:
+            self.flush()
+        elif shared_data.event_loop is not None:
+            shared_data.event_loop.call_later(self.interval, self.flush)
+        else:
+            timer = threading.Timer(self.interval, self.flush)
+            timer.daemon = True
+            timer.start()
+
+    def flush(self):
+        """
+        Push the recorded changes to the subscribers still in the lobby, one frame encoded for all of them.
+        """
+        with self._lock:
+            self._flush_scheduled = False
+            changes, self._changes = self._changes, {}
+            version = self.version
+            lines = [f"{kind} {chat_id} {self.labels[chat_id]}" if kind in (ADD, UPDATE) else f"{kind} {chat_id}"
+                     for chat_id, kind in changes.items()]
+            lobby = shared_data.registry.lobby
+            for client_id in [client_id for client_id, client in self.subscribers.items() if lobby.get(client_id) is not client]:
+                del self.subscribers[client_id]  # joined a room or left
+            subscribers = list(self.subscribers.values())
+        if not lines or not subscribers:
+            return
+        for frame in self._frames(f"version {version}", lines, protocol.ROOM_UPDATE):
+            variants = {}
+            for client in subscribers:
+                try:
+                    client.send_shared(frame, variants)
+                except Exception as e:
+                    logger.error(f"Failed to send room updates to {client.address}: {e}")
+                    metrics.SEND_FAILURES.inc()
+
+    @staticmethod
+    def _frames(header: str, lines: list, msg_type: int) -> list:
+        """
+        returns:
+            list: The lines encoded in as few frames as fit them, each frame starting with the header line.
+        """
+        frames = []
+        payload = [header]
+        size = len(header.encode("utf-8"))
+        for line in lines:
+            line_size = len(line.encode("utf-8")) + 1
+            if size + line_size > protocol.MAX_FRAME_SIZE and len(payload) > 1:
+                frames.append(protocol.encode_frame(msg_type, "\n".join(payload)))
+                payload = [header]
+                size = len(header.encode("utf-8"))
+            payload.append(line)
+            size += line_size
+        frames.append(protocol.encode_frame(msg_type, "\n".join(payload)))
+        return frames
+
+    def subscribe(self, client):
+        with self._lock:
+            self.subscribers[client.client_id] = client
+
+    def unsubscribe(self, client):
+        with self._lock:
+            self.subscribers.pop(client.client_id, None)
+
+    def pages(self) -> int:
+        return max(1, -(-len(self.labels) // self.page_size))
+
+    def page(self, number: int) -> tuple:
+        """
+        args:
+            number (int): The page, from 1, out of range numbers are brought to the first or the last page.
+        returns:
+            tuple: (version, page number, pages, rooms), the rooms of the page as (chat_id, label) pairs.
+        """
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = list(self.labels.items())
+            pages = self.pages()
+            number = min(max(number, 1), pages)
+            start = (number - 1) * self.page_size
+            return self.version, number, pages, self._snapshot[start:start + self.page_size]
+
+    def listing(self, number: int = 1) -> str:
+        """
+        returns:
+            str: A page of the rooms for a LIST_ROOMS reply, see protocol.LIST_ROOMS.
+        """
+        with self._lock:
+            # Keyed by the page actually shown, clients asking for made up page numbers do not grow the cache.
+            number = min(max(number, 1), self.pages())
+            text = self._texts.get(("listing", number))
+            if text is None:
+                version, page, pages, rooms = self.page(number)
+                lines = [f"version {version} page {page} of {pages}, {len(self.labels)} rooms"]
+                lines += [f"{chat_id} {label}" for chat_id, label in rooms]
+                text = self._texts[("listing", number)] = "\n".join(lines)
+            return text
+
+    def text(self, number: int = 1) -> str:
+        """
+        returns:
+            str: A page of the rooms as the lobby shows it, with how to ask for the others.
+        """
+        with self._lock:
+            number = min(max(number, 1), self.pages())
+            text = self._texts.get(("text", number))
+            if text is None:
+                version, page, pages, rooms = self.page(number)
+                text = ", ".join(label + "\n" for _, label in rooms) if rooms else "No available rooms"
+                if pages > 1:
+                    text += f"(page {page} of {pages}, {len(self.labels)} rooms, type 'rooms <page>' for another page)\n"
+                self._texts[("text", number)] = text
+            return text
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+room_list = RoomList()
+shared_data.registry.room_listeners.append(room_list.on_room)
+
+if __name__ == "__main__":
+    pass
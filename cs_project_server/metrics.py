@@ -0,0 +1,241 @@
+from utils import logger
+import bisect
+import threading
+import socket
+import shared_data
+import protocol
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Bucket upper bounds in seconds for the latency histograms.
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, fraction: float) -> float:
+        """
+        returns:
+            float: The upper bound of the bucket holding the quantile, an upper estimate of it.
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+class Metric:
+    """
+    A named metric family. Hot paths keep a reference to a child (see labels()) and only call inc/observe on it.
+    """
+    def __init__(self, name: str, help_text: str, kind: str, factory=Counter, label_names: tuple = (), callback=None):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.factory = factory
+        self.label_names = label_names
+        # For gauges read at scrape time: returns a number, or a {label values tuple: number} dict.
+        self.callback = callback
+        self.children = {}
+        self._lock = threading.Lock()
+        if not label_names and callback is None:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self._lock:
+                child = self.children.setdefault(values, self.factory())
+        return child
+
+    def remove(self, *values):
+        with self._lock:
+            self.children.pop(values, None)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    @property
+    def value(self):
+        return self._default.value
+
+    def samples(self) -> dict:
+        if self.callback is None:
+            return dict(self.children)
+        values = self.callback()
+        return values if isinstance(values, dict) else {(): values}
+
+    def render(self, lines: list):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        for values, sample in self.samples().items():
+            labels = [f'{name}="{value}"' for name, value in zip(self.label_names, values)]
+            if isinstance(sample, Histogram):
+                cumulative = 0
+                for bound, count in zip(sample.bounds + (float("inf"),), sample.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    bucket_labels = labels + [f'le="{le}"']
+                    lines.append(f"{self.name}_bucket{_label_text(bucket_labels)} {cumulative}")
+                lines.append(f"{self.name}_sum{_label_text(labels)} {sample.sum}")
+                lines.append(f"{self.name}_count{_label_text(labels)} {sample.count}")
+            else:
+                value = sample.value if isinstance(sample, Counter) else sample
+                lines.append(f"{self.name}{_label_text(labels)} {value}")
+
+def _label_text(labels: list) -> str:
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+_metrics = []
+
+def counter(name: str, help_text: str, label_names: tuple = ()) -> Metric:
+    metric = Metric(name, help_text, "counter", Counter, label_names)
+    _metrics.append(metric)
+    return metric
+
+def histogram(name: str, help_text: str, label_names: tuple = ()) -> Metric:
+    metric = Metric(name, help_text, "histogram", Histogram, label_names)
+    _metrics.append(metric)
+    return metric
+
+def gauge(name: str, help_text: str, callback, label_names: tuple = ()) -> Metric:
+    metric = Metric(name, help_text, "gauge", label_names=label_names, callback=callback)
+    _metrics.append(metric)
+    return metric
+
+def _room_queue_depths() -> dict:
+    depths = {}
+    for chat_id, chat_room in list(shared_data.registry.rooms.items()):
+        depths[(str(chat_id),)] = chat_room.message_queue.qsize() + sum(len(client.outbound) for client in list(chat_room.chat_clients))
+    return depths
+
+ACCEPTED = counter("chat_connections_accepted_total", "Accepted TCP connections.")
+REFUSED = counter("chat_connections_refused_total", "Connections closed with a busy frame by admission control.", ("reason",))
+ACTIVE = gauge("chat_connections_active", "Clients that picked a name and are still connected.", lambda: shared_data.registry.client_count())
+ROOMS = gauge("chat_rooms_active", "Open chat rooms.", lambda: len(shared_data.registry.rooms))
+HANDSHAKE = histogram("chat_handshake_seconds", "Time from accept until the client joined a room.")
+MESSAGES = counter("chat_messages_total", "Chat messages sent in all rooms.")
+ROOM_MESSAGES = counter("chat_room_messages_total", "Chat messages sent in each open room.", ("room",))
+ROOM_QUEUE_DEPTH = gauge("chat_room_queue_depth", "Frames waiting for delivery in each room.", _room_queue_depths, ("room",))
+FANOUT = histogram("chat_fanout_seconds", "Time to queue one message to every member of a room.")
+BYTES_IN = counter("chat_bytes_received_total", "Bytes read from clients.")
+BYTES_OUT = counter("chat_bytes_sent_total", "Bytes written to clients.")
+WRITE_CALLS = counter("chat_write_calls_total", "Socket write system calls.")
+SEND_FAILURES = counter("chat_send_failures_total", "Sends that failed with an error.")
+EVICTIONS = counter("chat_slow_consumer_evictions_total", "Clients disconnected for not reading fast enough.")
+DROPPED_FRAMES = counter("chat_dropped_frames_total", "Frames dropped from full outbound queues.")
+REAPED = counter("chat_connections_reaped_total", "Connections closed by the liveness checks.", ("reason",))
+RECEIVE_BUFFERS = gauge("chat_receive_buffers", "Pooled receive buffers holding a partial frame and free for reuse.",
+                        lambda: {("in_use",): protocol.receive_pool.in_use, ("free",): len(protocol.receive_pool.free)}, ("state",))
+THROTTLED = counter("chat_throttled_total", "Frames over a rate limit, by the limit exceeded and the action taken.", ("limit", "action"))
+PAUSED_SENDERS = counter("chat_sender_pauses_total", "Times a sender was paused by a full outbound queue.")
+SESSIONS = counter("chat_sessions_total", "Resumable session events: detached, resumed, refused and expired.", ("event",))
+
+def render() -> str:
+    """
+    returns:
+        str: Every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _metrics:
+        metric.render(lines)
+    return "\n".join(lines) + "\n"
+
+def summary(top_rooms: int = 10) -> dict:
+    """
+    returns:
+        dict: The headline numbers shown by the stats admin command.
+    """
+    rooms = sorted(((values[0], child.value) for values, child in list(ROOM_MESSAGES.children.items())), key=lambda room: -room[1])
+    depths = _room_queue_depths()
+    return {
+        "accepted": ACCEPTED.value,
+        "refused": sum(child.value for child in list(REFUSED.children.values())),
+        "active": shared_data.registry.client_count(),
+        "rooms": len(shared_data.registry.rooms),
+        "bytes_in": BYTES_IN.value,
+        "bytes_out": BYTES_OUT.value,
+        "messages": MESSAGES.value,
+        "send_failures": SEND_FAILURES.value,
+        "evictions": EVICTIONS.value,
+        "reaped": sum(child.value for child in list(REAPED.children.values())),
+        "dropped_frames": DROPPED_FRAMES.value,
+        "sender_pauses": PAUSED_SENDERS.value,
+        "throttled": sum(child.value for child in list(THROTTLED.children.values())),
+        "resumed": SESSIONS.labels("resumed").value,
+        "handshake_p50": HANDSHAKE._default.quantile(0.5),
+        "handshake_p99": HANDSHAKE._default.quantile(0.99),
+        "fanout_p50": FANOUT._default.quantile(0.5),
+        "fanout_p99": FANOUT._default.quantile(0.99),
+        "top_rooms": [(room, messages, depths.get((room,), 0)) for room, messages in rooms[:top_rooms]],
+    }
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# The running metrics endpoint, None if it is disabled.
+http_server = None
+
+def start_http_server(host: str, port: int, listener: socket.socket = None):
+    """
+    Serve /metrics on a background thread, port 0 disables the endpoint.
+    args:
+        listener (socket.socket): An already listening socket to serve on, the one taken over from the previous server in an upgrade.
+    """
+    global http_server
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler, bind_and_activate=listener is None)
+    except OSError as e:
+        logger.error(f"Failed to start the metrics endpoint on {host}:{port}: {e}")
+        return None
+    if listener is not None:
+        server.socket.close()
+        server.socket = listener
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Metrics available on http://{host}:{port}/metrics")
+    http_server = server
+    return server
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,163 @@
+from utils import logger, OUTBOUND_HIGH_WATERMARK, OUTBOUND_LOW_WATERMARK, SLOW_CONSUMER_POLICY
+import collections
+import threading
+import metrics
+
+# What to do when a client's buffer is above the high watermark.
+DROP_OLDEST = "drop_oldest"  # drop queued frames, oldest first, to make room
+DISCONNECT = "disconnect"    # evict the slow consumer
+PAUSE = "pause"              # stop reading from the sender until the buffer drains below the low watermark
+POLICIES = (DROP_OLDEST, DISCONNECT, PAUSE)
+
+class OutboundQueue:
+    """
+    Bounded buffer of encoded frames waiting to be written to one connection.
+    Senders only append here, the I/O layer (the event loop or the client's writer thread)
+    drains it, so a client that reads slowly never blocks anyone else.
+    """
+    def __init__(self, high_watermark: int = OUTBOUND_HIGH_WATERMARK, low_watermark: int = OUTBOUND_LOW_WATERMARK,
+                 policy: str = SLOW_CONSUMER_POLICY):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow consumer policy {policy}, expected one of {POLICIES}")
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.policy = policy
+        self.frames = collections.deque()
+        self.size = 0
+        # Bytes of the first frame that were already written.
+        self.head_offset = 0
+        # Frames of the batch the writer is writing right now, until it reports what it wrote with consume().
+        self.in_flight = 0
+        # Chunks put in front of the frames by restart(), still to be written.
+        self.restarted = 0
+        self.dropped = 0
+        self.closed = False
+        self.paused_senders = set()
+        self._ready = threading.Condition(threading.Lock())
+
+    def push(self, data: bytes, sender=None) -> bool:
+        """
+        Queue a frame, applying the slow consumer policy when the buffer is over the high watermark.
+        args:
+            data (bytes): The encoded frame.
+            sender (Client): The client the frame comes from, paused under the pause policy.
+        returns:
+            bool: False if the consumer should be disconnected, True otherwise.
+        """
+        pause_sender = False
+        with self._ready:
+            if self.closed:
+                return True
+            if self.size + len(data) > self.high_watermark:
+                if self.policy == DISCONNECT:
+                    return False
+                if self.policy == DROP_OLDEST:
+                    self._drop_oldest(len(data))
+                elif sender is not None and sender not in self.paused_senders:
+                    self.paused_senders.add(sender)
+                    pause_sender = True
+            self.frames.append(data)
+            self.size += len(data)
+            self._ready.notify()
+        if pause_sender:
+            metrics.PAUSED_SENDERS.inc()
+            sender.pause_reading()
+        return True
+
+    def _drop_oldest(self, incoming: int):
+        # Frames being written must be finished, or the stream would be corrupted. Once a write returned only
+        # the partly written first frame and a restart's chunks are, the rest may go.
+        keep = max(self.in_flight, self.restarted, 1 if self.head_offset else 0)
+        while len(self.frames) > keep and self.size + incoming > self.high_watermark:
+            dropped = self.frames[keep]
+            del self.frames[keep]
+            self.size -= len(dropped)
+            self.dropped += 1
+            metrics.DROPPED_FRAMES.inc()
+
+    def pending(self) -> list:
+        """
+        returns:
+            list: The queued frames in order, the first one without its already written bytes.
+        """
+        with self._ready:
+            return self._pending()
+
+    def _pending(self) -> list:
+        if not self.frames:
+            return []
+        chunks = list(self.frames)
+        self.in_flight = len(chunks)
+        if self.head_offset:
+            chunks[0] = memoryview(chunks[0])[self.head_offset:]
+        return chunks
+
+    def wait_pending(self, timeout: float = None) -> list:
+        """
+        Block until there is something to write or the queue is closed.
+        returns:
+            list: The pending chunks, empty once the queue is closed.
+        """
+        with self._ready:
+            while not self.frames and not self.closed:
+                if not self._ready.wait(timeout):
+                    break
+            return [] if self.closed else self._pending()
+
+    def consume(self, sent: int):
+        """
+        Mark bytes as written, resuming paused senders once the buffer is below the low watermark.
+        The writer calls it after every write of the pending frames, with 0 if the write failed: the batch is no
+        longer in flight then.
+        args:
+            sent (int): The number of bytes written to the socket.
+        """
+        with self._ready:
+            self.size -= sent
+            sent += self.head_offset
+            while self.frames and sent >= len(self.frames[0]):
+                sent -= len(self.frames.popleft())
+                self.restarted = max(0, self.restarted - 1)
+            self.head_offset = sent
+            self.in_flight = 0
+            resumed = []
+            if self.paused_senders and self.size <= self.low_watermark:
+                resumed, self.paused_senders = self.paused_senders, set()
+        for sender in resumed:
+            sender.resume_reading()
+
+    def restart(self, chunks: list):
+        """
+        Put chunks in front of the queued frames, for a new connection that takes over from a dropped one.
+        The first queued frame then continues from where the old connection stopped writing it.
+        """
+        with self._ready:
+            # The chunks and the rest of a partly written frame must be written whole, like frames in flight.
+            self.restarted = len(chunks)
+            if self.head_offset:
+                self.frames[0] = memoryview(self.frames[0])[self.head_offset:]
+                self.head_offset = 0
+                self.restarted += 1
+            self.frames.extendleft(reversed(chunks))
+            self.size += sum(len(chunk) for chunk in chunks)
+            self._ready.notify()
+
+    def close(self):
+        with self._ready:
+            self.closed = True
+            self.frames.clear()
+            self.size = 0
+            self.in_flight = 0
+            self.restarted = 0
+            resumed, self.paused_senders = self.paused_senders, set()
+            self._ready.notify_all()
+        for sender in resumed:
+            sender.resume_reading()
+        if self.dropped:
+            logger.info(f"Outbound queue closed after dropping {self.dropped} frames")
+
+    def __len__(self):
+        return len(self.frames)
+
+if __name__ == "__main__":
+    pass
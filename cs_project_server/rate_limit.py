@@ -0,0 +1,103 @@
+from utils import CLIENT_MESSAGE_RATE, CLIENT_BYTE_RATE, ROOM_MESSAGE_RATE, ROOM_BYTE_RATE, RATE_LIMIT_BURST, RATE_LIMIT_POLICY
+import time
+
+# What to do with a frame over the limit.
+PAUSE = "pause"            # handle it, then stop reading from the client until it is back under the limit
+DROP = "drop"              # discard it and tell the client
+DISCONNECT = "disconnect"  # close the connection
+POLICIES = (PAUSE, DROP, DISCONNECT)
+
+class Bucket:
+    """
+    Token bucket state of one connection or room, the rates and bursts are kept by its RateLimit.
+    """
+    __slots__ = ("messages", "bytes", "updated")
+
+    def __init__(self, messages: float, size: float, now: float):
+        self.messages = messages
+        self.bytes = size
+        self.updated = now
+
+class RateLimit:
+    """
+    Messages per second and bytes per second limits, each one a token bucket holding up to burst seconds of tokens.
+    The buckets are refilled lazily when a frame is charged to them, nothing runs for idle connections.
+    """
+    def __init__(self, message_rate: float, byte_rate: float, burst: float = RATE_LIMIT_BURST, policy: str = RATE_LIMIT_POLICY):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown rate limit policy {policy}, expected one of {POLICIES}")
+        self.message_rate = message_rate
+        self.byte_rate = byte_rate
+        self.message_burst = max(1.0, message_rate * burst)
+        self.byte_burst = byte_rate * burst
+        self.policy = policy
+
+    def __bool__(self):
+        return bool(self.message_rate or self.byte_rate)
+
+    def bucket(self, now: float = None):
+        """
+        returns:
+            Bucket: A full bucket, None if the limit is off so unlimited clients carry no state.
+        """
+        if not self:
+            return None
+        return Bucket(self.message_burst, self.byte_burst, time.monotonic() if now is None else now)
+
+    def _refill(self, bucket: Bucket, now: float):
+        elapsed = now - bucket.updated
+        if elapsed > 0:
+            bucket.messages = min(self.message_burst, bucket.messages + elapsed * self.message_rate)
+            bucket.bytes = min(self.byte_burst, bucket.bytes + elapsed * self.byte_rate)
+            bucket.updated = now
+
+    def take(self, bucket: Bucket, size: int, now: float) -> float:
+        """
+        Take a message of size bytes from the bucket if it holds enough tokens.
+        A message larger than the byte burst only needs a full bucket.
+        returns:
+            float: 0 if the tokens were taken, otherwise the seconds until they will be available.
+        """
+        self._refill(bucket, now)
+        waits = [0.0]
+        if self.message_rate and bucket.messages < 1:
+            waits.append((1 - bucket.messages) / self.message_rate)
+        needed = min(size, self.byte_burst)
+        if self.byte_rate and bucket.bytes < needed:
+            waits.append((needed - bucket.bytes) / self.byte_rate)
+        delay = max(waits)
+        if not delay:
+            self._charge(bucket, size)
+        return delay
+
+    def charge(self, bucket: Bucket, size: int, now: float) -> float:
+        """
+        Take a message of size bytes from the bucket, running it into debt if it does not hold enough tokens.
+        returns:
+            float: The seconds until the debt is paid back, 0 if there is none.
+        """
+        self._refill(bucket, now)
+        self._charge(bucket, size)
+        return self.debt(bucket, now)
+
+    def debt(self, bucket: Bucket, now: float) -> float:
+        """
+        returns:
+            float: The seconds until the bucket's debt is paid back, 0 if there is none.
+        """
+        self._refill(bucket, now)
+        return max(0.0, -bucket.messages / self.message_rate if self.message_rate else 0.0,
+                   -bucket.bytes / self.byte_rate if self.byte_rate else 0.0)
+
+    def _charge(self, bucket: Bucket, size: int):
+        if self.message_rate:
+            bucket.messages -= 1
+        if self.byte_rate:
+            bucket.bytes -= size
+
+# The limits of every connection, and of the chat messages posted in every room.
+client_limit = RateLimit(CLIENT_MESSAGE_RATE, CLIENT_BYTE_RATE)
+room_limit = RateLimit(ROOM_MESSAGE_RATE, ROOM_BYTE_RATE)
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,229 @@
+from utils import logger, RESUME_TIMEOUT, RESUME_BUFFER_BYTES
+import collections
+import secrets
+import time
+import shared_data
+import protocol
+import metrics
+
+# A client that offers "resume" gets a token in a RESUME frame. Both sides then count the bytes of the frames they
+# handle from the other after that point: the server from the frame following the OPTIONS offer, the client from the frame
+# following the token. When the connection drops, the client stays in its room, detached, with what is sent to it queued.
+# A new connection sends "<token> <bytes received>" as its first frame. The server answers "resumed <bytes received>"
+# and writes the stream again from the client's count, from the ring of what it wrote last, and then the queued frames.
+# The client does the same with what it wrote. Neither side goes through the name and lobby handshake again.
+
+class Session:
+    """
+    Resume state of one client: its token, the tail of the stream written to it and the bytes of the frames it sent.
+    """
+    def __init__(self, token: str, skip: int, limit: int = RESUME_BUFFER_BYTES):
+        self.token = token
+        self.limit = limit
+        # The last bytes written, at least limit of them, as the written chunks or slices of them.
+        self.chunks = collections.deque()
+        self.size = 0
+        # Stream bytes written since the token frame, and the next bytes to write that are not part of the stream.
+        self.written = 0
+        self.skip = skip
+        # Bytes of the frames handled from the client since its offer.
+        self.received = 0
+        # Monotonic time of the drop while detached, None while connected.
+        self.detached_at = None
+
+    def record(self, batch: list, sent: int):
+        """
+        Keep the bytes of a write.
+        args:
+            batch (list): The chunks handed to sendmsg.
+            sent (int): The bytes it wrote, the first ones of the batch.
+        """
+        for chunk in batch:
+            if sent <= 0:
+                break
+            part = chunk if len(chunk) <= sent else memoryview(chunk)[:sent]
+            sent -= len(part)
+            if self.skip:
+                if len(part) <= self.skip:
+                    self.skip -= len(part)
+                    continue
+                part, self.skip = memoryview(part)[self.skip:], 0
+            self.chunks.append(part)
+            self.size += len(part)
+            self.written += len(part)
+        while self.chunks and self.size - len(self.chunks[0]) >= self.limit:
+            self.size -= len(self.chunks.popleft())
+
+    def since(self, offset: int):
+        """
+        returns:
+            list: The stream written from offset on, None if the ring no longer reaches back to offset.
+        """
+        start = self.written - self.size
+        if not start <= offset <= self.written:
+            return None
+        chunks = []
+        for chunk in self.chunks:
+            if offset >= start + len(chunk):
+                start += len(chunk)
+                continue
+            chunks.append(memoryview(chunk)[offset - start:] if offset > start else chunk)
+            offset = start = start + len(chunk)
+        return chunks
+
+# token -> Client, every client with a session, connected or detached.
+by_token = {}
+
+def enabled() -> bool:
+    """
+    Sessions need the single process event loop: a resuming connection may reach another worker process,
+    and threaded mode has no way to move a socket to the reader thread of the session.
+    """
+    return RESUME_TIMEOUT > 0 and shared_data.event_loop is not None and shared_data.cluster is None
+
+def start(client):
+    """
+    Give the client a session, right after answering its OPTIONS offer.
+    args:
+        client (Client): The client.
+    """
+    token = secrets.token_urlsafe(18)
+    client.send_frame(protocol.RESUME, f"token {token}")
+    # Everything queued so far, the token frame included, is written before the stream starts.
+    client.session = Session(token, client.outbound.size)
+    by_token[token] = client
+
+def end(client):
+    """
+    Forget the client's session, its next disconnect is final.
+    """
+    if client.session is not None:
+        by_token.pop(client.session.token, None)
+        client.session = None
+    client.detached = False
+
+def detach(client, reason: str) -> bool:
+    """
+    Keep the place of a client whose connection dropped or stopped answering: it stays in its room and the registry,
+    the frames sent to it are queued, and it gives its connection slot back until it resumes or the session expires.
+    args:
+        client (Client): The client.
+        reason (str): Why the connection is considered lost.
+    returns:
+        bool: False if the client has no session to keep, the caller disconnects it then.
+    """
+    session = client.session
+    if session is None or client.detached or client.loop is None:
+        return False
+    client.loop.unregister(client)
+    try:
+        client.socket.close()
+    except OSError:
+        pass
+    client.socket = None
+    client.detached = True
+    shared_data.registry.close_connection(client)
+    session.detached_at = detached_at = time.monotonic()
+    client.loop.call_later(RESUME_TIMEOUT, lambda: _expire(client, detached_at))
+    metrics.SESSIONS.labels("detached").inc()
+    logger.info("Client %s lost its connection (%s), keeping its session for %gs", client.address, reason, RESUME_TIMEOUT)
+    return True
+
+def _expire(client, detached_at: float):
+    if client.detached and client.session is not None and client.session.detached_at == detached_at:
+        metrics.SESSIONS.labels("expired").inc()
+        client.disconnect_client("Session expired.")
+
+def resume(client, request: str):
+    """
+    Let a new connection take over the session its first frame names. The connection's socket moves to the session's
+    client, which is written the preamble the connection still had queued, the answer, and the stream from the client's count.
+    args:
+        client (Client): The new connection, before its name.
+        request (str): "<token> <bytes received>".
+    returns:
+        Client: The session's client now on this connection, None if it was answered "expired".
+    """
+    token, _, received = request.partition(" ")
+    owner = by_token.get(token)
+    if owner is None or not received.isdigit() or client.loop is None:
+        return _refuse(client)
+    # The client may notice the drop before the server does, the old connection is dead then.
+    if not owner.detached and not detach(owner, "Resumed from a new connection."):
+        return _refuse(client)
+    chunks = owner.session.since(int(received))
+    if chunks is None:
+        owner.disconnect_client("Session too far behind to resume.")
+        return _refuse(client)
+    loop = client.loop
+    preamble = [bytes(chunk) for chunk in client.outbound.pending()]
+    preamble.append(protocol.encode_frame(protocol.RESUME, f"resumed {owner.session.received}"))
+    loop.unregister(client)
+    new_socket, client.socket = client.socket, None
+    client.outbound.close()
+    owner.admitted, client.admitted = client.admitted, False
+    owner.socket = new_socket
+    owner.address = client.address
+    owner.detached = False
+    owner.session.detached_at = None
+    # A partial frame of the old connection is sent again by the client, from its count.
+    owner.parser = protocol.FrameParser()
+    owner.last_seen = time.monotonic()
+    owner.pinged_at = None
+    owner.stalled_since = None
+    # Whatever is left of an earlier resume's preamble and resent stream is not part of the stream, it goes.
+    owner.outbound.consume(owner.session.skip)
+    # The new preamble and the resent stream are written before the queued frames, and were recorded already.
+    owner.session.skip = sum(len(chunk) for chunk in preamble + chunks)
+    owner.outbound.restart(preamble + chunks)
+    loop.register_client(owner)
+    loop.update_interest(owner)
+    loop.schedule_write(owner)
+    metrics.SESSIONS.labels("resumed").inc()
+    logger.info("Client %s resumed its session from %s", owner.client_name, owner.address)
+    return owner
+
+def save(session: Session) -> dict:
+    """
+    returns:
+        dict: The session's counts for an upgrade's hand-over, its ring of written bytes goes separately.
+    """
+    return {
+        "token": session.token,
+        "limit": session.limit,
+        "written": session.written,
+        "skip": session.skip,
+        "received": session.received,
+        "detached_at": session.detached_at,
+    }
+
+def restore(client, state: dict, ring: bytes):
+    """
+    Give a client taken over from the previous process its session back. A detached one waits for a new connection
+    for what is left of RESUME_TIMEOUT since its drop, monotonic time is system wide.
+    args:
+        client (Client): The client, registered with the loop unless detached.
+        state (dict): What save() returned in the previous process.
+        ring (bytes): The last bytes written to the client, the session's ring.
+    """
+    session = Session(state["token"], state["skip"], state["limit"])
+    if ring:
+        session.chunks.append(ring)
+        session.size = len(ring)
+    session.written = state["written"]
+    session.received = state["received"]
+    session.detached_at = detached_at = state["detached_at"]
+    client.session = session
+    by_token[session.token] = client
+    if detached_at is not None:
+        client.detached = True
+        remaining = max(0.0, detached_at + RESUME_TIMEOUT - time.monotonic())
+        client.loop.call_later(remaining, lambda: _expire(client, detached_at))
+
+def _refuse(client):
+    metrics.SESSIONS.labels("refused").inc()
+    client.send_frame(protocol.RESUME, "expired")
+    return None
+
+if __name__ == "__main__":
+    pass
@@ -1,2 +1,214 @@
-clients: list = []
-chat_rooms: list = []
\ No newline at end of file
+import heapq
+import threading
+from utils import MATCH_ORDER
+
+class Registry:
+    """
+    Index of the connected clients and the chat rooms.
+    Lookups by id are O(1) dict reads; every mutation holds the lock so the
+    connection threads, the event loop and the admin console can share it.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clients: dict = {}     # client_id -> Client
+        self.rooms: dict = {}       # chat_id -> Chat
+        self.open_rooms: dict = {}  # chat_id -> Chat, rooms with free seats in creation order
+        # Matchmaking indexes: the open rooms in a heap of (rank, chat_id) by MATCH_ORDER, entries whose rank is no
+        # longer the room's current one are skipped when they come up, and the rooms each client name is in.
+        self._open_heap: list = []
+        self._open_rank: dict = {}  # chat_id -> rank of the open room, its live heap entry
+        self.rooms_by_name: dict = {}  # client name -> {chat_id: members of that name in the room}
+        self.lobby: dict = {}       # client_id -> Client, registered clients not in a room
+        # Called as listener(chat_id, chat) after a room opened, changed or closed (chat is None then).
+        self.room_listeners: list = []
+        # Admitted connections, from the accept until they close or are handed to another worker.
+        self.connections = 0
+        self.connections_per_ip: dict = {}  # ip -> admitted connections from it
+
+    def add_client(self, client):
+        with self._lock:
+            self.clients[client.client_id] = client
+            self.update_client(client)
+
+    def remove_client(self, client) -> bool:
+        """
+        Forget a client.
+        returns:
+            bool: True if the client was registered, False otherwise.
+        """
+        with self._lock:
+            self.lobby.pop(client.client_id, None)
+            return self.clients.pop(client.client_id, None) is not None
+
+    def update_client(self, client):
+        """
+        Keep the lobby index in sync after the client's room changed.
+        """
+        with self._lock:
+            if client.room_id is None and client.client_id in self.clients:
+                self.lobby[client.client_id] = client
+            else:
+                self.lobby.pop(client.client_id, None)
+
+    def get_client(self, client_id: int):
+        return self.clients.get(client_id)
+
+    def add_room(self, chat):
+        with self._lock:
+            self.rooms[chat.chat_id] = chat
+            self.update_room(chat)
+
+    def remove_room(self, chat, members: tuple = ()):
+        """
+        Forget a closed room.
+        args:
+            chat (Chat): The room.
+            members (tuple): The clients it was closed with, they were not removed one by one.
+        """
+        with self._lock:
+            self.rooms.pop(chat.chat_id, None)
+            self.open_rooms.pop(chat.chat_id, None)
+            self._open_rank.pop(chat.chat_id, None)
+            for client in members:
+                self._unindex_name(client.client_name, chat.chat_id, all_of_them=True)
+        self._notify_room(chat.chat_id, None)
+
+    def update_room(self, chat, joined=None, left=None):
+        """
+        Keep the open rooms and the matchmaking indexes in sync after the room's membership changed.
+        args:
+            chat (Chat): The room.
+            joined (Client): The client that was added, if one was.
+            left (Client): The client that was removed, if one was.
+        """
+        with self._lock:
+            if joined is not None:
+                rooms = self.rooms_by_name.setdefault(joined.client_name, {})
+                rooms[chat.chat_id] = rooms.get(chat.chat_id, 0) + 1
+            if left is not None:
+                self._unindex_name(left.client_name, chat.chat_id)
+            if chat.chat_id not in self.rooms:
+                return
+            if chat.full:
+                self.open_rooms.pop(chat.chat_id, None)
+                self._open_rank.pop(chat.chat_id, None)
+            else:
+                self.open_rooms[chat.chat_id] = chat
+                rank = (-len(chat.members), chat.chat_id) if MATCH_ORDER == "fill" else (chat.chat_id,)
+                if self._open_rank.get(chat.chat_id) != rank:
+                    self._open_rank[chat.chat_id] = rank
+                    heapq.heappush(self._open_heap, (rank, chat.chat_id))
+                    if len(self._open_heap) > 2 * len(self._open_rank) + 64:
+                        # Mostly stale entries of rooms that filled up or changed rank away from the top, rebuild.
+                        self._open_heap = [(rank, chat_id) for chat_id, rank in self._open_rank.items()]
+                        heapq.heapify(self._open_heap)
+        self._notify_room(chat.chat_id, chat)
+
+    def _unindex_name(self, name: str, chat_id: int, all_of_them: bool = False):
+        rooms = self.rooms_by_name.get(name)
+        if rooms is None or chat_id not in rooms:
+            return
+        if all_of_them or rooms[chat_id] == 1:
+            del rooms[chat_id]
+            if not rooms:
+                del self.rooms_by_name[name]
+        else:
+            rooms[chat_id] -= 1
+
+    def match_room(self, names: list = None):
+        """
+        Find the open room a matchmaking request goes to, the first one in MATCH_ORDER: the fullest and then the oldest
+        ("fill"), or the oldest ("age").
+        Any open room is the top of the heap, O(log n) amortized for skipping the stale entries. With names, the
+        candidates are the rooms the least common name is in, usually one or a few, checked against the other names.
+        args:
+            names (list): Client names that must all be in the room, none for any open room.
+        returns:
+            Chat: The room, None if no open room matches.
+        """
+        with self._lock:
+            if not names:
+                heap = self._open_heap
+                while heap:
+                    rank, chat_id = heap[0]
+                    if self._open_rank.get(chat_id) == rank:
+                        return self.rooms[chat_id]
+                    heapq.heappop(heap)
+                return None
+            indexed = [self.rooms_by_name.get(name, {}) for name in set(names)]
+            indexed.sort(key=len)
+            candidates = [chat_id for chat_id in indexed[0] if chat_id in self._open_rank
+                          and all(chat_id in rooms for rooms in indexed[1:])]
+            if not candidates:
+                return None
+            return self.rooms[min(candidates, key=self._open_rank.__getitem__)]
+
+    def _notify_room(self, chat_id: int, chat):
+        for listener in self.room_listeners:
+            listener(chat_id, chat)
+
+    def get_room(self, chat_id: int):
+        return self.rooms.get(chat_id)
+
+    def open_connection(self, ip: str, limit: int = 0, per_ip_limit: int = 0) -> bool:
+        """
+        Count a new connection unless it would go over the limits, 0 meaning no limit.
+        returns:
+            bool: True if the connection was admitted, False otherwise.
+        """
+        with self._lock:
+            from_ip = self.connections_per_ip.get(ip, 0)
+            if (limit and self.connections >= limit) or (per_ip_limit and from_ip >= per_ip_limit):
+                return False
+            self.connections += 1
+            self.connections_per_ip[ip] = from_ip + 1
+            return True
+
+    def close_connection(self, client):
+        """
+        Give back the client's admitted connection, only the first call for a client counts.
+        """
+        with self._lock:
+            if not client.admitted:
+                return
+            client.admitted = False
+            self.connections -= 1
+            ip = client.address[0]
+            if self.connections_per_ip.get(ip, 0) > 1:
+                self.connections_per_ip[ip] -= 1
+            else:
+                self.connections_per_ip.pop(ip, None)
+
+    def connection_count(self, ip: str = None) -> int:
+        """
+        returns:
+            int: The admitted connections, only the ones from ip if given.
+        """
+        if ip is None:
+            return self.connections
+        return self.connections_per_ip.get(ip, 0)
+
+    def client_count(self) -> int:
+        return len(self.clients)
+
+    def has_open_rooms(self) -> bool:
+        return bool(self.open_rooms)
+
+    def available_rooms(self) -> list:
+        with self._lock:
+            return list(self.open_rooms.values())
+
+    def all_clients(self) -> list:
+        with self._lock:
+            return list(self.clients.values())
+
+    def lobby_clients(self) -> list:
+        with self._lock:
+            return list(self.lobby.values())
+
+registry = Registry()
+# The running event loop when the server is started in loop mode, None in threaded mode.
+event_loop = None
+# In a multi-process server: cluster.Worker inside each worker, cluster.Supervisor in the parent process.
+cluster = None
+supervisor = None
@@ -6,6 +6,12 @@ import chat
 import shared_data
 import connection
 import client_handler
+import event_loop
+import protocol
+import cluster
+import upgrade
+import metrics
+import lobby
 
 def admin_commands(msg):
     """
@@ -20,45 +26,108 @@ def admin_commands(msg):
         case "status":
             logger.info("Server is running and accepting connections.")
             show_connected_clients()
+        case "stats":
+            show_stats()
         case "broadcast":
             message = input("Enter message to broadcast: ")
             broadcast_message(message)
         case _:
-            print("Available commands: status, broadcast")
+            print("Available commands: status, stats, broadcast")
 
 def show_connected_clients() :
     """
     Prints all connected clients.
     """
-    print(f"Connected clients: {len(shared_data.clients)}")
-    for client in shared_data.clients:
+    if shared_data.supervisor is not None:
+        for result in shared_data.supervisor.request("status"):
+            print(f"Worker {result['worker']} (pid {result['pid']}): {result['count']} connected clients")
+            for client in result["clients"]:
+                print(f"Client: {client}")
+        return
+    print(f"Connected clients: {shared_data.registry.client_count()}")
+    for client in shared_data.registry.all_clients():
         print(f"Client: {client}")
 
-def broadcast_message(message: str, exclude_busy_users: bool=False) -> bool:
+def show_stats():
+    """
+    Prints the server metrics, per worker process in a multi-process server.
+    """
+    if shared_data.supervisor is not None:
+        for result in shared_data.supervisor.request("stats"):
+            print(f"Worker {result['worker']} (pid {result['pid']}):")
+            print_stats(result)
+        return
+    print_stats(metrics.summary())
+
+def print_stats(stats: dict):
+    print(f"Connections: {stats['active']} active, {stats['accepted']} accepted, {stats['refused']} refused as busy, {stats['evictions']} evicted as slow consumers, {stats['reaped']} timed out, {stats['resumed']} sessions resumed")
+    print(f"Rooms: {stats['rooms']} open, {stats['messages']} messages")
+    print(f"Traffic: {stats['bytes_in']} bytes in, {stats['bytes_out']} bytes out, {stats['send_failures']} send failures")
+    print(f"Backpressure: {stats['dropped_frames']} frames dropped, {stats['sender_pauses']} sender pauses, {stats['throttled']} frames over a rate limit")
+    print(f"Handshake: p50 <= {stats['handshake_p50'] * 1000:g} ms, p99 <= {stats['handshake_p99'] * 1000:g} ms")
+    print(f"Fan-out: p50 <= {stats['fanout_p50'] * 1000:g} ms, p99 <= {stats['fanout_p99'] * 1000:g} ms")
+    for room, messages, depth in stats["top_rooms"]:
+        print(f"Room {room}: {messages} messages, {depth} frames queued")
+
+def broadcast_message(message: str, exclude_busy_users: bool=False, relay: bool=True, room_news: bool=False) -> bool:
     """
     Broadcast a message to all connected clients.
     args:
         message (str): The message to broadcast.
         exclude_busy_users (bool): If True, exclude clients in chat rooms.
+        relay (bool): In a worker process, also send it to the clients of the other workers.
+        room_news (bool): The message announces a room, skip the clients subscribed to the room list, they get a ROOM_UPDATE.
     returns:
         bool: True if broadcast was successful, False otherwise.
     """
-    payload = f"[Broadcast] {message}\n"
-    for client in shared_data.clients:
-        if exclude_busy_users and client.room_id is not None:
-            continue
-        print("Sending to", client.client_name)
+    if shared_data.supervisor is not None:
+        results = shared_data.supervisor.request("broadcast", message=message, exclude_busy_users=exclude_busy_users)
+        print(f"Broadcast complete on {len(results)} workers.")
+        return len(results) == shared_data.supervisor.count and all(result["success"] for result in results)
+    if relay and shared_data.cluster is not None:
+        shared_data.cluster.relay_broadcast(message, exclude_busy_users, room_news)
+    frame = protocol.encode_frame(protocol.BROADCAST, f"[Broadcast] {message}\n")
+    clients = shared_data.registry.lobby_clients() if exclude_busy_users else shared_data.registry.all_clients()
+    if room_news and lobby.room_list.subscribers:
+        subscribers = lobby.room_list.subscribers
+        clients = [client for client in clients if subscribers.get(client.client_id) is not client]
+    success = True
+    variants = {}
+    for client in clients:
         try:
-            client.socket.sendall(payload.encode("utf-8"))
+            # Only queues the shared frame, a slow client can't hold up the rest of the broadcast.
+            client.send_shared(frame, variants)
         except Exception as e:
             logger.error(f"Failed to send message to {client.address}: {e}")
-            return False
-    print("Broadcast complete.")
-    return True
+            metrics.SEND_FAILURES.inc()
+            success = False
+    print(f"Broadcast complete, sent to {len(clients)} clients.")
+    return success
 
 if __name__ == "__main__":
-    server_socket = connection.ConnectionHandler.start_server()
-    threading.Thread(target=connection.ConnectionHandler.handle_new_client_connections, args=(server_socket,)).start()
+    server_socket = None
+    loop = None
+    takeover = None
+    if utils.UPGRADE_SOCKET and (utils.WORKERS > 1 or utils.SERVER_MODE == "threaded"):
+        logger.warning("Upgrades need the single process event loop server, UPGRADE_SOCKET is ignored")
+    if utils.WORKERS > 1:
+        shared_data.supervisor = cluster.Supervisor(utils.WORKERS)
+        shared_data.supervisor.start()
+    elif utils.SERVER_MODE == "threaded":
+        server_socket = connection.ConnectionHandler.start_server()
+        threading.Thread(target=connection.ConnectionHandler.handle_new_client_connections, args=(server_socket,)).start()
+    else:
+        # With a server already running on the upgrade socket, this process takes its place.
+        takeover = upgrade.connect(utils.UPGRADE_SOCKET) if utils.UPGRADE_SOCKET else None
+        server_socket = takeover.listener if takeover is not None else connection.ConnectionHandler.start_server()
+        loop = event_loop.EventLoop(server_socket)
+        if takeover is not None:
+            takeover.restore(loop)
+        if utils.UPGRADE_SOCKET:
+            upgrade.listen(utils.UPGRADE_SOCKET, loop)
+        threading.Thread(target=loop.run, daemon=True).start()
+    if shared_data.supervisor is None:
+        metrics.start_http_server(utils.METRICS_HOST, utils.METRICS_PORT, takeover.metrics_listener if takeover is not None else None)
     logger.debug("Admin command interface started.")
 
     while True:
@@ -66,7 +135,12 @@ if __name__ == "__main__":
             command = input("Enter admin command (type 'exit' to quit): ")
             if command.lower() == "exit":
                 logger.info("Shutting down server...")
-                server_socket.close()
+                if loop is not None:
+                    loop.stop()
+                if shared_data.supervisor is not None:
+                    shared_data.supervisor.stop()
+                else:
+                    server_socket.close()
                 break
             else:
                 admin_commands(command)
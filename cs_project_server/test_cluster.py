@@ -0,0 +1,122 @@
+"""
+Tests of the multi-process server: a worker forked the way Supervisor.start forks it must have a log writer of its own,
+not the parent's listener that only looks started there, and its records must reach the log file. A client joining a
+room the moment it was created on another worker must get in.
+
+usage: python -m pytest test_cluster.py
+"""
+import os
+import re
+import sys
+import time
+import socket
+import subprocess
+import multiprocessing
+import pytest
+import utils
+import protocol
+
+def writers(logger) -> list:
+    """
+    returns:
+        list: (queue id, listener id) of each of the logger's queue handlers.
+    """
+    return [(id(handler.queue), id(handler.listener)) for handler in logger.handlers if hasattr(handler, "listener")]
+
+def forked_worker(name: str, inherited: list, errors):
+    """Stands in for cluster.run_worker, logs a line the way a worker does once it started."""
+    logger = utils.setup_logger(name)
+    # Inherited objects keep their ids in a forked child, the parent's queue or listener would show up here.
+    if not writers(logger) or set(writers(logger)) & set(inherited):
+        errors.put(f"the worker kept the parent's log writer: {writers(logger)}")
+    for handler in logger.handlers:
+        if hasattr(handler, "listener") and not handler.listener._thread.is_alive():
+            errors.put("no log writer running in the worker")
+    logger.info("Worker 0 started")
+    utils.close_logger(logger)
+
+def test_forked_worker_logs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    name = "fork_check"
+    logger = utils.setup_logger(name, async_mode=True)
+    logger.info("Supervisor started")
+    errors = multiprocessing.SimpleQueue()
+    # The workers are started as in Supervisor.start, forked from a parent whose log writer is running.
+    process = multiprocessing.get_context("fork").Process(target=forked_worker, args=(name, writers(logger), errors))
+    process.start()
+    process.join(10)
+    utils.close_logger(logger)
+    assert process.exitcode == 0
+    assert errors.empty(), errors.get()
+    lines = (tmp_path / f"{name}.log").read_text().splitlines()
+    assert any(line.endswith("Supervisor started") for line in lines)
+    assert any(line.endswith("Worker 0 started") for line in lines)
+
+class Connection:
+    """A chat client reading whole frames."""
+    def __init__(self, port: int):
+        self.socket = socket.create_connection(("127.0.0.1", port), timeout=5)
+        self.parser = protocol.FrameParser()
+        self.frames = []
+
+    def send(self, msg_type: int, text: str):
+        self.socket.sendall(protocol.encode_frame(msg_type, text))
+
+    def wait_for(self, *msg_types: int) -> tuple:
+        """
+        returns:
+            tuple: (msg_type, text) of the next frame of one of the types, the others are skipped.
+        """
+        while True:
+            while self.frames:
+                msg_type, text = self.frames.pop(0)
+                if msg_type in msg_types:
+                    return msg_type, text
+            data = self.socket.recv(65536)
+            if not data:
+                raise ConnectionError("the server closed the connection")
+            self.frames += [(msg_type, protocol.decode_text(payload)) for msg_type, _, payload in self.parser.feed(data)]
+
+    def close(self):
+        self.socket.close()
+
+@pytest.fixture
+def cluster(tmp_path):
+    """
+    yields:
+        tuple: (port, log file) of a server with two worker processes.
+    """
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    env = dict(os.environ, SERVER_PORT=str(port), WORKERS="2", METRICS_PORT="0", MAX_CONNECTIONS="100", HISTORY_DIR="",
+               LOG_LEVEL="INFO", PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    server = subprocess.Popen([sys.executable, os.path.join(env["PYTHONPATH"], "socket_server.py")], cwd=tmp_path, env=env,
+                              stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    log = tmp_path / "socket_server.log"
+    deadline = time.monotonic() + 10
+    while not log.exists() or log.read_text().count("Server listen on") < 2:
+        assert time.monotonic() < deadline and server.poll() is None, "the workers did not start"
+        time.sleep(0.05)
+    yield port, log
+    server.kill()
+    server.wait()
+
+def test_join_a_room_just_created_on_another_worker(cluster):
+    port, log = cluster
+    for attempt in range(20):
+        creator, joiner = Connection(port), Connection(port)
+        creator.send(protocol.CHAT, f"creator{attempt}")
+        creator.send(protocol.CHAT, "new")
+        room_id = re.search(r"room (\d+) created", creator.wait_for(protocol.JOIN)[1]).group(1)
+        # No delay: the other worker has most likely not heard of the room yet.
+        joiner.send(protocol.CHAT, f"joiner{attempt}")
+        joiner.send(protocol.CHAT, room_id)
+        msg_type, text = joiner.wait_for(protocol.JOIN, protocol.SYSTEM)
+        while msg_type == protocol.SYSTEM and "full or does not exist" not in text:
+            msg_type, text = joiner.wait_for(protocol.JOIN, protocol.SYSTEM)
+        assert msg_type == protocol.JOIN, f"attempt {attempt}: {text}"
+        creator.close()
+        joiner.close()
+    # The kernel spreads the connections over both workers, some of the joins crossed to the room's owner.
+    assert "off to worker" in log.read_text()
@@ -0,0 +1,131 @@
+"""
+Tests of the room history: the segment and index format, rollover to a new segment, reloading a segment whose last
+frame was torn by a crash, and the 'last <n>' and 'since <t>' replays, from the segments and the unwritten tail.
+
+usage: python -m pytest test_history.py
+"""
+import os
+import time
+import types
+import pytest
+import protocol
+import history
+
+class Clock:
+    """Stands in for the time module in history, with a unix time the test sets."""
+    def __init__(self, now: float):
+        self.now = now
+        self.monotonic = time.monotonic
+        self.sleep = time.sleep
+
+    def time(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock(1_700_000_000.0)
+    monkeypatch.setattr(history, "time", clock)
+    return clock
+
+def open_room(directory, chat_id: int = 1) -> history.RoomHistory:
+    """The history of a room, written by the test instead of the store's writer thread."""
+    store = types.SimpleNamespace(directory=str(directory), mark_dirty=lambda room: None)
+    return history.RoomHistory(store, chat_id)
+
+def frame(number: int) -> bytes:
+    return protocol.encode_frame(protocol.CHAT, f"message {number}")
+
+def texts(chunks: list) -> list:
+    return [protocol.decode_text(payload) for _, _, payload in protocol.FrameParser().feed(b"".join(bytes(chunk) for chunk in chunks))]
+
+def test_segment_format(tmp_path, clock):
+    room = open_room(tmp_path)
+    for number in range(3):
+        room.append(frame(number))
+    assert room.write_pending()
+    room.close_files()
+    directory = tmp_path / "room-1"
+    assert sorted(os.listdir(directory)) == [f"{0:020d}.idx", f"{0:020d}.log"]
+    # The frames back to back, exactly as they were sent.
+    assert (directory / f"{0:020d}.log").read_bytes() == b"".join(frame(number) for number in range(3))
+    # All three in the same second and INDEX_INTERVAL bytes: one index entry, for the first frame.
+    index = (directory / f"{0:020d}.idx").read_bytes()
+    assert [history.INDEX_ENTRY.unpack_from(index, offset) for offset in range(0, len(index), history.INDEX_ENTRY.size)] == [(0, clock.now, 0)]
+
+def test_index_entry_every_second(tmp_path, clock):
+    room = open_room(tmp_path)
+    for number in range(4):
+        room.append(frame(number))
+        clock.now += 0.5
+    room.write_pending()
+    assert [(seq, offset) for seq, _, offset in room.segments[0].index] == [(0, 0), (2, 2 * len(frame(0)))]
+
+def test_rollover_and_reload(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(history, "HISTORY_SEGMENT_BYTES", 3 * len(frame(0)))
+    room = open_room(tmp_path)
+    for number in range(10):
+        room.append(frame(number))
+    room.write_pending()
+    room.close_files()
+    assert [segment.first_seq for segment in room.segments] == [0, 3, 6, 9]
+    assert [segment.count for segment in room.segments] == [3, 3, 3, 1]
+    reloaded = open_room(tmp_path)
+    assert [(segment.first_seq, segment.count, segment.size) for segment in reloaded.segments] == \
+           [(segment.first_seq, segment.count, segment.size) for segment in room.segments]
+    assert reloaded.next_seq == 10
+    assert texts(reloaded.replay(last=10)) == [f"message {number}" for number in range(10)]
+
+def test_torn_frame_is_cut_on_reload(tmp_path, clock):
+    room = open_room(tmp_path)
+    for number in range(3):
+        room.append(frame(number))
+    room.write_pending()
+    room.close_files()
+    log_path = room.segments[-1].log_path
+    size = os.path.getsize(log_path)
+    with open(log_path, "ab") as log_file:
+        log_file.write(frame(3)[:-2])  # the process died in the middle of the write
+    reloaded = open_room(tmp_path)
+    assert os.path.getsize(log_path) == size
+    assert reloaded.next_seq == 3
+    # Appending carries on right after the last whole frame.
+    reloaded.append(frame(4))
+    reloaded.write_pending()
+    reloaded.close_files()
+    assert texts(open_room(tmp_path).replay(last=10)) == ["message 0", "message 1", "message 2", "message 4"]
+
+def test_replay_last(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(history, "HISTORY_SEGMENT_BYTES", 4 * len(frame(0)))
+    room = open_room(tmp_path)
+    for number in range(10):
+        room.append(frame(number))
+    room.write_pending()
+    # The last frames are still in the tail, not written yet.
+    for number in range(10, 12):
+        room.append(frame(number))
+    for last in (0, 1, 2, 3, 5, 12, 100):
+        assert texts(room.replay(last=last)) == [f"message {number}" for number in range(max(0, 12 - last), 12)], f"last {last}"
+    room.close_files()
+
+def test_replay_since(tmp_path, clock):
+    room = open_room(tmp_path)
+    start = clock.now
+    for number in range(6):
+        room.append(frame(number))
+        if number == 3:
+            room.write_pending()  # 0-3 in the segment, 4 and 5 in the tail
+        clock.now += 1
+    # Frame n was sent at start + n, a replay starts at the second holding the timestamp.
+    assert texts(room.replay(since=start + 2.5)) == ["message 2", "message 3", "message 4", "message 5"]
+    assert texts(room.replay(since=start + 4)) == ["message 4", "message 5"]
+    assert texts(room.replay(since=start - 100)) == [f"message {number}" for number in range(6)]
+    assert texts(room.replay(since=start + 100)) == []
+    room.close_files()
+
+def test_replay_max_bytes_keeps_whole_frames(tmp_path, clock):
+    room = open_room(tmp_path)
+    for number in range(10):
+        room.append(frame(number))
+    room.write_pending()
+    assert texts(room.replay(last=10, max_bytes=3 * len(frame(0)) + 1)) == ["message 7", "message 8", "message 9"]
+    room.close_files()
@@ -0,0 +1,153 @@
+"""
+Tests of the lobby's room list (lobby.RoomList): every change bumps the version once, the cache of page texts is keyed
+by the page actually shown so it stays bounded, and subscribed lobby clients get the changes as ROOM_UPDATE deltas,
+collapsed per room between two pushes and split over frames that each start with the version.
+
+usage: python -m pytest test_lobby.py
+"""
+import pytest
+import socket_server  # noqa: F401, imported before client_handler, which imports it back
+import shared_data
+import protocol
+import history
+import chat
+import lobby
+from client_handler import Client
+
+class _Loop:
+    """Stands in for the event loop: nothing is written, timers wait in calls until the test runs them."""
+    def __init__(self):
+        self.calls = []
+
+    def schedule_write(self, client):
+        pass
+
+    def update_interest(self, client):
+        pass
+
+    def call_later(self, delay, callback):
+        self.calls.append(callback)
+
+    def run_calls(self):
+        calls, self.calls = self.calls, []
+        for callback in calls:
+            callback()
+
+@pytest.fixture
+def loop(monkeypatch) -> _Loop:
+    loop = _Loop()
+    monkeypatch.setattr(shared_data, "event_loop", loop)
+    monkeypatch.setattr(shared_data, "registry", shared_data.Registry())
+    monkeypatch.setattr(history, "store", None)
+    return loop
+
+def lobby_client(client_id: int, room_list: lobby.RoomList) -> Client:
+    """A client waiting in the lobby, subscribed to the room list."""
+    client = Client(("test", client_id), object(), client_id=client_id, client_name=f"user{client_id}")
+    client.loop = shared_data.event_loop
+    shared_data.registry.add_client(client)
+    room_list.subscribe(client)
+    return client
+
+def updates(client: Client) -> list:
+    """The ROOM_UPDATE frames queued to the client, as lists of lines, taken off its queue."""
+    stream = b"".join(bytes(frame) for frame in client.outbound.frames)
+    client.outbound.consume(client.outbound.size)
+    return [protocol.decode_text(payload).split("\n") for msg_type, _, payload in protocol.FrameParser().feed(stream)
+            if msg_type == protocol.ROOM_UPDATE]
+
+def test_version_bumps_once_per_change():
+    room_list = lobby.RoomList(interval=0)
+    room_list.set(1, "room 1")
+    assert room_list.version == 1
+    room_list.set(1, "room 1")  # no change
+    assert room_list.version == 1
+    room_list.set(1, "room 1, 2 members")
+    room_list.set(2, "room 2")
+    room_list.set(1, None, lobby.FULL)
+    room_list.set(1, None)  # already gone
+    assert room_list.version == 4
+    assert room_list.page(1) == (4, 1, 1, [(2, "room 2")])
+
+def test_pages():
+    room_list = lobby.RoomList(page_size=2, interval=0)
+    for chat_id in range(1, 6):
+        room_list.set(chat_id, f"room {chat_id}")
+    assert room_list.pages() == 3
+    assert room_list.page(2) == (5, 2, 3, [(3, "room 3"), (4, "room 4")])
+    # Out of range pages are the first or the last one.
+    assert room_list.page(-7)[1:] == (1, 3, [(1, "room 1"), (2, "room 2")])
+    assert room_list.page(99)[1:] == (3, 3, [(5, "room 5")])
+    assert room_list.listing(3).split("\n") == ["version 5 page 3 of 3, 5 rooms", "5 room 5"]
+    assert lobby.RoomList(interval=0).text() == "No available rooms"
+
+def test_page_cache_is_bounded_and_dropped_on_change():
+    room_list = lobby.RoomList(page_size=2, interval=0)
+    for chat_id in range(1, 6):
+        room_list.set(chat_id, f"room {chat_id}")
+    for number in list(range(-50, 50)) + [10 ** 9]:
+        room_list.listing(number)
+        room_list.text(number)
+    assert set(room_list._texts) == {(format, page) for format in ("listing", "text") for page in (1, 2, 3)}
+    text = room_list.text(2)
+    assert room_list.text(2) is text
+    room_list.set(3, "room 3, renamed")
+    assert not room_list._texts
+    assert "room 3, renamed" in room_list.text(2)
+
+def test_deltas_pushed_right_away(loop):
+    room_list = lobby.RoomList(interval=0)
+    client = lobby_client(1, room_list)
+    room_list.set(7, "room 7")
+    room_list.set(7, "room 7, 2 members")
+    room_list.set(7, None, lobby.FULL)
+    room_list.set(7, "room 7, 1 member")
+    room_list.set(7, None)
+    assert updates(client) == [["version 1", "add 7 room 7"], ["version 2", "update 7 room 7, 2 members"],
+                               ["version 3", "full 7"], ["version 4", "add 7 room 7, 1 member"], ["version 5", "remove 7"]]
+
+def test_deltas_collapse_between_pushes(loop):
+    room_list = lobby.RoomList(interval=0.25)
+    room_list.set(1, "room 1")
+    room_list.set(2, "room 2")
+    client = lobby_client(1, room_list)
+    room_list.set(1, "room 1, renamed")
+    room_list.set(1, None, lobby.FULL)  # the last change of a room wins
+    room_list.set(3, "room 3")
+    room_list.set(3, "room 3, 2 members")  # still an add, with the latest label
+    room_list.set(4, "room 4")
+    room_list.set(4, None)  # opened and gone, never seen
+    room_list.set(2, "room 2, renamed")
+    assert len(loop.calls) == 1  # one push scheduled for all of them
+    loop.run_calls()
+    assert updates(client) == [["version 9", "full 1", "add 3 room 3, 2 members", "update 2 room 2, renamed"]]
+    loop.run_calls()
+    assert updates(client) == []
+
+def test_only_lobby_subscribers_get_deltas(loop, monkeypatch):
+    monkeypatch.setattr(chat.Chat, "_max_chat_size", 2)
+    room_list = lobby.RoomList(interval=0)
+    shared_data.registry.room_listeners.append(room_list.on_room)
+    waiting = lobby_client(1, room_list)
+    joining = lobby_client(2, room_list)
+    room = chat.Chat()
+    shared_data.registry.add_room(room)
+    room.add_client(joining)
+    # Changes pushed while the joining client was still in the lobby reach it, the next ones no longer.
+    assert updates(joining)[0] == ["version 1", f"add {room.chat_id} Chat Room: {room.chat_id} | Users: "]
+    room.add_client(Client(("test", 3), object(), client_id=3, client_name="user3"))
+    assert updates(waiting)[-1] == ["version 3", f"full {room.chat_id}"]
+    assert updates(joining) == []
+    assert set(room_list.subscribers) == {1}
+
+def test_large_push_is_split_over_frames(loop):
+    room_list = lobby.RoomList(interval=0.25)
+    client = lobby_client(1, room_list)
+    label = "x" * (protocol.MAX_FRAME_SIZE // 3)
+    for chat_id in range(1, 8):
+        room_list.set(chat_id, f"{chat_id} {label}")
+    loop.run_calls()
+    pushed = updates(client)
+    assert len(pushed) > 1
+    assert all(lines[0] == "version 7" for lines in pushed)
+    assert [line.split()[1] for lines in pushed for line in lines[1:]] == [str(chat_id) for chat_id in range(1, 8)]
@@ -0,0 +1,140 @@
+"""
+Tests of matchmaking (Registry.match_room): 'any' goes to the first open room in MATCH_ORDER, full and closed rooms
+are never matched, stale heap entries of rooms whose membership changed are skipped, and 'with <name>' goes to an open
+room every named user is in, down to the JOIN frame of the lobby request.
+
+usage: python -m pytest test_matchmaking.py
+"""
+import itertools
+import pytest
+import socket_server  # noqa: F401, imported before client_handler, which imports it back
+import shared_data
+import protocol
+import history
+import chat
+from connection import ConnectionHandler
+from client_handler import Client
+
+ROOM_SIZE = 3
+
+class _QuietLoop:
+    """Stands in for the event loop: nothing is written, no manager threads, presence timers never fire."""
+    def schedule_write(self, client):
+        pass
+
+    def update_interest(self, client):
+        pass
+
+    def call_later(self, delay, callback):
+        pass
+
+_client_ids = itertools.count(1)
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch) -> shared_data.Registry:
+    monkeypatch.setattr(shared_data, "event_loop", _QuietLoop())
+    monkeypatch.setattr(shared_data, "registry", shared_data.Registry())
+    monkeypatch.setattr(shared_data, "cluster", None)
+    monkeypatch.setattr(history, "store", None)
+    monkeypatch.setattr(chat.Chat, "_max_chat_size", ROOM_SIZE)
+    return shared_data.registry
+
+def client(name: str) -> Client:
+    new_client = Client(("test", 0), object(), client_id=next(_client_ids), client_name=name)
+    new_client.loop = shared_data.event_loop
+    shared_data.registry.add_client(new_client)
+    return new_client
+
+def room(*names: str) -> chat.Chat:
+    """A new room with a member of each name."""
+    new_room = chat.Chat()
+    shared_data.registry.add_room(new_room)
+    for name in names:
+        new_room.add_client(client(name))
+    return new_room
+
+def frames(to_client: Client) -> list:
+    return [(msg_type, protocol.decode_text(payload))
+            for msg_type, _, payload in protocol.FrameParser().feed(b"".join(bytes(frame) for frame in to_client.outbound.frames))]
+
+def test_fill_order(registry):
+    first = room("a")
+    second = room("b", "c")
+    third = room("d")
+    # The fullest room first, then the oldest of the same size.
+    assert registry.match_room() is second
+    second.add_client(client("e"))
+    assert registry.match_room() is first
+    third.add_client(client("f"))
+    assert registry.match_room() is third
+
+def test_age_order(registry, monkeypatch):
+    monkeypatch.setattr(shared_data, "MATCH_ORDER", "age")
+    first = room("a")
+    room("b", "c")
+    assert registry.match_room() is first
+
+def test_leaving_changes_the_rank(registry):
+    first = room("a")
+    second = room("b", "c")
+    assert registry.match_room() is second
+    # The heap still holds second's old rank, it is skipped and the room is matched by its new one.
+    second.remove_client(second.chat_clients[0])
+    assert registry.match_room() is first
+
+def test_full_and_closed_rooms_are_not_matched(registry):
+    full = room("a", "b", "c")
+    closed = room("d")
+    closed.remove_client(closed.chat_clients[0])
+    assert registry.get_room(closed.chat_id) is None
+    assert registry.match_room() is None
+    assert registry.match_room(["a"]) is None
+    assert registry.match_room(["d"]) is None
+    # A seat freed in the full room opens it again.
+    full.remove_client(full.chat_clients[0])
+    assert registry.match_room() is full
+
+def test_stale_heap_entries_are_bounded(registry):
+    rooms = [room("a", "b") for _ in range(10)]
+    for _ in range(200):
+        for some_room in rooms:
+            member = some_room.chat_clients[0]
+            some_room.remove_client(member)
+            some_room.add_client(member)
+    assert len(registry._open_heap) <= 2 * len(registry._open_rank) + 64
+    assert registry.match_room() is rooms[0]
+
+def test_with_names(registry):
+    room("alice")
+    both = room("alice", "bob")
+    room("bob", "carol", "dave")  # full
+    assert registry.match_room(["bob"]) is both
+    assert registry.match_room(["bob", "alice"]) is both
+    assert registry.match_room(["alice", "alice"]) is both
+    assert registry.match_room(["carol"]) is None
+    assert registry.match_room(["bob", "carol"]) is None
+    assert registry.match_room(["nobody"]) is None
+
+def test_with_names_picks_the_first_in_match_order(registry):
+    room("alice")
+    fuller = room("alice", "bob")
+    assert registry.match_room(["alice"]) is fuller
+
+def test_name_stays_indexed_while_one_of_its_clients_is_in_the_room(registry):
+    twins = room("alice", "alice")
+    twins.remove_client(twins.chat_clients[0])
+    assert registry.match_room(["alice"]) is twins
+    twins.add_client(client("bob"))
+    twins.remove_client(twins.chat_clients[0])
+    assert registry.match_room(["alice"]) is None
+
+def test_with_request_joins_the_room(registry):
+    target = room("alice")
+    joiner = client("joiner")
+    assert ConnectionHandler.handle_lobby_input(joiner, "with alice")
+    assert joiner.room_id == target.chat_id and joiner in target.chat_clients
+    assert (protocol.JOIN, f"Joined chat room {target.chat_id}.\n") in frames(joiner)
+    stranger = client("stranger")
+    assert not ConnectionHandler.handle_lobby_input(stranger, "with nobody")
+    assert stranger.room_id is None
+    assert frames(stranger)[-1][1].startswith("No open chat room with nobody.")
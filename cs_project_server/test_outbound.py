@@ -0,0 +1,61 @@
+"""
+Tests of the outbound queue's slow consumer handling: under the drop_oldest policy the queue of a client that stopped
+reading stays at the high watermark, and what it does write is still a stream of whole frames.
+
+usage: python -m pytest test_outbound.py
+"""
+import socket
+import socket_server  # noqa: F401, imported before client_handler, which imports it back
+import protocol
+import outbound
+from client_handler import Client
+
+HIGH_WATERMARK = 64 * 1024
+
+def stalled_client() -> tuple:
+    """
+    returns:
+        tuple: (client, the peer socket that never reads), the client drops the oldest frames over HIGH_WATERMARK.
+    """
+    writer, reader = socket.socketpair()
+    writer.setblocking(False)
+    client = Client(("test", 0), writer, client_id=1, client_name="stalled")
+    client.outbound = outbound.OutboundQueue(HIGH_WATERMARK, HIGH_WATERMARK // 4, outbound.DROP_OLDEST)
+    return client, reader
+
+def write(client: Client):
+    """One write attempt as the event loop makes it."""
+    try:
+        chunks = client.outbound.pending()
+        while chunks and client.write_batch(chunks):
+            chunks = client.outbound.pending()
+    except BlockingIOError:
+        pass
+
+def test_drop_oldest_stays_at_high_watermark():
+    client, reader = stalled_client()
+    frames = 3000
+    for number in range(frames):
+        # One frame per loop iteration, and a write attempt after it.
+        client.outbound.push(protocol.encode_frame(protocol.CHAT, f"{number} " + "x" * 1000))
+        write(client)
+        assert client.outbound.size <= HIGH_WATERMARK
+    # The socket buffers took some, the queue dropped most of the rest.
+    assert client.outbound.dropped > frames // 2
+    # The reader catches up: everything still queued is written, then the connection ends.
+    reader.setblocking(False)
+    stream = bytearray()
+    while client.outbound.size:
+        try:
+            stream += reader.recv(1 << 20)
+        except BlockingIOError:
+            write(client)
+    client.socket.shutdown(socket.SHUT_WR)
+    reader.setblocking(True)
+    while data := reader.recv(1 << 20):
+        stream += data
+    numbers = [int(protocol.decode_text(payload).split()[0]) for _, _, payload in protocol.FrameParser().feed(bytes(stream))]
+    assert len(numbers) == frames - client.outbound.dropped
+    assert numbers == sorted(numbers) and numbers[-1] == frames - 1
+    client.socket.close()
+    reader.close()
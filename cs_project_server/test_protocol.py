@@ -0,0 +1,105 @@
+"""
+Tests of the receive path: frames of multilingual text split between reads at every byte offset must come out of
+FrameParser and decode_text() unchanged, and malformed UTF-8 must decode with replacement characters.
+
+usage: python -m pytest test_protocol.py
+"""
+import pytest
+import protocol
+from text_samples import MESSAGES
+
+# Payloads that are not valid UTF-8, and what they must decode to.
+MALFORMED = (
+    ("שלום".encode("utf-8")[:-1], "שלו�"),
+    (b"\x80abc", "�abc"),
+    ("😀".encode("utf-8")[:3] + b"!", "�!"),
+    (b"\xc0\xaf", "��"),
+)
+
+class ChunkedSocket:
+    """Serves recv_into() from a list of chunks, one chunk per call at most, then b"" for a closed connection."""
+    def __init__(self, chunks: list):
+        self.chunks = [chunk for chunk in chunks if chunk]
+
+    def recv_into(self, buffer) -> int:
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        size = min(len(chunk), len(buffer))
+        buffer[:size] = chunk[:size]
+        if size < len(chunk):
+            self.chunks.insert(0, chunk[size:])
+        return size
+
+def stream_of(compressed: bool) -> bytes:
+    frames = []
+    for message in MESSAGES:
+        if compressed:
+            frames.append(protocol.encode_frame(protocol.CHAT, protocol.deflate(message.encode("utf-8"), 6), protocol.FLAG_DEFLATE))
+        else:
+            frames.append(protocol.encode_frame(protocol.CHAT, message))
+    return b"".join(frames)
+
+def feed_all(chunks: list) -> list:
+    """
+    returns:
+        list: The texts of the frames fed in chunks to FrameParser.feed, decoded as the client does.
+    """
+    parser = protocol.FrameParser()
+    inflater = protocol.Inflater()
+    return [protocol.decode_text(inflater.decompress(payload, flags)) for chunk in chunks for _, flags, payload in parser.feed(chunk)]
+
+def receive_all(chunks: list) -> list:
+    """
+    returns:
+        list: The texts of the frames read with FrameParser.recv_from, decoded as the server does.
+    """
+    sock = ChunkedSocket(chunks)
+    parser = protocol.FrameParser()
+    inflater = protocol.Inflater()
+    texts = []
+    while parser.recv_from(sock):
+        for _, flags, payload in parser.frames():
+            texts.append(protocol.decode_text(inflater.decompress(payload, flags)))
+    return texts
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_feed_split_at_every_offset(compressed):
+    stream = stream_of(compressed)
+    for offset in range(len(stream) + 1):
+        assert feed_all([stream[:offset], stream[offset:]]) == list(MESSAGES), f"split at byte {offset}"
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_recv_from_split_at_every_offset(compressed):
+    stream = stream_of(compressed)
+    for offset in range(len(stream) + 1):
+        assert receive_all([stream[:offset], stream[offset:]]) == list(MESSAGES), f"split at byte {offset}"
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_one_byte_reads(compressed):
+    stream = stream_of(compressed)
+    chunks = [stream[i:i + 1] for i in range(len(stream))]
+    assert feed_all(chunks) == list(MESSAGES)
+    assert receive_all(chunks) == list(MESSAGES)
+
+def test_decoder_only_sees_whole_frames():
+    # Why no incremental decoder is needed: a character split between reads is never handed to the decoder, the parser
+    # holds the partial frame until its last byte arrives, so every payload it yields is valid UTF-8 on its own.
+    stream = stream_of(False)
+    for offset in range(len(stream) + 1):
+        parser = protocol.FrameParser()
+        for chunk in (stream[:offset], stream[offset:]):
+            for _, _, payload in parser.feed(chunk):
+                str(payload, "utf-8")  # strict, raises on a partial character
+
+@pytest.mark.parametrize("payload, expected", MALFORMED)
+def test_decode_text_malformed(payload, expected):
+    assert protocol.decode_text(payload) == expected
+    assert feed_all([protocol.encode_frame(protocol.CHAT, payload)]) == [expected]
+
+def test_decode_text_every_prefix():
+    # A truncated payload decodes with a replacement character instead of raising, whatever byte it was cut at.
+    for message in MESSAGES:
+        data = message.encode("utf-8")
+        for offset in range(len(data) + 1):
+            assert protocol.decode_text(memoryview(data)[:offset]) == data[:offset].decode("utf-8", "replace")
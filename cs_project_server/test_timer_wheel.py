@@ -0,0 +1,101 @@
+"""
+Tests of the liveness timer wheel: timers fire in the tick of their deadline and never before it, each once,
+timers more than one revolution away wait for their own turn of the wheel, and the timer of a connection that is
+gone is dropped when it fires instead of being cancelled.
+
+usage: python -m pytest test_timer_wheel.py
+"""
+import pytest
+import socket_server  # noqa: F401, imported before client_handler, which imports it back
+import connection
+from connection import ConnectionHandler
+from client_handler import Client
+from timer_wheel import TimerWheel
+
+TICK = 0.5
+
+def start_of(wheel: TimerWheel) -> float:
+    """The monotonic time the wheel's next tick starts at."""
+    return wheel.current * wheel.tick
+
+def fired_at(wheel: TimerWheel, now: float, until: float) -> dict:
+    """
+    Advance the wheel a tick at a time from now to until.
+    returns:
+        dict: item -> the times it was returned at.
+    """
+    fired = {}
+    while now <= until:
+        for item in wheel.expire(now):
+            fired.setdefault(item, []).append(now)
+        now += wheel.tick
+    return fired
+
+@pytest.mark.parametrize("offset", [0.0, 0.1, 0.49])
+@pytest.mark.parametrize("delay", [0.0, 0.2, 0.5, 1.0, 3.3])
+def test_fires_on_time(offset, delay):
+    wheel = TimerWheel(TICK)
+    now = start_of(wheel) + offset
+    wheel.schedule(delay, "timer", now)
+    assert len(wheel) == 1
+    fired = fired_at(wheel, now, now + delay + 3 * TICK)
+    # Rounded up to the next tick: never early, at most one tick late, and only once.
+    assert len(fired["timer"]) == 1
+    assert now + delay <= fired["timer"][0] < now + delay + 2 * TICK
+    assert len(wheel) == 0 and wheel.next_deadline() is None
+
+def test_expires_in_deadline_order():
+    wheel = TimerWheel(TICK)
+    now = start_of(wheel)
+    for delay in (3, 1, 2):
+        wheel.schedule(delay, delay, now)
+    assert wheel.next_deadline() == now
+    assert wheel.expire(now + 1.4) == []
+    assert wheel.expire(now + 1.5) == [1]
+    assert wheel.expire(now + 2.5) == [2]
+    assert wheel.expire(now + 3.5) == [3]
+    assert wheel.expire(now + 10) == []
+
+def test_wraps_past_one_revolution():
+    wheel = TimerWheel(TICK, slots=8)
+    now = start_of(wheel)
+    revolution = 8 * TICK
+    # Both land in the same slot, the far one two revolutions later.
+    wheel.schedule(1.0, "near", now)
+    wheel.schedule(1.0 + 2 * revolution, "far", now)
+    fired = fired_at(wheel, now, now + 4 * revolution)
+    assert len(fired["near"]) == 1 and now + 1.0 <= fired["near"][0] < now + 1.0 + 2 * TICK
+    assert len(fired["far"]) == 1 and now + 1.0 + 2 * revolution <= fired["far"][0] < now + 1.0 + 2 * revolution + 2 * TICK
+    assert len(wheel) == 0
+
+def test_long_pause_returns_everything_once():
+    wheel = TimerWheel(TICK, slots=8)
+    now = start_of(wheel)
+    for number in range(50):
+        wheel.schedule(number * 0.7, number, now)
+    # Far more than one revolution passed without an expire.
+    assert sorted(wheel.expire(now + 100)) == list(range(50))
+    assert len(wheel) == 0
+    assert wheel.expire(now + 200) == []
+
+def test_schedule_behind_the_wheel():
+    wheel = TimerWheel(TICK)
+    now = start_of(wheel)
+    wheel.expire(now + 5)
+    # Counted from a time the wheel already passed, it fires on the next tick.
+    wheel.schedule(1.0, "late", now)
+    assert wheel.expire(now + 5) == []
+    assert wheel.expire(now + 5 + TICK) == ["late"]
+
+def test_gone_client_is_dropped_when_its_timer_fires(monkeypatch):
+    wheel = TimerWheel(TICK)
+    monkeypatch.setattr(connection, "liveness_checks", wheel)
+    now = start_of(wheel)
+    gone = Client(("test", 1), None, client_id=1, client_name="gone")
+    alive = Client(("test", 2), object(), client_id=2, client_name="alive")
+    for client in (gone, alive):
+        client.last_seen = now
+        wheel.schedule(TICK, client, now)
+    assert ConnectionHandler.remove_disconnected_clients(now + 2 * TICK) == 0
+    # The live client is checked again later, the gone one leaves the wheel without a check.
+    assert len(wheel) == 1
@@ -0,0 +1,17 @@
+"""
+Multilingual chat messages shared by the receive path tests (test_protocol.py) and the decoding benchmark (bench_text.py):
+Hebrew, emoji with modifiers and joiners, combining marks, CJK, a long mixed message and an empty one.
+"""
+
+MESSAGES = (
+    "hello",
+    "שלום לכולם, מה שלומכם?",
+    "emoji 😀👍🏽🇮🇱 and a family 👨‍👩‍👧‍👦",
+    "combining: é ä שָׁ",
+    "日本語のテキストと中文",
+    "mixed שלום 😀 日本 é " * 20,
+    "",
+)
+
+if __name__ == "__main__":
+    pass
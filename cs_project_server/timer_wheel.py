@@ -0,0 +1,73 @@
+import threading
+import time
+
+class TimerWheel:
+    """
+    Hashed timing wheel. A timer lands in the slot of its deadline tick modulo the wheel size, so scheduling is O(1)
+    and advancing the wheel only visits the slots of the ticks that passed, never every timer.
+    Timers further away than one revolution stay in their slot until their tick comes around.
+    """
+    def __init__(self, tick: float, slots: int = 512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]  # (deadline tick, item) lists
+        self.count = 0
+        # The next tick to expire, every one before it was already handled.
+        self.current = self._tick_of(time.monotonic())
+        self._lock = threading.Lock()
+
+    def _tick_of(self, when: float) -> int:
+        return int(when // self.tick)
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay: float, item, now: float = None):
+        """
+        Return item from expire() once delay seconds have passed, rounded up to the next tick.
+        args:
+            delay (float): Seconds from now.
+            item: Anything, usually the object the timer is about.
+            now (float): The monotonic time delay counts from, defaults to now.
+        """
+        deadline = self._tick_of((time.monotonic() if now is None else now) + delay) + 1
+        with self._lock:
+            deadline = max(deadline, self.current)
+            self.slots[deadline % len(self.slots)].append((deadline, item))
+            self.count += 1
+
+    def expire(self, now: float = None) -> list:
+        """
+        Advance the wheel to now.
+        returns:
+            list: The items whose deadline passed, each returned once.
+        """
+        last = self._tick_of(time.monotonic() if now is None else now)
+        if last < self.current:
+            return []
+        expired = []
+        with self._lock:
+            # After a long pause every slot is visited at most once.
+            end = min(last + 1, self.current + len(self.slots))
+            for tick in range(self.current, end):
+                slot = self.slots[tick % len(self.slots)]
+                if not slot:
+                    continue
+                waiting = [entry for entry in slot if entry[0] > last]
+                if len(waiting) < len(slot):
+                    expired.extend(item for deadline, item in slot if deadline <= last)
+                    slot[:] = waiting
+            self.current = max(self.current, last + 1)
+            self.count -= len(expired)
+        return expired
+
+    def next_deadline(self) -> float:
+        """
+        returns:
+            float: The monotonic time of the next tick to expire, None if the wheel is empty.
+        """
+        if not self.count:
+            return None
+        return self.current * self.tick
+
+if __name__ == "__main__":
+    pass
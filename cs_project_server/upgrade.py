@@ -0,0 +1,246 @@
+from utils import logger, UPGRADE_TIMEOUT
+import os
+import json
+import time
+import base64
+import socket
+import utils
+import shared_data
+import metrics
+import chat
+import history
+import event_loop
+import sessions
+import lobby
+import rate_limit
+from cluster import send_control, recv_control
+from connection import ConnectionHandler
+from client_handler import Client
+
+# The running server and its successor talk over a SOCK_SEQPACKET Unix socket, with the same JSON control messages as
+# the workers of a multi-process server: the sockets travel alongside them as SCM_RIGHTS file descriptors.
+# Client sockets per message, under the kernel's limit of 253 descriptors in one SCM_RIGHTS message.
+FDS_PER_MESSAGE = 250
+# Bytes of client states, and of a client's buffered data before base64, per message, well under the socket's send buffer.
+MESSAGE_SIZE = 48 * 1024
+
+def listen(path: str, loop: event_loop.EventLoop) -> socket.socket:
+    """
+    Wait for a successor on the upgrade socket. The hand-over runs on the loop, which serves nobody while it lasts:
+    new connections wait in the listen backlog and the clients' data in their socket buffers.
+    """
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass  # no previous server, or it exited cleanly
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    server.bind(path)
+    server.listen(1)
+    server.setblocking(False)
+    loop.add_reader(server, lambda: _on_successor(server, loop))
+    logger.info(f"Waiting for upgrades on {path}")
+    return server
+
+def _on_successor(server: socket.socket, loop: event_loop.EventLoop):
+    try:
+        link, address = server.accept()
+    except (BlockingIOError, InterruptedError):
+        return
+    link.settimeout(UPGRADE_TIMEOUT)
+    logger.info("A new server process is taking over %d connections", len(loop.clients))
+    try:
+        hand_over(link, loop)
+        message, fds = recv_control(link)
+        if message is None or message["type"] != "ready":
+            raise ConnectionError("the new process did not take the connections over")
+    except (OSError, ValueError) as e:
+        # Nothing was closed on this side, the clients never notice a failed upgrade either.
+        logger.error(f"Upgrade failed, this process keeps serving: {e}")
+        link.close()
+        return
+    logger.info("Upgrade complete, exiting")
+    utils.close_logger(logger)
+    # The new process holds the same sockets, closing this process' descriptors doesn't end any connection.
+    os._exit(0)
+
+def client_state(client: Client) -> dict:
+    bucket = client.rate_bucket
+    return {
+        "client_id": client.client_id,
+        "client_name": client.client_name,
+        "address": list(client.address),
+        "room_id": client.room_id,
+        "connected_at": client.connected_at,
+        "compression": client.deflater is not None,
+        # A detached client has no socket, it waits in the new process for a connection to resume its session.
+        "detached": client.detached,
+        "session": sessions.save(client.session) if client.session is not None else None,
+        "subscribed": lobby.room_list.subscribers.get(client.client_id) is client,
+        "rate": [bucket.messages, bucket.bytes, bucket.updated] if bucket is not None else None,
+        "throttled": client.throttled,
+    }
+
+def send_data(link: socket.socket, client_id: int, field: str, data: bytes):
+    for start in range(0, len(data), MESSAGE_SIZE):
+        chunk = base64.b64encode(data[start:start + MESSAGE_SIZE]).decode("ascii")
+        send_control(link, {"type": "data", "client_id": client_id, "field": field, "data": chunk})
+
+def hand_over(link: socket.socket, loop: event_loop.EventLoop):
+    """
+    Send the listening sockets and every connection, with its name, room, session, lobby subscription and rate limit
+    state and the bytes it has buffered both ways, to the new process. Detached sessions go along without a socket.
+    raises:
+        OSError: If the new process went away or the history writer did not catch up in time.
+    """
+    rooms = list(shared_data.registry.rooms.values())
+    for chat_room in rooms:
+        chat_room.flush_presence()
+    if history.store is not None and not history.store.flush(UPGRADE_TIMEOUT):
+        raise TimeoutError("the history writer did not catch up")
+    # Room members first and in their room's order, so the new process rebuilds the rooms as they are.
+    clients = {}
+    for chat_room in rooms:
+        clients.update((client.client_id, client) for client in chat_room.chat_clients)
+    clients.update((client.client_id, client) for client in loop.clients)
+    clients.update((client.client_id, client) for client in sessions.by_token.values())
+    clients = [client for client in clients.values() if client.socket is not None or client.detached]
+    listeners = [loop.server_socket.fileno()]
+    if metrics.http_server is not None:
+        listeners.append(metrics.http_server.socket.fileno())
+    send_control(link, {
+        "type": "server",
+        "next_client_id": ConnectionHandler._client_id,
+        "next_chat_id": chat.Chat._chat_id,
+        "metrics": metrics.http_server is not None,
+    }, listeners)
+    batch, states, size = [], [], 0
+    for client in clients + [None]:
+        state = client_state(client) if client is not None else None
+        length = len(json.dumps(state)) if state is not None else 0
+        if batch and (client is None or len(batch) == FDS_PER_MESSAGE or size + length > MESSAGE_SIZE):
+            send_control(link, {"type": "clients", "clients": states}, [sent.socket.fileno() for sent in batch if not sent.detached])
+            for sent in batch:
+                send_data(link, sent.client_id, "pending", b"".join(bytes(chunk) for chunk in sent.outbound.pending()))
+                if sent.session is not None:
+                    send_data(link, sent.client_id, "ring", b"".join(bytes(chunk) for chunk in sent.session.chunks))
+                if not sent.detached:
+                    # A detached client's partial frame is sent again by the client when it resumes.
+                    send_data(link, sent.client_id, "received", sent.parser.unparsed())
+            batch, states, size = [], [], 0
+        if client is not None:
+            batch.append(client)
+            states.append(state)
+            size += length
+    send_control(link, {"type": "done"})
+    logger.info("Handed %d connections and %d rooms over", len(clients), len(rooms))
+
+def connect(path: str):
+    """
+    Ask the server waiting on the upgrade socket to hand its connections over.
+    returns:
+        Takeover: The hand-over in progress, None if no server is waiting there.
+    """
+    link = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    link.settimeout(UPGRADE_TIMEOUT)
+    try:
+        link.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        link.close()
+        return None
+    logger.info(f"Taking over from the server waiting on {path}")
+    return Takeover(link)
+
+class Takeover:
+    """
+    New process side of an upgrade: the listening sockets arrive first, the connections once the loop exists.
+    """
+    def __init__(self, link: socket.socket):
+        self.link = link
+        message, fds = recv_control(link)
+        if message is None or message["type"] != "server":
+            raise ConnectionError("the running server did not hand its listening socket over")
+        self.server = message
+        self.listener = socket.socket(fileno=fds[0])
+        self.metrics_listener = socket.socket(fileno=fds[1]) if message["metrics"] else None
+
+    def restore(self, loop: event_loop.EventLoop):
+        """
+        Receive every connection, register it with the loop and put the rooms back together, then let the old process exit.
+        raises:
+            OSError: If the old process went away, nothing was written to the connections then.
+        """
+        # The restored rooms must not start the threaded mode's room managers.
+        shared_data.event_loop = loop
+        states, data = [], {}
+        while True:
+            message, fds = recv_control(self.link, FDS_PER_MESSAGE)
+            if message is None:
+                raise ConnectionError("the running server closed the upgrade link")
+            if message["type"] == "clients":
+                fds = iter(fds)
+                for state in message["clients"]:
+                    state["socket"] = None if state["detached"] else socket.socket(fileno=next(fds))
+                    states.append(state)
+            elif message["type"] == "data":
+                data.setdefault((message["client_id"], message["field"]), []).append(base64.b64decode(message["data"]))
+            elif message["type"] == "done":
+                break
+        ConnectionHandler._client_id = self.server["next_client_id"]
+        clients = [self._restore_client(state, data, loop) for state in states]
+        chat.Chat._chat_id = self.server["next_chat_id"]
+        send_control(self.link, {"type": "ready"})
+        self.link.close()
+        # Frames the old process read but did not handle yet, now that every room is back.
+        for client in clients:
+            received = b"".join(data.get((client.client_id, "received"), []))
+            if received and client.socket is not None:
+                loop.handle_data(client, received)
+        logger.info("Took over %d connections and %d rooms", len(clients), len(shared_data.registry.rooms))
+
+    def _restore_client(self, state: dict, data: dict, loop: event_loop.EventLoop) -> Client:
+        """
+        args:
+            state (dict): What client_state() returned in the old process, with the client's socket, None if detached.
+            data (dict): (client_id, field) -> the chunks of the client's buffered bytes.
+        """
+        def field(name: str) -> bytes:
+            return b"".join(data.get((state["client_id"], name), []))
+
+        client = Client(tuple(state["address"]), state["socket"], client_id=state["client_id"], client_name=state["client_name"])
+        # Monotonic time is system wide, the handshake timeout keeps counting from the original accept.
+        client.connected_at = state["connected_at"]
+        if state["detached"]:
+            client.loop = loop  # it gave its connection slot back when it dropped
+        else:
+            client.admitted = shared_data.registry.open_connection(client.address[0])
+            loop.register_client(client)
+        ConnectionHandler.watch(client)
+        if state["compression"]:
+            # The streaming context stays behind in the old process, later frames are compressed on their own.
+            client.enable_compression(context=False)
+        if state["session"] is not None:
+            sessions.restore(client, state["session"], field("ring"))
+        pending = field("pending")
+        if pending:
+            client.send(pending)
+        if state["rate"] is not None and client.rate_bucket is not None:
+            bucket = client.rate_bucket
+            bucket.messages, bucket.bytes, bucket.updated = state["rate"]
+            if state["throttled"] and not client.detached:
+                client.throttle(rate_limit.client_limit.debt(bucket, time.monotonic()))
+        if client.client_name is not None:
+            shared_data.registry.add_client(client)
+            if state["subscribed"]:
+                lobby.room_list.subscribe(client)
+        room_id = state["room_id"]
+        if room_id is not None:
+            chat_room = shared_data.registry.get_room(room_id)
+            if chat_room is None:
+                chat.Chat._chat_id = room_id
+                chat_room = chat.Chat()
+                shared_data.registry.add_room(chat_room)
+            chat_room.add_client(client)
+        return client
+
+if __name__ == "__main__":
+    pass
@@ -1,18 +1,132 @@
 import logging
+import logging.handlers
+import atexit
+import queue
+import time
 import dotenv
 import os
 dotenv.load_dotenv()
 MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", 5))
 MAX_BUFFER_SIZE = int(os.getenv("MAX_BUFFER_SIZE", 1024))
+# Admission control: connections over MAX_CONNECTIONS, or over MAX_CONNECTIONS_PER_IP from one address (0 for no limit),
+# get a busy frame asking them to retry after BUSY_RETRY_AFTER seconds and are closed right away.
+MAX_CONNECTIONS_PER_IP = int(os.getenv("MAX_CONNECTIONS_PER_IP", 0))
+BUSY_RETRY_AFTER = int(os.getenv("BUSY_RETRY_AFTER", 5))
+# Liveness: a connection silent for PING_INTERVAL seconds is pinged, and disconnected once it was silent for IDLE_TIMEOUT,
+# did not send its name within HANDSHAKE_TIMEOUT, or had queued output that made no progress for WRITE_TIMEOUT. 0 disables one.
+# The checks are kept in a timer wheel with LIVENESS_TICK seconds resolution.
+PING_INTERVAL = float(os.getenv("PING_INTERVAL", 30))
+IDLE_TIMEOUT = float(os.getenv("IDLE_TIMEOUT", 90))
+HANDSHAKE_TIMEOUT = float(os.getenv("HANDSHAKE_TIMEOUT", 30))
+WRITE_TIMEOUT = float(os.getenv("WRITE_TIMEOUT", 60))
+LIVENESS_TICK = float(os.getenv("LIVENESS_TICK", 1))
+# Per message compression for the clients that ask for it during the handshake: "deflate", or "none" to refuse.
+# Payloads under COMPRESSION_MIN_SIZE bytes are sent as they are, compressing them costs more than it saves.
+COMPRESSION = os.getenv("COMPRESSION", "deflate").lower()
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", 6))
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 256))
+# Kernel queue of connections waiting to be accepted, and the most the event loop accepts in one go.
+LISTEN_BACKLOG = int(os.getenv("LISTEN_BACKLOG", 1024))
+ACCEPT_BURST = int(os.getenv("ACCEPT_BURST", 64))
+# "loop" runs every connection on one selector loop, "threaded" keeps the thread per client fallback.
+SERVER_MODE = os.getenv("SERVER_MODE", "loop").lower()
+# Zero-downtime upgrades of a single process event loop server: it waits for a successor on the UPGRADE_SOCKET Unix socket
+# path ("" disables it). A new server started with the same path takes over the listening socket and every connection,
+# and the running one exits. Either side gives up on an upgrade that takes longer than UPGRADE_TIMEOUT seconds.
+UPGRADE_SOCKET = os.getenv("UPGRADE_SOCKET", "")
+UPGRADE_TIMEOUT = float(os.getenv("UPGRADE_TIMEOUT", 10))
+# More than one worker starts a multi-process server, each worker runs its own event loop and owns its rooms.
+WORKERS = int(os.getenv("WORKERS", 1))
+# Per connection outbound buffer limits in bytes, and what to do with clients that stay above them:
+# "disconnect", "drop_oldest" or "pause" (stop reading from the sender until the buffer drains).
+OUTBOUND_HIGH_WATERMARK = int(os.getenv("OUTBOUND_HIGH_WATERMARK", 256 * 1024))
+OUTBOUND_LOW_WATERMARK = int(os.getenv("OUTBOUND_LOW_WATERMARK", 64 * 1024))
+SLOW_CONSUMER_POLICY = os.getenv("SLOW_CONSUMER_POLICY", "disconnect").lower()
+# Rate limits on what clients send, charged as their frames are read: messages and bytes per second for each connection,
+# and for the chat messages posted in each room, with bursts of RATE_LIMIT_BURST seconds worth of them. All of them are
+# off (0) by default, e.g. CLIENT_MESSAGE_RATE=20 CLIENT_BYTE_RATE=65536 caps each client at 20 messages and 64 KiB a second.
+# Over a limit, "pause" stops reading from the client until it is back under it, letting TCP push back on the sender,
+# "drop" discards the message and tells the client, "disconnect" closes the connection.
+CLIENT_MESSAGE_RATE = float(os.getenv("CLIENT_MESSAGE_RATE", 0))
+CLIENT_BYTE_RATE = float(os.getenv("CLIENT_BYTE_RATE", 0))
+ROOM_MESSAGE_RATE = float(os.getenv("ROOM_MESSAGE_RATE", 0))
+ROOM_BYTE_RATE = float(os.getenv("ROOM_BYTE_RATE", 0))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", 2))
+RATE_LIMIT_POLICY = os.getenv("RATE_LIMIT_POLICY", "pause").lower()
+# Resumable sessions for the clients that ask for them, event loop mode only: a client whose connection drops keeps its
+# place in its room for RESUME_TIMEOUT seconds (0 disables resuming), and the last RESUME_BUFFER_BYTES written to it are
+# kept so a new connection presenting its token gets whatever the old one lost.
+RESUME_TIMEOUT = float(os.getenv("RESUME_TIMEOUT", 60))
+RESUME_BUFFER_BYTES = int(os.getenv("RESUME_BUFFER_BYTES", 256 * 1024))
+MAX_CHAT_SIZE = int(os.getenv("MAX_CHAT_SIZE", 2))
+# Which open room a matchmaking request ('any', 'with <names>') joins first: "fill" the fullest, then the oldest,
+# so rooms fill up before new ones get members, or "age" the oldest.
+MATCH_ORDER = os.getenv("MATCH_ORDER", "fill").lower()
+# Rooms per page of the lobby's room list, and how long changes of the list are collected before they are pushed to
+# the subscribed lobby clients as one message, 0 pushes each right away.
+LOBBY_PAGE_SIZE = int(os.getenv("LOBBY_PAGE_SIZE", 50))
+ROOM_UPDATE_INTERVAL = float(os.getenv("ROOM_UPDATE_INTERVAL", 0.25))
+# Join and leave notifications are collected for PRESENCE_INTERVAL seconds and sent as one message, 0 sends each right away.
+PRESENCE_INTERVAL = float(os.getenv("PRESENCE_INTERVAL", 0.25))
+# Event loop threads writing to the sockets when one iteration has many connections to write, 0 writes on the loop thread.
+FANOUT_THREADS = int(os.getenv("FANOUT_THREADS", 0))
+# Opt-in write coalescing: hold a connection's writes for up to FLUSH_DELAY seconds so more messages go out
+# in one sendmsg call, unless FLUSH_BYTES are already queued. 0 writes at the end of every loop iteration.
+FLUSH_DELAY = float(os.getenv("FLUSH_DELAY", 0))
+FLUSH_BYTES = int(os.getenv("FLUSH_BYTES", 16 * 1024))
+# Local endpoint serving the metrics in the Prometheus text format, port 0 disables it.
+# Worker processes of a multi-process server listen on METRICS_PORT + 1 + their index.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+# Set HISTORY_DIR to keep the rooms' chat messages on disk and replay them to clients joining a room:
+# the last HISTORY_REPLAY_COUNT, or what the client asks for with "<room id> last <count>" / "<room id> since <unix time>".
+# Each room's log is split in HISTORY_SEGMENT_BYTES segments, the oldest are deleted once the room's history is
+# over HISTORY_MAX_BYTES or they are older than HISTORY_MAX_AGE seconds. Writes are fsynced every HISTORY_FSYNC_INTERVAL seconds.
+# A room whose last member left, or that was open before a restart, opens again under its id when a client joins it
+# while its history is on disk. Such rooms are not in the lobby's list, the clients need to know the id. New rooms
+# never take the id of one with history.
+HISTORY_DIR = os.getenv("HISTORY_DIR", "")
+HISTORY_REPLAY_COUNT = int(os.getenv("HISTORY_REPLAY_COUNT", 50))
+HISTORY_SEGMENT_BYTES = int(os.getenv("HISTORY_SEGMENT_BYTES", 1024 * 1024))
+HISTORY_MAX_BYTES = int(os.getenv("HISTORY_MAX_BYTES", 64 * 1024 * 1024))
+HISTORY_MAX_AGE = int(os.getenv("HISTORY_MAX_AGE", 7 * 24 * 3600))
+HISTORY_FSYNC_INTERVAL = float(os.getenv("HISTORY_FSYNC_INTERVAL", 0.05))
+# Hand log records to a background writer thread instead of writing them on the calling thread.
+LOG_ASYNC = os.getenv("LOG_ASYNC", "true").lower() == "true"
+# The log file rotates once it reaches LOG_MAX_BYTES, keeping LOG_BACKUP_COUNT old files.
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5))
+# Per message events are summarized every LOG_SUMMARY_INTERVAL seconds, and only every
+# LOG_SAMPLE_EVERY-th one is logged in full at DEBUG level (0 logs none of them).
+LOG_SUMMARY_INTERVAL = float(os.getenv("LOG_SUMMARY_INTERVAL", 10))
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", 0))
 
-def setup_logger(name: str, level: str = "DEBUG") -> logging.Logger:
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves the record untouched, the message is formatted by the writer thread.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+def _start_listener(handler: LazyQueueHandler, *targets: logging.Handler, forked: bool = False):
+    """
+    Start the writer thread of a queue handler, on a new queue in a forked child.
+    """
+    if forked:
+        atexit.unregister(handler.listener.stop)
+        handler.queue = queue.SimpleQueue()
+    handler.listener = logging.handlers.QueueListener(handler.queue, *targets, respect_handler_level=True)
+    handler.listener.start()
+    atexit.register(handler.listener.stop)
+
+def setup_logger(name: str, level: str = "DEBUG", async_mode: bool = LOG_ASYNC) -> logging.Logger:
     logger = logging.getLogger(name)
 
     logger.setLevel(level)
 
     if not logger.handlers:
         ch = logging.StreamHandler()
-        fh = logging.FileHandler(f"{name}.log")
+        fh = logging.handlers.RotatingFileHandler(f"{name}.log", maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
         fh.setLevel(level)
         ch.setLevel(level)
 
@@ -21,12 +135,62 @@ def setup_logger(name: str, level: str = "DEBUG") -> logging.Logger:
         )
         fh.setFormatter(formatter)
         ch.setFormatter(formatter)
-        logger.addHandler(fh)
-        logger.addHandler(ch)
+        if async_mode:
+            # Callers only enqueue the record, formatting and the blocking writes happen on the listener thread.
+            handler = LazyQueueHandler(queue.SimpleQueue())
+            _start_listener(handler, fh, ch)
+            # Forked worker processes don't inherit the writer thread. The parent's listener still looks started there
+            # and the queue may hold the parent's records, the child gets a queue and a listener of its own.
+            os.register_at_fork(after_in_child=lambda: handler in logger.handlers and _start_listener(handler, fh, ch, forked=True))
+            logger.addHandler(handler)
+        else:
+            logger.addHandler(fh)
+            logger.addHandler(ch)
 
     return logger
 
-logger = setup_logger("socket_server", os.getenv("LOG_LEVEL", "DEBUG"))
+def close_logger(logger: logging.Logger):
+    """
+    Flush and remove the logger's handlers, stopping its writer thread if it has one.
+    """
+    for handler in list(logger.handlers):
+        listener = getattr(handler, "listener", None)
+        if listener is not None:
+            listener.stop()
+            atexit.unregister(listener.stop)
+            for target in listener.handlers:
+                target.close()
+        handler.close()
+        logger.removeHandler(handler)
+
+class LogSampler:
+    """
+    Turns a per message log line into one summary line per interval, optionally logging every Nth event in full.
+    """
+    def __init__(self, logger: logging.Logger, events: str, interval: float = LOG_SUMMARY_INTERVAL, sample_every: int = LOG_SAMPLE_EVERY):
+        self.logger = logger
+        self.events = events
+        self.interval = interval
+        self.sample_every = sample_every
+        self.count = 0
+        self.window_start = time.monotonic()
+
+    def record(self, msg: str, *args):
+        """
+        Count one event, the message and its args are only formatted if the event is sampled.
+        args:
+            msg (str): %-style log message of the event.
+        """
+        self.count += 1
+        if self.sample_every and self.count % self.sample_every == 0:
+            self.logger.debug(msg, *args)
+        now = time.monotonic()
+        if now - self.window_start >= self.interval:
+            self.logger.info("%d %s in the last %.1fs", self.count, self.events, now - self.window_start)
+            self.count = 0
+            self.window_start = now
+
+logger = setup_logger("socket_server", os.getenv("LOG_LEVEL", "INFO"))
 
 if __name__ == "__main__":
     pass
\ No newline at end of file